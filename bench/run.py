@@ -0,0 +1,328 @@
+#!/bin/env python
+#
+# Benchmark of the deploy scripts on a plain Linux box.
+#
+# The full flows of deploy-vm-centos7.py and deploy-vm-ceph-centos6.py run
+# against synthetic sparse templates (an MBR with one partition and random
+# data filling a given ratio of the disk) and stand-in executables for
+# qemu-img, losetup, kpartx, mount, rbd, virsh and friends (bench/stub.py)
+# which record their calls and sleep a simulated latency. Root, libvirt and
+# ceph are not needed, the disk images are real sparse files.
+#
+# For every template and concurrency level, '--deploys' vms are deployed
+# at most '--concurrency' at a time, and the report shows:
+#
+#   - per-stage latency from the deploys' event log (see vmdeploy.events);
+#   - end-to-end latency of the deploy processes;
+#   - subprocess calls per deploy by command;
+#   - throughput in deploys per minute and MiB of template data per second.
+#
+# Example:
+#
+#   python bench/run.py --python python2 --sizes 10 --fills 0.01,0.05 \
+#       --concurrency 1,4 --deploys 8 --latency default=0.01,rbd=0.1
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+
+SCRIPTS = {
+    'centos7': 'deploy-vm-centos7.py',
+    'ceph': 'deploy-vm-ceph-centos6.py',
+}
+
+# Commands replaced by bench/stub.py.
+STUB_COMMANDS = (
+    'qemu-img', 'losetup', 'kpartx', 'mount', 'umount', 'mkswap',
+    'xfs_growfs', 'e2fsck', 'resize2fs', 'rbd', 'virsh')
+
+SECTOR_SIZE = 512
+CHUNK_SIZE = 1024 * 1024
+
+
+def check_list(convert):
+    def check(value):
+        try:
+            return [convert(v) for v in value.split(',') if v]
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid list: " + value)
+    return check
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the deploy scripts with stub binaries '
+        'and synthetic templates')
+    parser.add_argument(
+        '--python', help="python running the deploy scripts. "
+        "(Default: %(default)s)", dest='python', default=sys.executable)
+    parser.add_argument(
+        '--scripts', help="deploy scripts to run, separated by comma: "
+        "centos7, ceph. (Default: centos7,ceph)", dest='scripts',
+        default=['centos7', 'ceph'], type=check_list(str))
+    parser.add_argument(
+        '--sizes', help="template sizes separated by comma. Unit: GB. "
+        "(Default: 10)", dest='sizes', default=[10], type=check_list(int))
+    parser.add_argument(
+        '--fills', help="ratios of the templates filled with data, "
+        "separated by comma. (Default: 0.01,0.05)", dest='fills',
+        default=[0.01, 0.05], type=check_list(float))
+    parser.add_argument(
+        '--concurrency', help="numbers of deploys at the same time, "
+        "separated by comma. (Default: 1,4)", dest='concurrency',
+        default=[1, 4], type=check_list(int))
+    parser.add_argument(
+        '--deploys', help="vms deployed per template and concurrency. "
+        "(Default: %(default)s)", dest='deploys', default=4, type=int)
+    parser.add_argument(
+        '--latency', help="simulated latency of the stub commands in "
+        "seconds, like 'default=0.01,rbd=0.1'. (Default: %(default)s)",
+        dest='latency', default='default=0.01')
+    parser.add_argument(
+        '--workdir', help="directory of templates, vm images and logs. "
+        "A temporary directory is used and removed if unspecified.",
+        dest='workdir')
+    parser.add_argument(
+        '--json', help="also write the results to this file as json.",
+        dest='json_file')
+    return parser
+
+
+# Write a sparse template of 'size' GB with one partition and 'fill' of
+# the disk filled with random data in 1 MiB chunks.
+def make_template(path, size, fill):
+    total = size * 1024 ** 3
+    sectors = total // SECTOR_SIZE
+    with open(path, 'wb') as f:
+        f.truncate(total)
+        # MBR with partition 1 from sector 2048 to the end of the disk.
+        entry = struct.pack(
+            '<B3sB3sII', 0x80, b'\x00\x02\x00', 0x83, b'\xfe\xff\xff',
+            2048, sectors - 2048)
+        f.seek(446)
+        f.write(entry)
+        f.seek(510)
+        f.write(b'\x55\xaa')
+
+        chunks = (total - CHUNK_SIZE) // CHUNK_SIZE
+        count = min(chunks, int(total * fill) // CHUNK_SIZE)
+        rand = random.Random(size * 1000 + int(fill * 1000))
+        for index in sorted(rand.sample(range(chunks), count)):
+            f.seek((index + 1) * CHUNK_SIZE)
+            f.write(os.urandom(CHUNK_SIZE))
+    return count * CHUNK_SIZE
+
+
+def make_stubs(bindir):
+    os.makedirs(bindir)
+    stub = os.path.join(BENCH_DIR, 'stub.py')
+    for command in STUB_COMMANDS:
+        path = os.path.join(bindir, command)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'.format(
+                sys.executable, stub, command))
+        os.chmod(path, 0o755)
+
+
+def write_conf(workdir):
+    conf_file = os.path.join(workdir, 'bench.conf')
+    with open(conf_file, 'w') as f:
+        f.write(
+            "[DEFAULT]\n"
+            "vmdeploypath = {0}/vmimages\n"
+            "vmtmplpath = {0}/templates\n"
+            "vmcreatelogdir = {0}/logs\n".format(workdir))
+    return conf_file
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def stats_str(values):
+    return "{0:>8.3f}{1:>8.3f}{2:>8.3f}{3:>8.3f}".format(
+        sum(values) / len(values), percentile(values, 50),
+        percentile(values, 95), max(values))
+
+
+class Bench(object):
+
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.bindir = os.path.join(workdir, 'bin')
+        self.calls_file = os.path.join(workdir, 'calls.jsonl')
+        self.events_file = os.path.join(workdir, 'logs', 'events.jsonl')
+        for name in ('vmimages', 'templates', 'logs'):
+            os.makedirs(os.path.join(workdir, name))
+        make_stubs(self.bindir)
+        self.conf_file = write_conf(workdir)
+        self.runs = 0
+
+    def argv(self, script, vmname, tmpl, size):
+        argv = [self.args.python, os.path.join(BASE_DIR, SCRIPTS[script]),
+                '--conf', self.conf_file, '--name', vmname,
+                '--net', 'virbr0/10.0.0.{0}/24'.format(
+                    random.randint(2, 254))]
+        if script == 'ceph':
+            argv.extend(['--pool', 'rbd', '--tmpl', 'rbd/bench.rbd@snap'])
+        else:
+            argv.extend(['--tmpl', tmpl, '--sys', str(size)])
+        return argv
+
+    def deploy_one(self, job):
+        vmname, argv = job
+        env = dict(os.environ)
+        env['PATH'] = self.bindir + os.pathsep + env.get('PATH', '')
+        env['BENCH_CALLS'] = self.calls_file
+        env['BENCH_TAG'] = vmname
+        env['BENCH_LATENCY'] = self.args.latency
+        start = time.time()
+        with open(os.devnull, 'wb') as devnull:
+            returncode = subprocess.call(
+                argv, stdout=devnull, stderr=subprocess.STDOUT, env=env)
+        seconds = time.time() - start
+        # Keep the disk usage of the bench down.
+        shutil.rmtree(os.path.join(self.workdir, 'vmimages', vmname),
+                      ignore_errors=True)
+        return vmname, returncode, seconds
+
+    def read_jsonl(self, path, key, names):
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get(key) in names:
+                    records.append(record)
+        return records
+
+    # Deploy 'deploys' vms, 'concurrency' at a time, return the results.
+    def run(self, script, tmpl, size, data_size, concurrency):
+        self.runs += 1
+        names = ['bench{0}-{1}'.format(self.runs, index)
+                 for index in range(self.args.deploys)]
+        jobs = [(name, self.argv(script, name, tmpl, size))
+                for name in names]
+
+        pool = ThreadPool(concurrency)
+        start = time.time()
+        try:
+            deploys = pool.map(self.deploy_one, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        wall = time.time() - start
+
+        stages = {}
+        for event in self.read_jsonl(self.events_file, 'vmname', names):
+            if event['event'] == 'stage' and event['status'] == 'ok':
+                stages.setdefault(event['stage'], []).append(
+                    event['seconds'])
+        calls = {}
+        for call in self.read_jsonl(self.calls_file, 'tag', names):
+            calls[call['cmd']] = calls.get(call['cmd'], 0) + 1
+
+        ok = len([d for d in deploys if d[1] == 0])
+        return {
+            'script': script, 'template': tmpl, 'concurrency': concurrency,
+            'deploys': len(deploys), 'ok': ok, 'wall': wall,
+            'latency': [d[2] for d in deploys], 'stages': stages,
+            'calls': calls,
+            'deploys_per_minute': ok * 60.0 / wall if wall else 0.0,
+            'mib_per_second': (ok * data_size / 1048576.0 / wall
+                               if wall else 0.0)}
+
+
+def report_str(result, deploys):
+    lines = [
+        "== {script} template={template} concurrency={concurrency}".format(
+            **result),
+        "deploys {0}/{1} ok, {2:.1f} seconds, {3:.1f} deploys/min, "
+        "{4:.1f} MiB/s of template data".format(
+            result['ok'], result['deploys'], result['wall'],
+            result['deploys_per_minute'], result['mib_per_second']),
+        "{0:<16s}{1:>8s}{2:>8s}{3:>8s}{4:>8s}".format(
+            "Stage:", "Mean:", "P50:", "P95:", "Max:"),
+        "{0:<16s}{1}".format("end-to-end", stats_str(result['latency']))]
+    stages = sorted(result['stages'].items(),
+                    key=lambda item: -sum(item[1]) / len(item[1]))
+    for name, values in stages:
+        lines.append("{0:<16s}{1}".format(name, stats_str(values)))
+    total = sum(result['calls'].values())
+    lines.append("subprocesses per deploy: {0:.1f} ({1})".format(
+        total / float(deploys), ", ".join(
+            "{0} {1:.1f}".format(cmd, count / float(deploys))
+            for cmd, count in sorted(result['calls'].items()))))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    for script in args.scripts:
+        if script not in SCRIPTS:
+            print("Unknown script: " + script)
+            return 1
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        if os.path.exists(workdir) and os.listdir(workdir):
+            print(workdir + " is not empty.")
+            return 1
+    else:
+        workdir = tempfile.mkdtemp(prefix='kvm-bench-')
+
+    results = []
+    try:
+        bench = Bench(args, workdir)
+        for script in args.scripts:
+            if script == 'ceph':
+                # The template is a rbd snapshot, only the stubs run.
+                templates = [('rbd/bench.rbd@snap', 0, 0)]
+            else:
+                templates = []
+                for size in args.sizes:
+                    for fill in args.fills:
+                        tmpl = 'bench-{0}g-{1}'.format(size, fill)
+                        data_size = make_template(os.path.join(
+                            workdir, 'templates', tmpl + '.raw'), size, fill)
+                        # The sys disk is a multiple of 10 GB.
+                        templates.append(
+                            (tmpl, (size + 9) // 10 * 10, data_size))
+            for tmpl, size, data_size in templates:
+                for concurrency in args.concurrency:
+                    result = bench.run(
+                        script, tmpl, size, data_size, concurrency)
+                    print(report_str(result, args.deploys))
+                    print("")
+                    results.append(result)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    failed = [r for r in results if r['ok'] != r['deploys']]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# Stand-in for the commands run by the deploy scripts (qemu-img, losetup,
+# kpartx, mount, rbd, virsh, ...), used by bench/run.py.
+#
+# bench/run.py puts a wrapper named after each command in PATH which runs
+# 'python stub.py <command> <args>'. The stub
+#
+#   - appends the call as a JSON line to $BENCH_CALLS, tagged with
+#     $BENCH_TAG (the vm being deployed);
+#   - sleeps the latency of the command given by $BENCH_LATENCY, like
+#     'qemu-img=0.05,rbd=0.2,default=0.01';
+#   - does just enough of the command's work for the deploy to go on:
+#     qemu-img creates and resizes sparse files, losetup and rbd print a
+#     device, mount creates the directories the deploy writes to.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    if value[-1].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1].upper()]
+    return int(value)
+
+
+def latency(command):
+    table = {}
+    for item in os.environ.get('BENCH_LATENCY', '').split(','):
+        if '=' in item:
+            name, seconds = item.split('=', 1)
+            table[name.strip()] = float(seconds)
+    return table.get(command, table.get('default', 0.0))
+
+
+def record(command, argv, seconds):
+    calls = os.environ.get('BENCH_CALLS')
+    if not calls:
+        return
+    line = json.dumps({
+        'cmd': command, 'argv': argv, 'tag': os.environ.get('BENCH_TAG'),
+        'latency': seconds, 'time': time.time()}) + '\n'
+    fd = os.open(calls, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def truncate(path, size):
+    with open(path, 'ab') as f:
+        f.truncate(size)
+
+
+def qemu_img(argv):
+    # qemu-img create [-f fmt] [-o opts] file size
+    # qemu-img resize [-f fmt] file size
+    if argv and argv[0] in ('create', 'resize'):
+        operands = []
+        skip = False
+        for arg in argv[1:]:
+            if skip:
+                skip = False
+            elif arg in ('-f', '-o', '-F', '-b'):
+                skip = True
+            elif not arg.startswith('-'):
+                operands.append(arg)
+        if len(operands) >= 2:
+            truncate(operands[0], parse_size(operands[1]))
+    return 0
+
+
+def losetup(argv):
+    if argv == ['-f']:
+        print('/dev/loop' + str(random.randint(0, 255)))
+    return 0
+
+
+def mount(argv):
+    operands = [a for a in argv if not a.startswith('-')]
+    if len(operands) >= 2:
+        mountpoint = operands[-1]
+        for path in ('etc/sysconfig/network-scripts', 'root'):
+            if not os.path.isdir(os.path.join(mountpoint, path)):
+                os.makedirs(os.path.join(mountpoint, path))
+    return 0
+
+
+def umount(argv):
+    operands = [a for a in argv if not a.startswith('-')]
+    if operands and os.path.isdir(operands[-1]):
+        # The files written to the "guest" vanish like on a real umount.
+        for name in os.listdir(operands[-1]):
+            path = os.path.join(operands[-1], name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return 0
+
+
+def rbd(argv):
+    if argv and argv[0] == 'map':
+        print('/dev/rbd' + str(random.randint(0, 255)))
+    return 0
+
+
+ACTIONS = {
+    'qemu-img': qemu_img,
+    'losetup': losetup,
+    'mount': mount,
+    'umount': umount,
+    'rbd': rbd,
+}
+
+
+def main(argv):
+    command, args = argv[0], argv[1:]
+    seconds = latency(command)
+    record(command, args, seconds)
+    if seconds:
+        time.sleep(seconds)
+    action = ACTIONS.get(command)
+    if action is None:
+        return 0
+    return action(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,18 @@
 #!/bin/env python
 
 import sys
+from vmdeploy import client
+
+# Hand the deploy to the deploy daemon (python -m vmdeploy.daemon) when it
+# is running, it has the modules and the configuration loaded already.
+returncode = client.forward(__file__, sys.argv[1:])
+if returncode is not None:
+    sys.exit(returncode)
+
 import os
 import os.path
 import time
+import atexit
 import argparse
 import uuid
 import random
@@ -11,10 +20,24 @@ import datetime
 import shutil
 import logging
 import subprocess
-import ConfigParser
 import tempfile
 import netaddr
 from lxml import etree
+from vmdeploy import batch
+from vmdeploy import conf
+from vmdeploy import datadisk
+from vmdeploy import diskprofile
+from vmdeploy import events
+from vmdeploy import ipam
+from vmdeploy import membacking
+from vmdeploy import netif
+from vmdeploy import parttable
+from vmdeploy import plan
+from vmdeploy import rawdisk
+from vmdeploy import slots
+from vmdeploy import sparsecopy
+from vmdeploy import tmplcache
+from vmdeploy import topology
 
 # Parse command options.
 
@@ -44,8 +67,24 @@ def check_empty(value):
     return svalue
 
 
+def check_vmnet(value):
+    try:
+        netif.split(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
+def check_diskprofile(value):
+    try:
+        diskprofile.parse_spec(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
 # Factory function to make parser.
-def make_parser():
+def make_parser(batchmode=False):
     parser = argparse.ArgumentParser(
         description='Create a virtual machine',
         epilog='Author: xiaopan.h@gmail.com',
@@ -58,7 +97,7 @@ def make_parser():
         dest='conf_file', required=True)
     base_group.add_argument(
         '--name', help="vm's name.", dest='vmname',
-        metavar='vmname', required=True)
+        metavar='vmname', required=not batchmode)
     base_group.add_argument(
         '--tmpl', help='the template used to create the vm',
         dest='vmtmpl', metavar='vmtmpl')
@@ -78,6 +117,18 @@ def make_parser():
         "Must be positive. (Default: %(default)s)",
         dest='vmmemsize', metavar='vmmemsize',
         default=1, type=check_negative)
+    cap_group.add_argument(
+        '--numa', help="'auto' pins the vcpus to the cpus of the least "
+        "loaded numa node of the host (or the fewest nodes) and binds the "
+        "memory to them, 'off' lets them float. (Default: %(default)s)",
+        dest='vmnuma', metavar='vmnuma', default='off',
+        choices=['off', 'auto'])
+    cap_group.add_argument(
+        '--hugepages', help="back the memory by hugepages of this size, "
+        "which must be free on the host (or on the numa nodes of the vm "
+        "with '--numa auto'). (Default: %(default)s)",
+        dest='vmhugepages', metavar='vmhugepages', default='off',
+        choices=['off'] + sorted(membacking.PAGE_SIZES))
 
     # Options about VM's disks.
     disk_group = parser.add_argument_group(
@@ -97,6 +148,26 @@ def make_parser():
         '--data', help="vm's data disk size. Unit: GB "
         "Must be multiple of 10.", dest='vmdatasize',
         metavar='vmdatasize', type=check_time10)
+    disk_group.add_argument(
+        '--datafs', help="file system of the data disk. 'xfs' clones an "
+        "empty xfs image made once per size, so the guest mounts it at "
+        "boot without formatting it. 'none' creates a blank disk. "
+        "(Default: %(default)s)", dest='vmdatafs', metavar='vmdatafs',
+        default='xfs', choices=['xfs', 'none'])
+    disk_group.add_argument(
+        '--diskprofile', help="i/o profiles of the disks, like "
+        "'sys=database,data=database' or one profile for all the disks. "
+        "Profiles: default (chosen by libvirt), balanced (cache=none, "
+        "io=native, discard, own iothread), database (balanced with "
+        "detect_zeroes=off), uring (balanced with io=io_uring), swap "
+        "(cache=unsafe). (Default: default)", dest='vmdiskprofile',
+        metavar='vmdiskprofile', type=check_diskprofile)
+    disk_group.add_argument(
+        '--allocation', help="allocation of the swap and data disks and "
+        "of the grown part of the sys disk. 'off' makes them sparse, "
+        "'falloc' reserves their blocks on the host. "
+        "(Default: %(default)s)", dest='vmallocation',
+        metavar='vmallocation', default='off', choices=rawdisk.ALLOCATIONS)
 
     # Options about VM's network
     net_group = parser.add_argument_group(
@@ -108,9 +179,14 @@ def make_parser():
         "as 'br0/172.30.0.3/255.255.255.0' or "
         "'virbr0/192.168.44.3/24'. You can use 'br1//' if "
         "you want to create an interface but do NOT want "
-        "specify ip address. Each 'vmnet' becomes vm's "
-        "network interface, like eth[0,1,2..]",
-        dest='vmnet', metavar='vmnet', nargs='+', required=True)
+        "specify ip address, or 'br0/auto' to take the next free "
+        "address of the ip pool of the bridge (see '--ippool'). "
+        "Each 'vmnet' becomes vm's "
+        "network interface, like eth[0,1,2..]. Options may follow, "
+        "separated by ':', as 'br0/172.30.0.3/24:vhost:queues=4:rx=1024' "
+        "or 'eth1/172.30.0.3/24:macvtap' (see vmdeploy/netif.py).",
+        dest='vmnet', metavar='vmnet', nargs='+', type=check_vmnet,
+        required=not batchmode)
     net_group.add_argument(
         '--gw', help="vm's gateway", dest='vmgateway',
         metavar='vmgateway')
@@ -119,6 +195,12 @@ def make_parser():
         "name servers separated by comma, "
         "like 8.8.8.8,114.114.114.114",
         dest='vmnameserver', metavar='vmnameserver')
+    net_group.add_argument(
+        '--ippool', help="ip pools of the bridges, separated by comma, "
+        "like 'virbr1/172.18.28.0/24,br0/10.0.0.0/16'. Addresses given by "
+        "'--net' are checked against the pool of their bridge, a pool is "
+        "learned from the first address of a bridge without pool.",
+        dest='ippool', metavar='ippool')
 
     # Other options.
     other_group = parser.add_argument_group('Others')
@@ -149,6 +231,13 @@ def make_parser():
         "'--mem'.",
         dest='vmmemresv', action='store_true',
         default=False)
+    other_group.add_argument(
+        '--mrsvmode', help="how '--mrsv' reserves the memory: 'balloon' "
+        "allocates twice the memory and balloons it down, 'dimm' allocates "
+        "the memory and makes room for dimms of up to twice the memory to "
+        "be plugged online. (Default: %(default)s)",
+        dest='vmmemresvmode', metavar='vmmemresvmode', default='balloon',
+        choices=membacking.RESERVE_MODES)
     other_group.add_argument(
         '--pubkey', help="ssh public key files. It "
         "accepts multiple files separated by comma. "
@@ -158,55 +247,69 @@ def make_parser():
         "Those public key files's content will be added "
         "to vm's /root/.ssh/authorized_keys.",
         dest='pubkey', metavar='pubkeyfile')
+    other_group.add_argument(
+        '--tmplcachesize', help="disk budget of uncompressed "
+        "templates in 'vmtmplpath'. Unit: GB. Least recently used "
+        "templates that have a '.raw.tar.gz' archive are removed "
+        "when exceeded. No limit if unspecified.",
+        dest='tmplcachesize', metavar='tmplcachesize',
+        type=check_negative)
+
+    # Options about batch deploy.
+    batch_group = parser.add_argument_group('Batch')
+    batch_group.add_argument(
+        '--manifest', help="deploy every vm listed in the manifest "
+        "file instead of a single vm. The manifest is an ini file, "
+        "each section is a vm named after the section, its options "
+        "have the same names as the configuration file.",
+        dest='manifest', metavar='manifest')
+    batch_group.add_argument(
+        '--plan', help="check the vm, or every vm of the manifest, "
+        "without deploying it: names, addresses, bridges, templates, "
+        "sizes, and the disk and memory of all the vms against this "
+        "host.", dest='plan', action='store_true', default=False)
+    batch_group.add_argument(
+        '--jobs', help="number of vms deployed at the same time in "
+        "batch mode. Must be positive. (Default: %(default)s)",
+        dest='batchjobs', metavar='jobs', default=4,
+        type=check_negative)
+    batch_group.add_argument(
+        '--iojobs', help="max number of deploys copying or creating "
+        "disk images at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='iojobs', metavar='iojobs', type=check_negative)
+    batch_group.add_argument(
+        '--loopjobs', help="max number of deploys using loop devices "
+        "and mounts at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='loopjobs', metavar='loopjobs', type=check_negative)
 
     return parser
 
 
-# Print help messages.
-make_parser().parse_args()
-if len(sys.argv) == 1:
-    make_parser().print_help()
-    sys.exit(1)
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--conf', help='specify the configuartion file',
-                    dest='conf_file', required=True)
+# Parse command line arguments, options of the configuration file are
+# their defaults.
+args = conf.parse_args(make_parser)
 
-# By default, the argument strings are taken from sys.argv.
-# Until now, only one argument '--conf' are added to parser, so
-# parse_known_args() just return the populated namespace (args) and
-# the list of remaining argument.
-args, remaining_argv = parser.parse_known_args()
-# 'args' only contain 'conf_file'
+# Plan mode: check the vm, or every vm of the manifest, and exit without
+# deploying.
+if args.plan:
+    sys.exit(plan.run(
+        make_parser, args, args.vmdeploypath, args.vmtmplpath))
 
-
-# Get complete parser from factory function.
-parser = make_parser()
-
-# Use options read from conf_file to set default values to parser.
-if args.conf_file:
-    config = ConfigParser.ConfigParser()
-    config.read([args.conf_file])
-
-    # Function items() return a list of (name, value) pairs for each option
-    # in the given section of the configuration file.
-    options_default = dict(config.items('DEFAULT'))
-
-    # Translate 'vmnet' from string (separated by comma) to list.
-    if 'vmnet' in options_default:
-        options_default['vmnet'] = options_default['vmnet'].split(',')
-
-    parser.set_defaults(**options_default)
-
-# Parse command line arguments.
-args = parser.parse_args()
+# Batch mode: deploy every vm of the manifest by a child process of this
+# script, and exit with the number of failed vms.
+if args.manifest:
+    sys.exit(batch.run(
+        __file__, make_parser(True), args, args.vmcreatelogdir))
 
 
 if args.vmswapsize is None:
     args.vmswapsize = args.vmmemsize
 
-if args.vmmemresv is False:
+# With dimm hotplug the domain has the memory of the vm, the room to grow
+# it is <maxMemory>.
+if args.vmmemresv is False or args.vmmemresvmode == 'dimm':
     vmmemsize_max = args.vmmemsize
 else:
     vmmemsize_max = args.vmmemsize * 2
@@ -216,6 +319,9 @@ if args.vmcpuresv is False:
 else:
     vmcpunumber_max = args.vmcpunumber * 2
 
+# Take the options off the 'vmnet' items, like ':vhost:queues=4'.
+args.vmnet, vmnetopts = netif.split_vmnet(args.vmnet)
+
 
 vmuuid = str(uuid.uuid4())
 
@@ -258,31 +364,47 @@ consolehandler = logging.StreamHandler()
 consolehandler.setFormatter(logformatter)
 logger.addHandler(consolehandler)
 
-# Check whether template file exist.
-if not os.path.isfile(vmtmplfile):
-    logger.warn("Try to find compressed file of {0}.".format(vmtmplfile))
-    comp_vmtmplfile = vmtmplfile + ".tar.gz"
-    if not os.path.isfile(comp_vmtmplfile):
-        logger.error(vmtmplfile + " is not a valid template file.")
-        sys.exit(1)
-    else:
-        try:
-            subprocess.call(
-                ['tar', '-Sxzf', comp_vmtmplfile, '-C',
-                    os.path.dirname(comp_vmtmplfile)],
-                stdout=open(os.devnull, 'wb'))
-        except Exception:
-            logger.error(
-                "Failed to uncompress " + comp_vmtmplfile
-                + ". " + str(sys.exc_info()[1]))
-            sys.exit(1)
-        else:
-            logger.debug("Succeeded to uncompress " + comp_vmtmplfile + ".")
+# Time every stage of the deploy in the event log of the host. A deploy
+# which exits in the middle of a stage logs it as failed.
+eventlog = events.EventLog(
+    os.path.join(args.vmcreatelogdir, 'events.jsonl'), taskid, args.vmname)
+eventlog.emit('deploy', status='start', vmtmpl=args.vmtmpl)
+atexit.register(eventlog.close)
+
+# Get the template from the template cache. '<vmtmpl>.raw' is uncompressed
+# from '<vmtmpl>.raw.tar.gz' when it does not exist, other deploys of the
+# same template wait for it instead of uncompressing it again.
+templates = tmplcache.TemplateCache(args.vmtmplpath, args.tmplcachesize)
+eventlog.begin('template')
+try:
+    vmtmplfile = templates.acquire(args.vmtmpl)
+except Exception:
+    logger.error(
+        "Failed to get template " + args.vmtmpl
+        + ". " + str(sys.exc_info()[1]))
+    sys.exit(1)
+else:
+    eventlog.end('template', extracted=args.vmtmpl in templates.extracted)
+    logger.debug("Succeeded to get template file " + vmtmplfile + ".")
 
 
 # Helper function to clean vm directory when error occured.
 def cleanfailedcreate():
     logger.debug("Cleaning failed create.")
+    if vmipam is not None:
+        try:
+            with vmipam.locked():
+                vmipam.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release ip addresses. "
+                        + str(sys.exc_info()[1]))
+    if vmpinning is not None:
+        try:
+            with vmpinning.locked():
+                vmpinning.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release numa pinning. "
+                        + str(sys.exc_info()[1]))
     shutil.rmtree(vmdir)
     sys.exit(1)
 
@@ -292,19 +414,75 @@ def cleanfailedcreate():
 ##############################
 
 # Exit when can't create vm directory, reason as: vmname already exist.
+eventlog.begin('mkdir')
 try:
     os.mkdir(vmdir)
 except Exception:
     logger.error("Failed to create vm directory. " + str(sys.exc_info()[1]))
     sys.exit(1)
 else:
+    eventlog.end('mkdir')
     logger.debug("Suceeded to create vm directory.")
 
+# Take the '<bridge>/auto' addresses from the ip pools of the bridges and
+# check the given ones against them, under the lock of the pools.
+vmipam = None
+vmpinning = None
+eventlog.begin('ipam')
+try:
+    ippools = ipam.IPAM(args.vmdeploypath, ipam.parse_pools(args.ippool))
+    with ippools.locked():
+        args.vmnet = ippools.allocate(
+            args.vmname, args.vmnet, args.vmgateway,
+            args.vmnameserver.split(',') if args.vmnameserver else [])
+    vmipam = ippools
+    ipam.write_ifcfg(vmdir, args.vmnet)
+except Exception:
+    logger.error("Failed to allocate ip addresses. " + str(sys.exc_info()[1]))
+    cleanfailedcreate()
+else:
+    eventlog.end('ipam')
+    logger.debug("Suceeded to allocate ip addresses: "
+                 + ", ".join(args.vmnet) + ".")
+
+# Pin the vcpus and bind the memory to the least loaded numa nodes, under
+# the lock of the pinning state.
+vmplacement = None
+if args.vmnuma == 'auto':
+    eventlog.begin('numa')
+    try:
+        pinning = topology.Pinning(args.vmdeploypath)
+        with pinning.locked():
+            vmplacement = pinning.place(
+                args.vmname, vmcpunumber_max, vmmemsize_max * 1024 ** 3,
+                membacking.PAGE_SIZES.get(args.vmhugepages, 1024) * 1024)
+        vmpinning = pinning
+    except Exception:
+        logger.error("Failed to pin the vm to numa nodes. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+    else:
+        eventlog.end('numa', nodes=vmplacement['nodes'])
+        logger.debug("Suceeded to pin the vm to numa nodes: " + ",".join(
+            str(node) for node in vmplacement['nodes']) + ".")
+
+# Check the free hugepages of the host, or of the numa nodes of the vm.
+if args.vmhugepages != 'off':
+    try:
+        membacking.check_hugepages(
+            args.vmhugepages, vmmemsize_max * 1024 ** 3, vmplacement)
+    except membacking.MemoryBackingError:
+        logger.error("Failed to back the memory by hugepages. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+
 
 ##############################
 #      Create XML file       #
 ##############################
 
+eventlog.begin('xml')
+
 # All xml element variable name start with 'x_' to avoid name conflict.
 x_domain = etree.Element('domain', type='kvm')
 
@@ -364,33 +542,47 @@ x_emulator.text = '/usr/libexec/qemu-kvm'
 # Helper function to define disk info to xml file.
 
 
-def defdiskxml(parent, disk_source, disk_device):
+# 'disk_profiles' sets the i/o attributes of the disk 'disk_name' (sys, swap
+# or data).
+def defdiskxml(parent, disk_source, disk_device, disk_profiles, disk_name):
     x_disk = etree.SubElement(parent, 'disk', type='file', device='disk')
+    x_driver = etree.SubElement(x_disk, 'driver', name='qemu', type='raw')
+    disk_profiles.apply(x_driver, disk_name)
     x_source = etree.SubElement(x_disk, 'source', file=disk_source)
     x_target = etree.SubElement(
         x_disk, 'target', dev=disk_device, bus='virtio')
 
 
 # Define disk info to xml file.
-defdiskxml(x_devices, vmsysfile, 'vda')
-defdiskxml(x_devices, vmswapfile, 'vdb')
+disk_profiles = diskprofile.DiskProfiles(args.vmdiskprofile)
+defdiskxml(x_devices, vmsysfile, 'vda', disk_profiles, 'sys')
+defdiskxml(x_devices, vmswapfile, 'vdb', disk_profiles, 'swap')
 if args.vmdatasize > 0:
-    defdiskxml(x_devices, vmdatafile, 'vdc')
+    defdiskxml(x_devices, vmdatafile, 'vdc', disk_profiles, 'data')
+x_iothreads = disk_profiles.add_iothreads(x_vcpu)
+if vmplacement is not None:
+    topology.placement_xml(
+        x_vcpu if x_iothreads is None else x_iothreads, x_cpu,
+        vmplacement, vmpinning.topology, disk_profiles.iothreads)
+if args.vmhugepages != 'off':
+    membacking.hugepages_xml(x_currentMemory, args.vmhugepages)
+if args.vmmemresv and args.vmmemresvmode == 'dimm':
+    membacking.hotplug_xml(x_memory, x_cpu, args.vmmemsize * 2,
+                           vmcpunumber_max, args.vmmemsize)
 
 # Helper function to define network interface info to xml file.
 
 
-def defnetxml(parent, net_source):
-    x_interface = etree.SubElement(parent, 'interface', type='bridge')
-    x_source = etree.SubElement(x_interface, 'source', bridge=net_source)
-    x_model = etree.SubElement(x_interface, 'model', type='virtio')
+def defnetxml(parent, net_source, net_options):
+    x_interface = netif.interface_xml(
+        parent, net_source, net_options, vmcpunumber_max)
 
 
 # Define network info to xml file.
 # vmnet = ['br0/172.30.0.3/255.255.255.0', 'virbr0/192.168.44.3/24']
-for netitem in args.vmnet:
+for index, netitem in enumerate(args.vmnet):
     br_if = netitem.split('/')[0]
-    defnetxml(x_devices, br_if)
+    defnetxml(x_devices, br_if, vmnetopts[index])
 
 # Define other devices.
 x_serial = etree.SubElement(x_devices, 'serial', type='pty')
@@ -415,6 +607,7 @@ f = open(vmxmlfile, 'w')
 f.write(etree.tostring(x_domain, pretty_print=True))
 f.close()
 
+eventlog.end('xml')
 logger.debug("Suceeded to generate the xml file for guest domain.")
 
 
@@ -422,40 +615,49 @@ logger.debug("Suceeded to generate the xml file for guest domain.")
 #     Prepare VM's Disks     #
 ##############################
 
+# Copying and creating disk images is throttled by '--iojobs'.
+ioslot = slots.Slots('diskio', args.iojobs)
+ioslot.acquire()
+
 # Prepare the sys disk.
 # Copy from template file.
+eventlog.begin('copy')
 try:
-    subprocess.call(['cp', '--sparse=always', vmtmplfile, vmsysfile],
-                    stdout=open(os.devnull, 'wb'))
+    copystats = sparsecopy.copy(
+        vmtmplfile, vmsysfile, progress=sparsecopy.progress_logger(logger))
 except Exception:
     logger.error(
         "Failed to copy from " + vmtmplfile + " to " + vmsysfile
         + ". " + str(sys.exc_info()[1]))
     cleanfailedcreate()
 else:
-    logger.debug("Suceeded to copy from " + vmtmplfile + " to " + vmsysfile)
+    eventlog.end('copy', method=copystats.method)
+    logger.debug("Suceeded to copy from " + vmtmplfile + " to " + vmsysfile
+                 + ". " + str(copystats))
+
+# The template may be evicted from the cache once it is copied.
+templates.release(args.vmtmpl)
 
 # Resize the sys disk.
+eventlog.begin('resize')
 try:
-    subprocess.call(
-        ['qemu-img', 'resize', vmsysfile,
-            str(args.vmsyssize) + "G"],
-        stdout=open(os.devnull, 'wb'))
+    rawdisk.resize(vmsysfile, args.vmsyssize * rawdisk.GIB,
+                   args.vmallocation)
 except Exception:
     logger.error(
         "Failed to resize: " + vmsysfile
         + ". " + str(sys.exc_info()[1]))
     cleanfailedcreate()
 else:
+    eventlog.end('resize')
     logger.debug("Suceed to resize: " + vmsysfile)
 
 
 # Prepare the swap disk.
+eventlog.begin('swap')
 try:
-    subprocess.call(
-        ['qemu-img', 'create', '-f', 'raw', vmswapfile,
-            str(args.vmswapsize) + "G"],
-        stdout=open(os.devnull, 'wb'))
+    rawdisk.create(vmswapfile, args.vmswapsize * rawdisk.GIB,
+                   args.vmallocation)
 except Exception:
     logger.error(
         "Failed to create swap disk: " + vmswapfile
@@ -465,31 +667,46 @@ else:
     logger.debug("Suceeded to create swap disk: " + vmswapfile)
 
 try:
-    subprocess.call(['mkswap', '-f', vmswapfile],
-                    stdout=open(os.devnull, 'wb'))
+    rawdisk.mkswap(vmswapfile)
 except Exception:
     logger.error(
         "Failed to mkswap: " + vmswapfile
         + ". " + str(sys.exc_info()[1]))
     cleanfailedcreate()
 else:
+    eventlog.end('swap')
     logger.debug("Suceeded to mkswap: " + vmswapfile)
 
 
 # Prepare the data disk.
 if args.vmdatasize > 0:
+    eventlog.begin('data')
+    # Clone the formatted image of the size, or create a blank disk when
+    # it can not be made.
+    vmdatamethod = None
+    if args.vmdatafs == 'xfs':
+        try:
+            vmdatamethod = datadisk.DataDisks(args.vmdeploypath).clone(
+                args.vmdatasize, vmdatafile, args.vmallocation)
+        except Exception:
+            logger.warn("Failed to clone formatted data disk, create a "
+                        "blank one. " + str(sys.exc_info()[1]))
     try:
-        subprocess.call(
-            ['qemu-img', 'create', '-f', 'raw', vmdatafile,
-                str(args.vmdatasize) + "G"],
-            stdout=open(os.devnull, 'wb'))
+        if vmdatamethod is None:
+            vmdatamethod = 'create'
+            rawdisk.create(vmdatafile, args.vmdatasize * rawdisk.GIB,
+                           args.vmallocation)
     except Exception:
         logger.error(
             "Failed to create data disk: " + vmdatafile
             + ". " + str(sys.exc_info()[1]))
         cleanfailedcreate()
     else:
-        logger.debug("Suceeded to create data disk: " + vmdatafile)
+        eventlog.end('data', method=vmdatamethod)
+        logger.debug("Suceeded to create data disk: " + vmdatafile
+                     + " by " + vmdatamethod + ".")
+
+ioslot.release()
 
 
 #####################################
@@ -535,39 +752,25 @@ def unfile_to_loop_kpartx(loopdev):
     unfile_to_loop(loopdev)
 
 
-# Associate vmsysfile to a loop device and use fdisk to change partition table.
+# Grow partition 1 to the end of the sys disk by changing its partition
+# table (MBR or GPT) in place in the image file.
+eventlog.begin('partition')
 try:
-    loopdev = file_to_loop(vmsysfile)
-
-    # p1_start_sec is partition's first sector number.
-    p1_pobj = subprocess.Popen(
-        "fdisk -lu " + loopdev
-        + " | grep " + loopdev + "p1",
-        shell=True, stdout=subprocess.PIPE)
-    p1_info = p1_pobj.communicate()[0].split()
-
-    if p1_info[1] != '*':
-        p1_start_sec = p1_info[1]
-    else:
-        p1_start_sec = p1_info[2]
-
-    # This string will passed to fdisk, and this will change the partition's
-    # last sector number to maximum.
-    fdisk_string = "p\nd\np\nn\np\n1\n" + p1_start_sec + "\n\np\na\n1\np\nw\n"
-
-    c1 = subprocess.Popen(['echo', '-e', fdisk_string], stdout=subprocess.PIPE)
-    c2 = subprocess.Popen(
-        ['fdisk', '-u', loopdev], stdin=c1.stdout,
-        stdout=open(os.devnull, 'wb'),
-        stderr=subprocess.STDOUT)
-    c1.wait()
-    c2.wait()
+    p1_start_sec, p1_end_sec = parttable.grow_partition(vmsysfile)
 except Exception:
-    sys.exit(1)
-finally:
-    # Detach vmsysfile with the loop device.
-    time.sleep(1)
-    unfile_to_loop(loopdev)
+    logger.error(
+        "Failed to change partition table of " + vmsysfile
+        + ". " + str(sys.exc_info()[1]))
+    cleanfailedcreate()
+else:
+    eventlog.end('partition')
+    logger.debug(
+        "Suceeded to grow partition 1 to sectors {0}-{1}.".format(
+            p1_start_sec, p1_end_sec))
+
+# Loop devices and mounts are throttled by '--loopjobs'.
+loopslot = slots.Slots('loop', args.loopjobs)
+loopslot.acquire()
 
 #####################################
 #       Reisze file system          #
@@ -575,6 +778,7 @@ finally:
 
 # Reassociate vmsysfile to a loop device and create device maps,
 # then use resize2fs to grow file system.
+eventlog.begin('resize2fs')
 try:
     loopdev = file_to_loop_kpartx(vmsysfile)
     loopmap = "/dev/mapper/" + loopdev.split('/')[-1] + "p1"
@@ -598,12 +802,14 @@ except Exception:
 finally:
     # Delete device maps and detach vmsysfile with loop device.
     unfile_to_loop_kpartx(loopdev)
+eventlog.end('resize2fs')
 
 #####################################
 #    Manipulate file's content      #
 #####################################
 
 # Mount sys disk to a temporary directory.
+eventlog.begin('mount')
 try:
     logger.debug("Mount sys disk to a temporary directory.")
 
@@ -617,7 +823,10 @@ except Exception:
     unfile_to_loop_kpartx(loopdev)
     sys.exit(1)
 
+eventlog.end('mount')
+
 # Change file's content
+eventlog.begin('inject')
 try:
     fstab_file = mountpoint + "/etc/fstab"
     if args.vmswapsize > 0:
@@ -655,6 +864,8 @@ try:
             "BOOTPROTO=static\nIPADDR={1}\nNETMASK={2}\n")
         with open(if_file, 'w') as f:
             f.write(if_file_content.format(if_name, if_ip, if_mask))
+            f.write(netif.ethtool_opts(
+                if_name, vmnetopts[index], vmcpunumber_max))
 
     network_file = mountpoint + "/etc/sysconfig/network"
     network_file_content = ("NETWORKING=yes\nHOSTNAME={0}\nNOZEROCONF=yes\n")
@@ -689,16 +900,24 @@ try:
         with open(rclocal_file, 'a') as f:
             f.write("restorecon -R /root/.ssh\n")
 
+    eventlog.end('inject')
 
 finally:
     logger.debug("Umount the temporary directory.")
+    eventlog.begin('umount')
     subprocess.call(['umount', mountpoint])
     unfile_to_loop_kpartx(loopdev)
+    eventlog.end('umount')
+    loopslot.release()
 
 # Start VM
 logger.debug("Start VM.")
-subprocess.call(['virsh', 'define', vmxmlfile])
-subprocess.call(['virsh', 'start', args.vmname])
+eventlog.begin('define')
+returncode = subprocess.call(['virsh', 'define', vmxmlfile])
+eventlog.end('define', 'ok' if returncode == 0 else 'failed')
+eventlog.begin('start')
+returncode = subprocess.call(['virsh', 'start', args.vmname])
+eventlog.end('start', 'ok' if returncode == 0 else 'failed')
 
 
 # Print summary description of this vm.
@@ -740,3 +959,6 @@ all_vars.update(vars())
 
 logger.debug("VM's summary information.")
 logger.debug(end_desc_str(all_vars))
+
+logger.debug("Slowest stages.\n" + eventlog.summary_str())
+eventlog.close()
@@ -1,9 +1,18 @@
 #!/bin/env python
 
 import sys
+from vmdeploy import client
+
+# Hand the deploy to the deploy daemon (python -m vmdeploy.daemon) when it
+# is running, it has the modules and the configuration loaded already.
+returncode = client.forward(__file__, sys.argv[1:])
+if returncode is not None:
+    sys.exit(returncode)
+
 import os
 import os.path
 import time
+import atexit
 import argparse
 import uuid
 import random
@@ -11,10 +20,29 @@ import datetime
 import shutil
 import logging
 import subprocess
-import ConfigParser
 import tempfile
 import netaddr
 from lxml import etree
+from vmdeploy import batch
+from vmdeploy import conf
+from vmdeploy import datadisk
+from vmdeploy import diskprofile
+from vmdeploy import events
+from vmdeploy import ipam
+from vmdeploy import membacking
+from vmdeploy import loopdev
+from vmdeploy import netif
+from vmdeploy import nocloud
+from vmdeploy import parttable
+from vmdeploy import plan
+from vmdeploy import provision
+from vmdeploy import rawdisk
+from vmdeploy import slots
+from vmdeploy import sparsecopy
+from vmdeploy import stages
+from vmdeploy import tmplcache
+from vmdeploy import topology
+from vmdeploy import warmpool
 
 # Parse command options.
 
@@ -45,8 +73,24 @@ def check_empty(value):
     return svalue
 
 
+def check_vmnet(value):
+    try:
+        netif.split(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
+def check_diskprofile(value):
+    try:
+        diskprofile.parse_spec(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
 # Factory function to make parser.
-def make_parser():
+def make_parser(batchmode=False):
     parser = argparse.ArgumentParser(
         description='Create a virtual machine',
         epilog='Author: xiaopan.h@gmail.com',
@@ -59,7 +103,7 @@ def make_parser():
         dest='conf_file', required=True)
     base_group.add_argument(
         '--name', help="vm's name.", dest='vmname',
-        metavar='vmname', required=True)
+        metavar='vmname', required=not batchmode)
     base_group.add_argument(
         '--tmpl', help='the template used to create the vm',
         dest='vmtmpl', metavar='vmtmpl')
@@ -79,6 +123,18 @@ def make_parser():
         "Must be positive. (Default: %(default)s)",
         dest='vmmemsize', metavar='vmmemsize',
         default=1, type=check_negative)
+    cap_group.add_argument(
+        '--numa', help="'auto' pins the vcpus to the cpus of the least "
+        "loaded numa node of the host (or the fewest nodes) and binds the "
+        "memory to them, 'off' lets them float. (Default: %(default)s)",
+        dest='vmnuma', metavar='vmnuma', default='off',
+        choices=['off', 'auto'])
+    cap_group.add_argument(
+        '--hugepages', help="back the memory by hugepages of this size, "
+        "which must be free on the host (or on the numa nodes of the vm "
+        "with '--numa auto'). (Default: %(default)s)",
+        dest='vmhugepages', metavar='vmhugepages', default='off',
+        choices=['off'] + sorted(membacking.PAGE_SIZES))
 
     # Options about VM's disks.
     disk_group = parser.add_argument_group(
@@ -97,6 +153,35 @@ def make_parser():
         '--data', help="vm's data disk size. Unit: GB "
         "Must be multiple of 10.", dest='vmdatasize',
         metavar='vmdatasize', type=check_time10)
+    disk_group.add_argument(
+        '--datafs', help="file system of the data disk. 'xfs' clones an "
+        "empty xfs image made once per size, so the guest mounts it at "
+        "boot without formatting it. 'none' creates a blank disk. "
+        "(Default: %(default)s)", dest='vmdatafs', metavar='vmdatafs',
+        default='xfs', choices=['xfs', 'none'])
+    disk_group.add_argument(
+        '--diskprofile', help="i/o profiles of the disks, like "
+        "'sys=database,data=database' or one profile for all the disks. "
+        "Profiles: default (chosen by libvirt), balanced (cache=none, "
+        "io=native, discard, own iothread), database (balanced with "
+        "detect_zeroes=off), uring (balanced with io=io_uring), swap "
+        "(cache=unsafe). (Default: default)", dest='vmdiskprofile',
+        metavar='vmdiskprofile', type=check_diskprofile)
+    disk_group.add_argument(
+        '--provision', help="how the sys disk is made from the "
+        "template. 'reflink' clones the template when 'vmdeploypath' "
+        "supports it (xfs with reflink, btrfs), 'qcow2' creates a qcow2 "
+        "overlay backed by the template, 'copy' makes a sparse copy "
+        "and 'auto' tries them in this order. reflink falls back to "
+        "copy. (Default: %(default)s)", dest='vmprovision',
+        metavar='vmprovision', default='reflink',
+        choices=provision.MODES)
+    disk_group.add_argument(
+        '--allocation', help="allocation of the swap and data disks and "
+        "of the grown part of the sys disk. 'off' makes them sparse, "
+        "'falloc' reserves their blocks on the host. "
+        "(Default: %(default)s)", dest='vmallocation',
+        metavar='vmallocation', default='off', choices=rawdisk.ALLOCATIONS)
 
     # Options about VM's network
     net_group = parser.add_argument_group(
@@ -107,9 +192,14 @@ def make_parser():
         "as 'br0/172.30.0.3/255.255.255.0' or "
         "'virbr0/192.168.44.3/24'. You can use 'br1//' if "
         "you want to create an interface but do NOT want "
-        "specify ip address. Each 'vmnet' becomes vm's "
-        "network interface, like eth[0,1,2..]",
-        dest='vmnet', metavar='vmnet', nargs='+', required=True)
+        "specify ip address, or 'br0/auto' to take the next free "
+        "address of the ip pool of the bridge (see '--ippool'). "
+        "Each 'vmnet' becomes vm's "
+        "network interface, like eth[0,1,2..]. Options may follow, "
+        "separated by ':', as 'br0/172.30.0.3/24:vhost:queues=4:rx=1024' "
+        "or 'eth1/172.30.0.3/24:macvtap' (see vmdeploy/netif.py).",
+        dest='vmnet', metavar='vmnet', nargs='+', type=check_vmnet,
+        required=not batchmode)
     net_group.add_argument(
         '--gw', help="vm's gateway", dest='vmgateway',
         metavar='vmgateway')
@@ -118,6 +208,12 @@ def make_parser():
         "name servers separated by comma, "
         "like 8.8.8.8,114.114.114.114",
         dest='vmnameserver', metavar='vmnameserver')
+    net_group.add_argument(
+        '--ippool', help="ip pools of the bridges, separated by comma, "
+        "like 'virbr1/172.18.28.0/24,br0/10.0.0.0/16'. Addresses given by "
+        "'--net' are checked against the pool of their bridge, a pool is "
+        "learned from the first address of a bridge without pool.",
+        dest='ippool', metavar='ippool')
 
     # Other options.
     other_group = parser.add_argument_group('Others')
@@ -148,6 +244,13 @@ def make_parser():
         "'--mem'.",
         dest='vmmemresv', action='store_true',
         default=False)
+    other_group.add_argument(
+        '--mrsvmode', help="how '--mrsv' reserves the memory: 'balloon' "
+        "allocates twice the memory and balloons it down, 'dimm' allocates "
+        "the memory and makes room for dimms of up to twice the memory to "
+        "be plugged online. (Default: %(default)s)",
+        dest='vmmemresvmode', metavar='vmmemresvmode', default='balloon',
+        choices=membacking.RESERVE_MODES)
     other_group.add_argument(
         '--pubkey', help="ssh public key files. It "
         "accepts multiple files separated by comma. "
@@ -157,49 +260,66 @@ def make_parser():
         "Those public key files's content will be added "
         "to vm's /root/.ssh/authorized_keys.",
         dest='pubkey', metavar='pubkeyfile')
+    other_group.add_argument(
+        '--tmplcachesize', help="disk budget of uncompressed "
+        "templates in 'vmtmplpath'. Unit: GB. Least recently used "
+        "templates that have a '.raw.tar.gz' archive are removed "
+        "when exceeded. No limit if unspecified.",
+        dest='tmplcachesize', metavar='tmplcachesize',
+        type=check_negative)
+    other_group.add_argument(
+        '--inject', help="how the vm's settings (network, hostname, "
+        "fstab, ssh public keys) get into the guest. 'mount' mounts "
+        "the sys disk and changes its files, 'nocloud' writes a "
+        "cloud-init NoCloud seed image attached as cdrom and never "
+        "mounts the sys disk, the template must have cloud-init "
+        "installed. (Default: %(default)s)",
+        dest='vminject', metavar='vminject', default='mount',
+        choices=['mount', 'nocloud'])
+    other_group.add_argument(
+        '--warmpool', help="pools of ready made sys disks, separated "
+        "by comma, like 'centos-7.2-x64/20:4'. A vm with the template and "
+        "sys disk size of a pool takes its sys disk from the pool "
+        "instead of copying the template, then the pool is filled up "
+        "again in the background. The format of each pool is "
+        "'<tmpl>/<size>:<count>'.",
+        dest='warmpool', metavar='warmpool')
+
+    # Options about batch deploy.
+    batch_group = parser.add_argument_group('Batch')
+    batch_group.add_argument(
+        '--manifest', help="deploy every vm listed in the manifest "
+        "file instead of a single vm. The manifest is an ini file, "
+        "each section is a vm named after the section, its options "
+        "have the same names as the configuration file.",
+        dest='manifest', metavar='manifest')
+    batch_group.add_argument(
+        '--plan', help="check the vm, or every vm of the manifest, "
+        "without deploying it: names, addresses, bridges, templates, "
+        "sizes, and the disk and memory of all the vms against this "
+        "host.", dest='plan', action='store_true', default=False)
+    batch_group.add_argument(
+        '--jobs', help="number of vms deployed at the same time in "
+        "batch mode. Must be positive. (Default: %(default)s)",
+        dest='batchjobs', metavar='jobs', default=4,
+        type=check_negative)
+    batch_group.add_argument(
+        '--iojobs', help="max number of deploys copying or creating "
+        "disk images at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='iojobs', metavar='iojobs', type=check_negative)
+    batch_group.add_argument(
+        '--loopjobs', help="max number of deploys using loop devices "
+        "and mounts at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='loopjobs', metavar='loopjobs', type=check_negative)
 
     return parser
 
 
-# Print help messages.
-make_parser().parse_args()
-if len(sys.argv) == 1:
-    make_parser().print_help()
-    sys.exit(1)
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--conf', help='specify the configuartion file',
-                    dest='conf_file', required=True)
-
-# By default, the argument strings are taken from sys.argv.
-# Until now, only one argument '--conf' are added to parser, so
-# parse_known_args() just return the populated namespace (args) and
-# the list of remaining argument.
-args, remaining_argv = parser.parse_known_args()
-# 'args' only contain 'conf_file'
-
-
-# Get complete parser from factory function.
-parser = make_parser()
-
-# Use options read from conf_file to set default values to parser.
-if args.conf_file:
-    config = ConfigParser.ConfigParser()
-    config.read([args.conf_file])
-
-    # Function items() return a list of (name, value) pairs for each option
-    # in the given section of the configuration file.
-    options_default = dict(config.items('DEFAULT'))
-
-    # Translate 'vmnet' from string (separated by comma) to list.
-    if 'vmnet' in options_default:
-        options_default['vmnet'] = options_default['vmnet'].split(',')
-
-    parser.set_defaults(**options_default)
-
-# Parse command line arguments.
-args = parser.parse_args()
+# Parse command line arguments, options of the configuration file are
+# their defaults.
+args = conf.parse_args(make_parser)
 
 base_dir = os.path.dirname(__file__)
 
@@ -218,10 +338,22 @@ if os.path.isabs(args.vmcreatelogdir):
 else:
     vmcreatelogdir = os.path.join(base_dir, args.vmcreatelogdir)
 
+# Plan mode: check the vm, or every vm of the manifest, and exit without
+# deploying.
+if args.plan:
+    sys.exit(plan.run(make_parser, args, vmdeploypath, vmtmplpath))
+
+# Batch mode: deploy every vm of the manifest by a child process of this
+# script, and exit with the number of failed vms.
+if args.manifest:
+    sys.exit(batch.run(__file__, make_parser(True), args, vmcreatelogdir))
+
 if args.vmswapsize is None:
     args.vmswapsize = args.vmmemsize
 
-if args.vmmemresv is False:
+# With dimm hotplug the domain has the memory of the vm, the room to grow
+# it is <maxMemory>.
+if args.vmmemresv is False or args.vmmemresvmode == 'dimm':
     vmmemsize_max = args.vmmemsize
 else:
     vmmemsize_max = args.vmmemsize * 2
@@ -231,6 +363,9 @@ if args.vmcpuresv is False:
 else:
     vmcpunumber_max = args.vmcpunumber * 2
 
+# Take the options off the 'vmnet' items, like ':vhost:queues=4'.
+args.vmnet, vmnetopts = netif.split_vmnet(args.vmnet)
+
 
 vmuuid = str(uuid.uuid4())
 
@@ -242,6 +377,14 @@ vmxmlfile = os.path.join(vmdir, args.vmname + '.xml')
 vmsysfile = os.path.join(vmdir, args.vmname + '.sys')
 vmswapfile = os.path.join(vmdir, args.vmname + '.swap')
 vmdatafile = os.path.join(vmdir, args.vmname + '.data')
+vmseedfile = os.path.join(vmdir, args.vmname + '.seed.iso')
+
+# The NoCloud seed matches interfaces by mac address, so they are fixed
+# in the xml instead of being chosen by libvirt.
+if args.vminject == 'nocloud':
+    vmmacs = [nocloud.random_mac() for netitem in args.vmnet]
+else:
+    vmmacs = [None for netitem in args.vmnet]
 
 # Generate six-bits random number.
 taskid = str(random.random()).split('.')[1][0:6]
@@ -272,31 +415,47 @@ consolehandler = logging.StreamHandler()
 consolehandler.setFormatter(logformatter)
 logger.addHandler(consolehandler)
 
-# Check whether template file exist.
-if not os.path.isfile(vmtmplfile):
-    logger.warn("Try to find compressed file of {0}.".format(vmtmplfile))
-    comp_vmtmplfile = vmtmplfile + ".tar.gz"
-    if not os.path.isfile(comp_vmtmplfile):
-        logger.error(vmtmplfile + " is not a valid template file.")
-        sys.exit(1)
-    else:
-        try:
-            subprocess.call(
-                ['tar', '-Sxzf', comp_vmtmplfile, '-C',
-                    os.path.dirname(comp_vmtmplfile)],
-                stdout=open(os.devnull, 'wb'))
-        except Exception:
-            logger.error(
-                "Failed to uncompress " + comp_vmtmplfile
-                + ". " + str(sys.exc_info()[1]))
-            sys.exit(1)
-        else:
-            logger.debug("Succeeded to uncompress " + comp_vmtmplfile + ".")
+# Time every stage of the deploy in the event log of the host. A deploy
+# which exits in the middle of a stage logs it as failed.
+eventlog = events.EventLog(
+    os.path.join(vmcreatelogdir, 'events.jsonl'), taskid, args.vmname)
+eventlog.emit('deploy', status='start', vmtmpl=args.vmtmpl)
+atexit.register(eventlog.close)
+
+# Get the template from the template cache. '<vmtmpl>.raw' is uncompressed
+# from '<vmtmpl>.raw.tar.gz' when it does not exist, other deploys of the
+# same template wait for it instead of uncompressing it again.
+templates = tmplcache.TemplateCache(vmtmplpath, args.tmplcachesize)
+eventlog.begin('template')
+try:
+    vmtmplfile = templates.acquire(args.vmtmpl)
+except Exception:
+    logger.error(
+        "Failed to get template " + args.vmtmpl
+        + ". " + str(sys.exc_info()[1]))
+    sys.exit(1)
+else:
+    eventlog.end('template', extracted=args.vmtmpl in templates.extracted)
+    logger.debug("Succeeded to get template file " + vmtmplfile + ".")
 
 
 # Helper function to clean vm directory when error occured.
 def cleanfailedcreate():
     logger.debug("Cleaning failed create.")
+    if vmipam is not None:
+        try:
+            with vmipam.locked():
+                vmipam.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release ip addresses. "
+                        + str(sys.exc_info()[1]))
+    if vmpinning is not None:
+        try:
+            with vmpinning.locked():
+                vmpinning.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release numa pinning. "
+                        + str(sys.exc_info()[1]))
     shutil.rmtree(vmdir)
     sys.exit(1)
 
@@ -306,130 +465,259 @@ def cleanfailedcreate():
 ##############################
 
 # Exit when can't create vm directory, reason as: vmname already exist.
+eventlog.begin('mkdir')
 try:
     os.mkdir(vmdir)
 except Exception:
     logger.error("Failed to create vm directory. " + str(sys.exc_info()[1]))
     sys.exit(1)
 else:
+    eventlog.end('mkdir')
     logger.debug("Suceeded to create vm directory.")
 
+# Take the '<bridge>/auto' addresses from the ip pools of the bridges and
+# check the given ones against them, under the lock of the pools.
+vmipam = None
+vmpinning = None
+eventlog.begin('ipam')
+try:
+    ippools = ipam.IPAM(vmdeploypath, ipam.parse_pools(args.ippool))
+    with ippools.locked():
+        args.vmnet = ippools.allocate(
+            args.vmname, args.vmnet, args.vmgateway,
+            args.vmnameserver.split(',') if args.vmnameserver else [])
+    vmipam = ippools
+    ipam.write_ifcfg(vmdir, args.vmnet)
+except Exception:
+    logger.error("Failed to allocate ip addresses. " + str(sys.exc_info()[1]))
+    cleanfailedcreate()
+else:
+    eventlog.end('ipam')
+    logger.debug("Suceeded to allocate ip addresses: "
+                 + ", ".join(args.vmnet) + ".")
+
+# Pin the vcpus and bind the memory to the least loaded numa nodes, under
+# the lock of the pinning state.
+vmplacement = None
+if args.vmnuma == 'auto':
+    eventlog.begin('numa')
+    try:
+        pinning = topology.Pinning(vmdeploypath)
+        with pinning.locked():
+            vmplacement = pinning.place(
+                args.vmname, vmcpunumber_max, vmmemsize_max * 1024 ** 3,
+                membacking.PAGE_SIZES.get(args.vmhugepages, 1024) * 1024)
+        vmpinning = pinning
+    except Exception:
+        logger.error("Failed to pin the vm to numa nodes. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+    else:
+        eventlog.end('numa', nodes=vmplacement['nodes'])
+        logger.debug("Suceeded to pin the vm to numa nodes: " + ",".join(
+            str(node) for node in vmplacement['nodes']) + ".")
+
+# Check the free hugepages of the host, or of the numa nodes of the vm.
+if args.vmhugepages != 'off':
+    try:
+        membacking.check_hugepages(
+            args.vmhugepages, vmmemsize_max * 1024 ** 3, vmplacement)
+    except membacking.MemoryBackingError:
+        logger.error("Failed to back the memory by hugepages. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+
+# Take a ready made sys disk (copied, resized, partition and file system
+# grown) from the warm pool of the template and size, if there is one.
+# The pool is filled up again in the background either way.
+vmsyspooled = False
+try:
+    warmpools = warmpool.parse_spec(args.warmpool)
+except ValueError:
+    logger.error(str(sys.exc_info()[1]))
+    cleanfailedcreate()
+poolkey = (args.vmtmpl, args.vmsyssize)
+if poolkey in warmpools and args.vmprovision != 'qcow2':
+    pool = warmpool.WarmPool(vmdeploypath, args.vmtmpl, args.vmsyssize)
+    eventlog.begin('warmpool')
+    try:
+        vmsyspooled = pool.claim(vmsysfile, vmtmplfile)
+    except Exception:
+        logger.warn("Failed to claim a disk from " + pool.pooldir + ". "
+                    + str(sys.exc_info()[1]))
+    eventlog.end('warmpool', claimed=vmsyspooled)
+    if vmsyspooled:
+        vmsysformat = 'raw'
+        templates.release(args.vmtmpl)
+        logger.debug("Suceeded to take sys disk from " + pool.pooldir + ".")
+    try:
+        warmpool.replenish(
+            vmdeploypath, vmtmplpath, args.vmtmpl, args.vmsyssize,
+            warmpools[poolkey],
+            os.path.join(vmcreatelogdir, 'warmpool_' + args.vmtmpl + '-'
+                         + str(args.vmsyssize) + 'G.out'),
+            args.tmplcachesize, args.iojobs, args.loopjobs,
+            args.vmallocation)
+    except Exception:
+        logger.warn("Failed to start the replenisher of " + pool.pooldir
+                    + ". " + str(sys.exc_info()[1]))
+
 
 ##############################
 #      Create XML file       #
 ##############################
 
-# All xml element variable name start with 'x_' to avoid name conflict.
-x_domain = etree.Element('domain', type='kvm')
+# Helper function to define disk info to xml file.
 
-x_name = etree.SubElement(x_domain, 'name')
-x_name.text = args.vmname
 
-x_uuid = etree.SubElement(x_domain, 'uuid')
-x_uuid.text = vmuuid
+# 'disk_profiles' sets the i/o attributes of the disk 'disk_name' (sys, swap
+# or data).
+def defdiskxml(parent, disk_source, disk_device, disk_profiles, disk_name,
+               disk_format='raw'):
+    x_disk = etree.SubElement(parent, 'disk', type='file', device='disk')
+    x_driver = etree.SubElement(
+        x_disk, 'driver', name='qemu', type=disk_format)
+    disk_profiles.apply(x_driver, disk_name)
+    x_source = etree.SubElement(x_disk, 'source', file=disk_source)
+    x_target = etree.SubElement(
+        x_disk, 'target', dev=disk_device, bus='virtio')
+    return x_disk
 
-x_memory = etree.SubElement(x_domain, 'memory', unit='GiB')
-x_memory.text = str(vmmemsize_max)
 
-x_currentMemory = etree.SubElement(x_domain, 'currentMemory', unit='GiB')
-x_currentMemory.text = str(args.vmmemsize)
+# Helper function to define cdrom info to xml file.
+def defcdromxml(parent, cdrom_source, cdrom_device):
+    x_disk = etree.SubElement(parent, 'disk', type='file', device='cdrom')
+    x_driver = etree.SubElement(x_disk, 'driver', name='qemu', type='raw')
+    x_source = etree.SubElement(x_disk, 'source', file=cdrom_source)
+    x_target = etree.SubElement(x_disk, 'target', dev=cdrom_device, bus='ide')
+    x_readonly = etree.SubElement(x_disk, 'readonly')
+    return x_disk
 
-x_vcpu = etree.SubElement(x_domain, 'vcpu', current=str(args.vmcpunumber))
-x_vcpu.text = str(vmcpunumber_max)
 
-x_cpu = etree.SubElement(x_domain, 'cpu', mode='host-model')
-x_cpu_model = etree.SubElement(x_cpu, 'model', fallback='allow')
+# Helper function to define network interface info to xml file.
 
-x_os = etree.SubElement(x_domain, 'os')
-x_type = etree.SubElement(x_os, 'type', arch='x86_64')
-x_type.text = 'hvm'
-# 'hvm' means full virtualization
 
-x_boot = etree.SubElement(x_os, 'boot', dev='hd')
-etree.SubElement(x_os, 'boot', dev='network')
+def defnetxml(parent, net_source, net_options, net_mac=None):
+    x_interface = netif.interface_xml(
+        parent, net_source, net_options, vmcpunumber_max, net_mac)
 
-# Define hypervisor features.
-x_features = etree.SubElement(x_domain, 'features')
-x_acpi = etree.SubElement(x_features, 'acpi')
-x_apic = etree.SubElement(x_features, 'apic')
-x_pae = etree.SubElement(x_features, 'pae')
 
-# Define events configuration.
-x_on_poweroff = etree.SubElement(x_domain, 'on_poweroff')
-x_on_poweroff.text = 'destroy'
 
-x_on_reboot = etree.SubElement(x_domain, 'on_reboot')
-x_on_reboot.text = 'restart'
+# Render the xml of the guest domain, return the domain element and the
+# disk element of the sys disk.
+def render_xml():
+    # All xml element variable name start with 'x_' to avoid name conflict.
+    x_domain = etree.Element('domain', type='kvm')
 
-x_on_crash = etree.SubElement(x_domain, 'on_crash')
-x_on_crash.text = 'restart'
+    x_name = etree.SubElement(x_domain, 'name')
+    x_name.text = args.vmname
 
-# Define time keeping.
-x_clock = etree.SubElement(x_domain, 'clock', offset='localtime')
-# localtime: guest clock will be synchronized to the host's configured
-# timezone when booted.
+    x_uuid = etree.SubElement(x_domain, 'uuid')
+    x_uuid.text = vmuuid
 
-# Define devices provided to the guest domain.
-x_devices = etree.SubElement(x_domain, 'devices')
+    x_memory = etree.SubElement(x_domain, 'memory', unit='GiB')
+    x_memory.text = str(vmmemsize_max)
 
-x_emulator = etree.SubElement(x_devices, 'emulator')
-x_emulator.text = '/usr/libexec/qemu-kvm'
+    x_currentMemory = etree.SubElement(x_domain, 'currentMemory', unit='GiB')
+    x_currentMemory.text = str(args.vmmemsize)
 
-# Helper function to define disk info to xml file.
+    x_vcpu = etree.SubElement(x_domain, 'vcpu', current=str(args.vmcpunumber))
+    x_vcpu.text = str(vmcpunumber_max)
 
+    x_cpu = etree.SubElement(x_domain, 'cpu', mode='host-model')
+    x_cpu_model = etree.SubElement(x_cpu, 'model', fallback='allow')
 
-def defdiskxml(parent, disk_source, disk_device):
-    x_disk = etree.SubElement(parent, 'disk', type='file', device='disk')
-    x_source = etree.SubElement(x_disk, 'source', file=disk_source)
-    x_target = etree.SubElement(
-        x_disk, 'target', dev=disk_device, bus='virtio')
+    x_os = etree.SubElement(x_domain, 'os')
+    x_type = etree.SubElement(x_os, 'type', arch='x86_64')
+    x_type.text = 'hvm'
+    # 'hvm' means full virtualization
 
+    x_boot = etree.SubElement(x_os, 'boot', dev='hd')
+    etree.SubElement(x_os, 'boot', dev='network')
 
-# Define disk info to xml file.
-defdiskxml(x_devices, vmsysfile, 'vda')
-defdiskxml(x_devices, vmswapfile, 'vdb')
-if args.vmdatasize > 0:
-    defdiskxml(x_devices, vmdatafile, 'vdc')
+    # Define hypervisor features.
+    x_features = etree.SubElement(x_domain, 'features')
+    x_acpi = etree.SubElement(x_features, 'acpi')
+    x_apic = etree.SubElement(x_features, 'apic')
+    x_pae = etree.SubElement(x_features, 'pae')
 
-# Helper function to define network interface info to xml file.
+    # Define events configuration.
+    x_on_poweroff = etree.SubElement(x_domain, 'on_poweroff')
+    x_on_poweroff.text = 'destroy'
 
+    x_on_reboot = etree.SubElement(x_domain, 'on_reboot')
+    x_on_reboot.text = 'restart'
 
-def defnetxml(parent, net_source):
-    x_interface = etree.SubElement(parent, 'interface', type='bridge')
-    x_source = etree.SubElement(x_interface, 'source', bridge=net_source)
-    x_model = etree.SubElement(x_interface, 'model', type='virtio')
+    x_on_crash = etree.SubElement(x_domain, 'on_crash')
+    x_on_crash.text = 'restart'
 
+    # Define time keeping.
+    x_clock = etree.SubElement(x_domain, 'clock', offset='localtime')
+    # localtime: guest clock will be synchronized to the host's configured
+    # timezone when booted.
 
-# Define network info to xml file.
-# vmnet = ['br0/172.30.0.3/255.255.255.0', 'virbr0/192.168.44.3/24']
-for netitem in args.vmnet:
-    br_if = netitem.split('/')[0]
-    defnetxml(x_devices, br_if)
+    # Define devices provided to the guest domain.
+    x_devices = etree.SubElement(x_domain, 'devices')
 
-# Define other devices.
-x_serial = etree.SubElement(x_devices, 'serial', type='pty')
-x_console = etree.SubElement(x_devices, 'console', type='pty')
+    x_emulator = etree.SubElement(x_devices, 'emulator')
+    x_emulator.text = '/usr/libexec/qemu-kvm'
 
-if args.vncpass:
-    x_graphics = etree.SubElement(
-        x_devices, 'graphics', type='vnc',
-        autoport='yes', passwd=args.vncpass)
-else:
-    x_graphics = etree.SubElement(
-        x_devices, 'graphics', type='vnc',
-        autoport='yes')
+    # Define disk info to xml file.
+    # The format of the sys disk is set once it is provisioned.
+    disk_profiles = diskprofile.DiskProfiles(args.vmdiskprofile)
+    x_sysdisk = defdiskxml(x_devices, vmsysfile, 'vda', disk_profiles, 'sys')
+    defdiskxml(x_devices, vmswapfile, 'vdb', disk_profiles, 'swap')
+    if args.vmdatasize > 0:
+        defdiskxml(x_devices, vmdatafile, 'vdc', disk_profiles, 'data')
+    x_iothreads = disk_profiles.add_iothreads(x_vcpu)
+    if vmplacement is not None:
+        topology.placement_xml(
+            x_vcpu if x_iothreads is None else x_iothreads, x_cpu,
+            vmplacement, vmpinning.topology, disk_profiles.iothreads)
+    if args.vmhugepages != 'off':
+        membacking.hugepages_xml(x_currentMemory, args.vmhugepages)
+    if args.vmmemresv and args.vmmemresvmode == 'dimm':
+        membacking.hotplug_xml(x_memory, x_cpu, args.vmmemsize * 2,
+                               vmcpunumber_max, args.vmmemsize)
+    if args.vminject == 'nocloud':
+        defcdromxml(x_devices, vmseedfile, 'hdc')
+
+    # Define network info to xml file.
+    # vmnet = ['br0/172.30.0.3/255.255.255.0', 'virbr0/192.168.44.3/24']
+    for index, netitem in enumerate(args.vmnet):
+        br_if = netitem.split('/')[0]
+        defnetxml(x_devices, br_if, vmnetopts[index], vmmacs[index])
 
-x_listen = etree.SubElement(
-    x_graphics, 'listen',
-    type='address', address='0.0.0.0')
+    # Define other devices.
+    x_serial = etree.SubElement(x_devices, 'serial', type='pty')
+    x_console = etree.SubElement(x_devices, 'console', type='pty')
 
+    if args.vncpass:
+        x_graphics = etree.SubElement(
+            x_devices, 'graphics', type='vnc',
+            autoport='yes', passwd=args.vncpass)
+    else:
+        x_graphics = etree.SubElement(
+            x_devices, 'graphics', type='vnc',
+            autoport='yes')
 
-# Write the xml infomation to file.
-f = open(vmxmlfile, 'w')
-f.write(etree.tostring(x_domain, pretty_print=True))
-f.close()
+    x_listen = etree.SubElement(
+        x_graphics, 'listen',
+        type='address', address='0.0.0.0')
 
-logger.debug("Suceeded to generate the xml file for guest domain.")
+    logger.debug("Suceeded to render the xml for guest domain.")
+    return x_domain, x_sysdisk
+
+
+# Write the xml infomation to file, once the format of the sys disk is known.
+def write_xml():
+    x_domain, x_sysdisk = pipeline.result('xml')
+    x_sysdisk.find('driver').set('type', vmsysformat)
+    f = open(vmxmlfile, 'w')
+    f.write(etree.tostring(x_domain, pretty_print=True))
+    f.close()
+
+    logger.debug("Suceeded to generate the xml file for guest domain.")
 
 
 ##############################
@@ -437,182 +725,125 @@ logger.debug("Suceeded to generate the xml file for guest domain.")
 ##############################
 
 # Prepare the sys disk.
-# Copy from template file.
-try:
-    subprocess.call(['cp', '--sparse=always', vmtmplfile, vmsysfile],
-                    stdout=open(os.devnull, 'wb'))
-except Exception:
-    logger.error(
-        "Failed to copy from " + vmtmplfile + " to " + vmsysfile
-        + ". " + str(sys.exc_info()[1]))
-    cleanfailedcreate()
-else:
-    logger.debug("Suceeded to copy from " + vmtmplfile + " to " + vmsysfile)
-
-# Resize the sys disk.
-try:
-    subprocess.call(
-        ['qemu-img', 'resize', vmsysfile,
-            str(args.vmsyssize) + "G"],
-        stdout=open(os.devnull, 'wb'))
-except Exception:
-    logger.error(
-        "Failed to resize: " + vmsysfile
-        + ". " + str(sys.exc_info()[1]))
-    cleanfailedcreate()
-else:
-    logger.debug("Suceed to resize: " + vmsysfile)
+def prepare_sysdisk():
+    global vmsysformat
+
+    # Copying disk images is throttled by '--iojobs'.
+    with slots.Slots('diskio', args.iojobs):
+        # Clone, overlay or copy from template file according to
+        # '--provision'.
+        eventlog.begin('copy')
+        try:
+            vmsysmethod, vmsysformat = provision.provision_sysdisk(
+                args.vmprovision, vmtmplfile, vmsysfile, args.vmsyssize,
+                progress=sparsecopy.progress_logger(logger))
+        except Exception:
+            eventlog.end('copy', 'failed')
+            raise IOError(
+                "Failed to provision from " + vmtmplfile + " to "
+                + vmsysfile + ". " + str(sys.exc_info()[1]))
+        eventlog.end('copy', method=vmsysmethod)
+        logger.debug(
+            "Suceeded to provision from " + vmtmplfile + " to " + vmsysfile
+            + " by " + vmsysmethod + ".")
+
+    # The template may be evicted from the cache once it is copied, unless
+    # it is the backing file of the qcow2 overlay.
+    if vmsysformat == 'qcow2':
+        templates.pin(args.vmtmpl)
+    templates.release(args.vmtmpl)
+
+    # Resize the sys disk, qcow2 overlay is created with its final size.
+    if vmsysformat == 'raw':
+        with eventlog.stage('resize'):
+            try:
+                rawdisk.resize(vmsysfile, args.vmsyssize * rawdisk.GIB,
+                               args.vmallocation)
+            except (IOError, OSError):
+                raise IOError("Failed to resize: " + vmsysfile + ". "
+                              + str(sys.exc_info()[1]))
+        logger.debug("Suceed to resize: " + vmsysfile)
 
 
 # Prepare the swap disk.
-try:
-    subprocess.call(
-        ['qemu-img', 'create', '-f',
-            'raw', vmswapfile, str(args.vmswapsize) + "G"],
-        stdout=open(os.devnull, 'wb'))
-except Exception:
-    logger.error(
-        "Failed to create swap disk: " + vmswapfile
-        + ". " + str(sys.exc_info()[1]))
-    cleanfailedcreate()
-else:
+def prepare_swapdisk():
+    try:
+        rawdisk.create(vmswapfile, args.vmswapsize * rawdisk.GIB,
+                       args.vmallocation)
+    except (IOError, OSError):
+        raise IOError("Failed to create swap disk: " + vmswapfile + ". "
+                      + str(sys.exc_info()[1]))
     logger.debug("Suceeded to create swap disk: " + vmswapfile)
 
-try:
-    subprocess.call(['mkswap', '-f', vmswapfile],
-                    stdout=open(os.devnull, 'wb'))
-except Exception:
-    logger.error(
-        "Failed to mkswap: " + vmswapfile + ". " + str(sys.exc_info()[1]))
-    cleanfailedcreate()
-else:
+    try:
+        rawdisk.mkswap(vmswapfile)
+    except (IOError, OSError):
+        raise IOError("Failed to mkswap: " + vmswapfile + ". "
+                      + str(sys.exc_info()[1]))
     logger.debug("Suceeded to mkswap: " + vmswapfile)
 
 
 # Prepare the data disk.
-if args.vmdatasize > 0:
+def prepare_datadisk():
+    # Clone the formatted image of the size, or create a blank disk when
+    # it can not be made.
+    if args.vmdatafs == 'xfs':
+        try:
+            method = datadisk.DataDisks(vmdeploypath).clone(
+                args.vmdatasize, vmdatafile, args.vmallocation)
+        except Exception:
+            logger.warn("Failed to clone formatted data disk, create a "
+                        "blank one. " + str(sys.exc_info()[1]))
+        else:
+            logger.debug("Suceeded to clone formatted data disk: "
+                          + vmdatafile + " by " + method + ".")
+            return
     try:
-        subprocess.call(
-            ['qemu-img', 'create', '-f', 'raw', vmdatafile,
-                str(args.vmdatasize) + "G"],
-            stdout=open(os.devnull, 'wb'))
-    except Exception:
-        logger.error(
-            "Failed to create data disk: " + vmdatafile
-            + ". " + str(sys.exc_info()[1]))
-        cleanfailedcreate()
-    else:
-        logger.debug("Suceeded to create data disk: " + vmdatafile)
+        rawdisk.create(vmdatafile, args.vmdatasize * rawdisk.GIB,
+                       args.vmallocation)
+    except (IOError, OSError):
+        raise IOError("Failed to create data disk: " + vmdatafile + ". "
+                      + str(sys.exc_info()[1]))
+    logger.debug("Suceeded to create data disk: " + vmdatafile)
 
 
 #####################################
 #  Change sys disk Partition Table  #
 #####################################
 
-logger.debug("Begin to change sys disk partition table.")
-
-# Helper function to losetup a file to loop device.
-
-
-def file_to_loop(file):
-    pobj = subprocess.Popen(['losetup', '-f'], stdout=subprocess.PIPE)
-    loopdev = pobj.communicate()[0].strip()
-    subprocess.call(['losetup', loopdev, file])
-    return loopdev
-
-# Helper function to detach file with loop device
-
-
-def unfile_to_loop(loopdev):
-    subprocess.call(['losetup', '-d', loopdev],
-                    stdout=open(os.devnull, 'wb'))
-
-
-# Helper function to create device maps of an image file.
-def file_to_loop_kpartx(file):
-    loopdev = file_to_loop(file)
-    subprocess.call(['kpartx', '-avs', '-pp', loopdev],
-                    stdout=open(os.devnull, 'wb'))
-    return loopdev
-    # -a add partition devmappings
-    # -v verbose
-    # -s sync mode. Don't return until the partitions are created
-    # -p set device name-partition number delimiter
-
-# Helper function to delete device maps and detach file with loop device.
-
-
-def unfile_to_loop_kpartx(loopdev):
-    subprocess.call(['kpartx', '-dv', '-pp', loopdev],
-                    stdout=open(os.devnull, 'wb'))
-    unfile_to_loop(loopdev)
-
-
-# Associate vmsysfile to a loop device and use fdisk to change partition table.
-try:
-    loopdev = file_to_loop(vmsysfile)
-
-    # p1_start_sec is partition's first sector number.
-    p1_pobj = subprocess.Popen(
-        "fdisk -lu " + loopdev
-        + " | grep " + loopdev + "p1",
-        shell=True, stdout=subprocess.PIPE)
-    p1_info = p1_pobj.communicate()[0].split()
-
-    if p1_info[1] != '*':
-        p1_start_sec = p1_info[1]
-    else:
-        p1_start_sec = p1_info[2]
-
-    # This string will passed to fdisk, and this will change the partition's
-    # last sector number to maximum.
-    fdisk_string = "p\nd\np\nn\np\n1\n" + p1_start_sec + "\n\np\na\n1\np\nw\n"
-
-    c1 = subprocess.Popen(['echo', '-e', fdisk_string], stdout=subprocess.PIPE)
-    c2 = subprocess.Popen(
-        ['fdisk', '-u', loopdev], stdin=c1.stdout,
-        stdout=open(os.devnull, 'wb'),
-        stderr=subprocess.STDOUT)
-    c1.wait()
-    c2.wait()
-except Exception:
-    sys.exit(1)
-finally:
-    # Detach vmsysfile with the loop device.
-    time.sleep(1)
-    unfile_to_loop(loopdev)
+# Grow partition 1 to the end of the sys disk by changing its partition
+# table (MBR or GPT) in place. A qcow2 overlay is changed through its nbd
+# device, a raw disk directly in the image file.
+def grow_partition():
+    logger.debug("Begin to change sys disk partition table.")
+    nbddev = None
+    try:
+        if vmsysformat == 'qcow2':
+            nbddev = loopdev.file_to_loop(vmsysfile, vmsysformat)
+            p1_start_sec, p1_end_sec = parttable.grow_partition(nbddev)
+        else:
+            p1_start_sec, p1_end_sec = parttable.grow_partition(vmsysfile)
+    finally:
+        # Detach vmsysfile with the nbd device.
+        if nbddev:
+            loopdev.unfile_to_loop(nbddev)
+    logger.debug(
+        "Suceeded to grow partition 1 to sectors {0}-{1}.".format(
+            p1_start_sec, p1_end_sec))
 
 
 #####################################
 #    Manipulate file's content      #
 #####################################
 
-# Mount sys disk to a temporary directory.
-try:
-    logger.debug("Mount sys disk to a temporary directory.")
-
-    loopdev = file_to_loop_kpartx(vmsysfile)
-    time.sleep(2)
-    logger.debug(loopdev)
-    loopmap = "/dev/mapper/" + loopdev.split('/')[-1] + "p1"
-    logger.debug(loopmap)
-
-    mountpoint = tempfile.mkdtemp(dir='/tmp', prefix='kvm-mount-')
-    logger.debug(mountpoint)
-    subprocess.call(['mount', loopmap, mountpoint],
-                    stdout=open(os.devnull, 'wb'))
-    time.sleep(1)
-except Exception:
-    unfile_to_loop_kpartx(loopdev)
-    sys.exit(1)
-
-
-# Change file's content
-try:
-    logger.debug(mountpoint)
-    # resize file system
-    logger.debug("Resize xfs file system using xfs_growfs.")
-    subprocess.call(['xfs_growfs', mountpoint], stdout=open(os.devnull, 'wb'))
+# Grow the file system mounted at 'mountpoint' and change file's content.
+def change_files(mountpoint):
+    # resize file system, a disk of the warm pool is grown already.
+    if not vmsyspooled:
+        logger.debug("Resize xfs file system using xfs_growfs.")
+        with eventlog.stage('xfs_growfs'):
+            subprocess.call(
+                ['xfs_growfs', mountpoint], stdout=open(os.devnull, 'wb'))
 
     fstab_file = mountpoint + "/etc/fstab"
     if args.vmswapsize > 0:
@@ -659,6 +890,8 @@ try:
         with open(if_file, 'w') as f:
             f.write(if_file_content.format(
                 if_name, if_ip, if_prefixlen, ip_gateway))
+            f.write(netif.ethtool_opts(
+                if_name, vmnetopts[index], vmcpunumber_max))
 
     # hostname
     network_file = mountpoint + "/etc/hostname"
@@ -689,15 +922,92 @@ try:
             f.write("restorecon -R /root/.ssh\n")
 
 
-finally:
-    logger.debug("Umount the temporary directory.")
-    subprocess.call(['umount', mountpoint])
-    unfile_to_loop_kpartx(loopdev)
+# Mount the sys disk to a temporary directory and change it.
+def inject_sysdisk():
+    # Loop devices and mounts are throttled by '--loopjobs'.
+    with slots.Slots('loop', args.loopjobs):
+        logger.debug("Mount sys disk to a temporary directory.")
+
+        with loopdev.mount_partition(
+                vmsysfile, vmsysformat, eventlog=eventlog) as mountpoint:
+            change_files(mountpoint)
+
+
+# Write the cloud-init NoCloud seed of the vm, instead of mounting the sys
+# disk and changing its files.
+def make_seed():
+    pubkeys = []
+    if args.pubkey:
+        for keyfile in args.pubkey.split(','):
+            if not os.path.isabs(keyfile):
+                keyfile = os.path.join(base_dir, keyfile)
+            with open(keyfile, 'r') as f:
+                pubkeys.extend(
+                    l.strip() for l in f
+                    if l.strip() and not l.startswith('#'))
+
+    mounts = []
+    if args.vmswapsize > 0:
+        mounts.append(['/dev/vdb', 'none', 'swap', 'sw', '0', '0'])
+    if args.vmdatasize > 0:
+        mounts.append(['/dev/vdc', '/web', 'xfs', 'defaults', '0', '0'])
+
+    nameservers = None
+    if args.vmnameserver:
+        nameservers = args.vmnameserver.split(',')
+
+    nocloud.write_seed(
+        vmseedfile,
+        nocloud.render_meta_data(vmuuid, args.vmname),
+        nocloud.render_user_data(
+            args.vmname, pubkeys, mounts,
+            netif.ethtool_commands(vmnetopts, vmcpunumber_max)),
+        nocloud.render_network_config(
+            args.vmnet, vmmacs, args.vmgateway, nameservers))
+    logger.debug("Suceeded to write NoCloud seed: " + vmseedfile)
+
+
+##############################
+#   Run the deploy stages    #
+##############################
+
+# The sys disk copy is the long stage, the xml and the swap and data disks
+# are prepared meanwhile. Guest injection only waits for the sys disk, a
+# NoCloud seed does not wait for anything.
+# A sys disk of the warm pool is ready for injection.
+pipeline = stages.Pipeline(eventlog=eventlog)
+pipeline.add('xml', render_xml)
+if not vmsyspooled:
+    pipeline.add('sysdisk', prepare_sysdisk)
+pipeline.add('swapdisk', prepare_swapdisk)
+if args.vmdatasize > 0:
+    pipeline.add('datadisk', prepare_datadisk)
+if vmsyspooled:
+    pipeline.add('writexml', write_xml, deps=['xml'])
+else:
+    pipeline.add('writexml', write_xml, deps=['xml', 'sysdisk'])
+if args.vminject == 'nocloud':
+    pipeline.add('seed', make_seed)
+elif vmsyspooled:
+    pipeline.add('inject', inject_sysdisk)
+else:
+    pipeline.add('partition', grow_partition, deps=['sysdisk'])
+    pipeline.add('inject', inject_sysdisk, deps=['partition'])
+
+try:
+    pipeline.run()
+except stages.StageError:
+    logger.error(str(sys.exc_info()[1]))
+    cleanfailedcreate()
 
 # Start VM
 logger.debug("Start VM.")
-subprocess.call(['virsh', 'define', vmxmlfile])
-subprocess.call(['virsh', 'start', args.vmname])
+eventlog.begin('define')
+returncode = subprocess.call(['virsh', 'define', vmxmlfile])
+eventlog.end('define', 'ok' if returncode == 0 else 'failed')
+eventlog.begin('start')
+returncode = subprocess.call(['virsh', 'start', args.vmname])
+eventlog.end('start', 'ok' if returncode == 0 else 'failed')
 
 
 # Print summary description of this vm.
@@ -739,3 +1049,6 @@ all_vars.update(vars())
 
 logger.debug("VM's summary information.")
 logger.debug(end_desc_str(all_vars))
+
+logger.debug("Slowest stages.\n" + eventlog.summary_str())
+eventlog.close()
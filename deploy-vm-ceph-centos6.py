@@ -1,9 +1,18 @@
 #!/bin/env python
 
 import sys
+from vmdeploy import client
+
+# Hand the deploy to the deploy daemon (python -m vmdeploy.daemon) when it
+# is running, it has the modules and the configuration loaded already.
+returncode = client.forward(__file__, sys.argv[1:])
+if returncode is not None:
+    sys.exit(returncode)
+
 import os
 import os.path
 import time
+import atexit
 import argparse
 import uuid
 import random
@@ -11,10 +20,23 @@ import datetime
 import shutil
 import logging
 import subprocess
-import ConfigParser
 import tempfile
 import netaddr
 from lxml import etree
+from vmdeploy import batch
+from vmdeploy import cephrbd
+from vmdeploy import conf
+from vmdeploy import datadisk
+from vmdeploy import events
+from vmdeploy import flatten
+from vmdeploy import ipam
+from vmdeploy import membacking
+from vmdeploy import netif
+from vmdeploy import plan
+from vmdeploy import rbdlayout
+from vmdeploy import scsidisk
+from vmdeploy import slots
+from vmdeploy import topology
 
 # Parse command options.
 
@@ -49,8 +71,32 @@ def check_empty(value):
     return svalue
 
 
+def check_vmnet(value):
+    try:
+        netif.split(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
+def check_rbdlayout(value):
+    try:
+        rbdlayout.parse_spec(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
+def check_rbdcache(value):
+    try:
+        scsidisk.parse_spec(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(str(sys.exc_info()[1]))
+    return value
+
+
 # Factory function to make parser.
-def make_parser():
+def make_parser(batchmode=False):
     parser = argparse.ArgumentParser(
         description='Create a virtual machine',
         epilog='Author: xiaopan.h@gmail.com',
@@ -63,7 +109,7 @@ def make_parser():
         dest='conf_file', required=True)
     base_group.add_argument(
         '--name', help="vm's name.", dest='vmname',
-        metavar='vmname', required=True)
+        metavar='vmname', required=not batchmode)
     base_group.add_argument(
         '--pool', help='the ceph pool where to put the rbd '
         'disk image of the vm', dest='vmpool',
@@ -86,6 +132,18 @@ def make_parser():
         "Must be positive. (Default: %(default)s)",
         dest='vmmemsize', metavar='vmmemsize',
         default=1, type=check_negative)
+    cap_group.add_argument(
+        '--numa', help="'auto' pins the vcpus to the cpus of the least "
+        "loaded numa node of the host (or the fewest nodes) and binds the "
+        "memory to them, 'off' lets them float. (Default: %(default)s)",
+        dest='vmnuma', metavar='vmnuma', default='off',
+        choices=['off', 'auto'])
+    cap_group.add_argument(
+        '--hugepages', help="back the memory by hugepages of this size, "
+        "which must be free on the host (or on the numa nodes of the vm "
+        "with '--numa auto'). (Default: %(default)s)",
+        dest='vmhugepages', metavar='vmhugepages', default='off',
+        choices=['off'] + sorted(membacking.PAGE_SIZES))
 
     # Options about VM's disks.
     disk_group = parser.add_argument_group(
@@ -102,6 +160,12 @@ def make_parser():
         '--data', help="vm's data disk size. Unit: GB "
         "Must be multiple of 10.", dest='vmdatasize',
         metavar='vmdatasize', type=check_time10)
+    disk_group.add_argument(
+        '--datafs', help="file system of the data disk. 'xfs' clones an "
+        "empty xfs image made once per size, so the guest mounts it at "
+        "boot without formatting it. 'none' creates a blank disk. "
+        "(Default: %(default)s)", dest='vmdatafs', metavar='vmdatafs',
+        default='xfs', choices=['xfs', 'none'])
     disk_group.add_argument(
         '--swap', help="vm's swap disk size. Unit: GB. ",
         dest='vmswapsize', metavar='vmswapsize', type=check_negative)
@@ -116,9 +180,14 @@ def make_parser():
         "as 'br0/172.30.0.3/255.255.255.0' or "
         "'virbr0/192.168.44.3/24'. You can use 'br1//' if "
         "you want to create an interface but do NOT want "
-        "specify ip address. Each 'vmnet' becomes vm's "
-        "network interface, like eth[0,1,2..]",
-        dest='vmnet', metavar='vmnet', nargs='+', required=True)
+        "specify ip address, or 'br0/auto' to take the next free "
+        "address of the ip pool of the bridge (see '--ippool'). "
+        "Each 'vmnet' becomes vm's "
+        "network interface, like eth[0,1,2..]. Options may follow, "
+        "separated by ':', as 'br0/172.30.0.3/24:vhost:queues=4:rx=1024' "
+        "or 'eth1/172.30.0.3/24:macvtap' (see vmdeploy/netif.py).",
+        dest='vmnet', metavar='vmnet', nargs='+', type=check_vmnet,
+        required=not batchmode)
     net_group.add_argument(
         '--gw', help="vm's gateway", dest='vmgateway',
         metavar='vmgateway')
@@ -127,6 +196,54 @@ def make_parser():
         "name servers separated by comma, "
         "like 8.8.8.8,114.114.114.114",
         dest='vmnameserver', metavar='vmnameserver')
+    net_group.add_argument(
+        '--ippool', help="ip pools of the bridges, separated by comma, "
+        "like 'virbr1/172.18.28.0/24,br0/10.0.0.0/16'. Addresses given by "
+        "'--net' are checked against the pool of their bridge, a pool is "
+        "learned from the first address of a bridge without pool.",
+        dest='ippool', metavar='ippool')
+
+    # Options about the ceph cluster.
+    ceph_group = parser.add_argument_group('Ceph')
+    ceph_group.add_argument(
+        '--cephconf', help="ceph configuration file of the cluster.",
+        dest='cephconf', metavar='cephconf')
+    ceph_group.add_argument(
+        '--cephuser', help="ceph user of the deploys and the guests. "
+        "(Default: %(default)s)", dest='cephuser', metavar='cephuser',
+        default='admin')
+    ceph_group.add_argument(
+        '--cephmons', help="monitors of the cluster separated by comma, "
+        "like '172.16.0.11:6789,172.16.0.12:6789'.",
+        dest='cephmons', metavar='cephmons')
+    ceph_group.add_argument(
+        '--cephsecret', help="uuid of the libvirt secret of the key of "
+        "'cephuser'. No auth if unspecified.",
+        dest='cephsecret', metavar='cephsecret')
+    ceph_group.add_argument(
+        '--cephjobs', help="max number of images cloned or created at the "
+        "same time over one connection, by a deploy or by a batch. Must be "
+        "positive. (Default: %(default)s)", dest='cephjobs',
+        metavar='cephjobs', default=8, type=check_negative)
+    ceph_group.add_argument(
+        '--rbdlayout', help="layout profiles of the images, like "
+        "'sys=managed,data=sequential', or one profile for both. Profiles: "
+        "default (the cluster's defaults), managed (exclusive-lock, "
+        "object-map, fast-diff), sequential (managed, 8M objects striped "
+        "by 1M over 8) and bulk (managed, 16M objects). "
+        "(Default: default)", dest='rbdlayout', metavar='rbdlayout',
+        type=check_rbdlayout)
+    ceph_group.add_argument(
+        '--rbdcache', help="cache profiles of the disks, like "
+        "'sys=writeback,data=none', or one profile for both. Profiles: "
+        "default (qemu's cache mode), writeback (cache=writeback, librbd "
+        "cache on) and none (cache=none, librbd cache off), all with "
+        "discard=unmap. (Default: default)", dest='rbdcache',
+        metavar='rbdcache', type=check_rbdcache)
+    # Set by a batch whose parent made the images of the vm already.
+    ceph_group.add_argument(
+        '--rbdready', help=argparse.SUPPRESS, dest='rbdready',
+        action='store_true', default=False)
 
     # Other options.
     other_group = parser.add_argument_group('Others')
@@ -157,6 +274,13 @@ def make_parser():
         "'--mem'.",
         dest='vmmemresv', action='store_true',
         default=False)
+    other_group.add_argument(
+        '--mrsvmode', help="how '--mrsv' reserves the memory: 'balloon' "
+        "allocates twice the memory and balloons it down, 'dimm' allocates "
+        "the memory and makes room for dimms of up to twice the memory to "
+        "be plugged online. (Default: %(default)s)",
+        dest='vmmemresvmode', metavar='vmmemresvmode', default='balloon',
+        choices=membacking.RESERVE_MODES)
     other_group.add_argument(
         '--pubkey', help="ssh public key files. It "
         "accepts multiple files separated by comma. "
@@ -167,55 +291,64 @@ def make_parser():
         "to vm's /root/.ssh/authorized_keys.",
         dest='pubkey', metavar='pubkeyfile')
 
-    return parser
-
-
-# Print help messages.
-make_parser().parse_args()
-if len(sys.argv) == 1:
-    make_parser().print_help()
-    sys.exit(1)
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--conf', help='specify the configuartion file',
-                    dest='conf_file', required=True)
+    # Options about batch deploy.
+    batch_group = parser.add_argument_group('Batch')
+    batch_group.add_argument(
+        '--manifest', help="deploy every vm listed in the manifest "
+        "file instead of a single vm. The manifest is an ini file, "
+        "each section is a vm named after the section, its options "
+        "have the same names as the configuration file.",
+        dest='manifest', metavar='manifest')
+    batch_group.add_argument(
+        '--plan', help="check the vm, or every vm of the manifest, "
+        "without deploying it: names, addresses, bridges, templates, "
+        "sizes, and the disk and memory of all the vms against this "
+        "host.", dest='plan', action='store_true', default=False)
+    batch_group.add_argument(
+        '--jobs', help="number of vms deployed at the same time in "
+        "batch mode. Must be positive. (Default: %(default)s)",
+        dest='batchjobs', metavar='jobs', default=4,
+        type=check_negative)
+    batch_group.add_argument(
+        '--iojobs', help="max number of deploys copying or creating "
+        "disk images at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='iojobs', metavar='iojobs', type=check_negative)
+    batch_group.add_argument(
+        '--loopjobs', help="max number of deploys using loop devices "
+        "and mounts at the same time on this host. Must be positive. "
+        "No limit if unspecified.",
+        dest='loopjobs', metavar='loopjobs', type=check_negative)
 
-# By default, the argument strings are taken from sys.argv.
-# Until now, only one argument '--conf' are added to parser, so
-# parse_known_args() just return the populated namespace (args) and
-# the list of remaining argument.
-args, remaining_argv = parser.parse_known_args()
-# 'args' only contain 'conf_file'
-
-
-# Get complete parser from factory function.
-parser = make_parser()
-
-# Use options read from conf_file to set default values to parser.
-if args.conf_file:
-    config = ConfigParser.ConfigParser()
-    config.read([args.conf_file])
+    return parser
 
-    # Function items() return a list of (name, value) pairs for each option
-    # in the given section of the configuration file.
-    options_default = dict(config.items('DEFAULT'))
 
-    # Translate 'vmnet' from string (separated by comma) to list.
-    if 'vmnet' in options_default:
-        options_default['vmnet'] = options_default['vmnet'].split(',')
+# Parse command line arguments, options of the configuration file are
+# their defaults.
+args = conf.parse_args(make_parser)
 
-    parser.set_defaults(**options_default)
+# Plan mode: check the vm, or every vm of the manifest, and exit without
+# deploying.
+if args.plan:
+    sys.exit(plan.run(
+        make_parser, args, args.vmdeploypath, backend='rbd'))
 
-# Parse command line arguments.
-args = parser.parse_args()
+# Batch mode: deploy every vm of the manifest by a child process of this
+# script, and exit with the number of failed vms. The images of the vms are
+# made first, over one connection to the cluster.
+if args.manifest:
+    sys.exit(batch.run(
+        __file__, make_parser(True), args, args.vmcreatelogdir,
+        lambda specs: cephrbd.prepare_batch(make_parser, args, specs)))
 
 
 # if args.vmswapsize is None:
 #    args.vmswapsize = args.vmmemsize
 args.vmswapsize = 0
 
-if args.vmmemresv is False:
+# With dimm hotplug the domain has the memory of the vm, the room to grow
+# it is <maxMemory>.
+if args.vmmemresv is False or args.vmmemresvmode == 'dimm':
     vmmemsize_max = args.vmmemsize
 else:
     vmmemsize_max = args.vmmemsize * 2
@@ -225,14 +358,16 @@ if args.vmcpuresv is False:
 else:
     vmcpunumber_max = args.vmcpunumber * 2
 
+# Take the options off the 'vmnet' items, like ':vhost:queues=4'.
+args.vmnet, vmnetopts = netif.split_vmnet(args.vmnet)
+
 
 vmtmplfile = args.vmtmpl
 vmuuid = str(uuid.uuid4())
 vmdir = os.path.join(args.vmdeploypath, args.vmname)
 vmxmlfile = os.path.join(vmdir, args.vmname + '.xml')
-vmsysfile = args.vmpool + '/' + args.vmname + '.rbd'  # fio/vmtest.rbd
-vmdatafile = args.vmpool + '/' + args.vmname + \
-    '-export.rbd'  # fio/vmtest-export.rbd
+# fio/vmtest.rbd and fio/vmtest-export.rbd
+vmsysfile, vmdatafile = cephrbd.image_names(args.vmpool, args.vmname)
 
 # Generate six-bits random number.
 taskid = str(random.random()).split('.')[1][0:6]
@@ -265,11 +400,43 @@ consolehandler = logging.StreamHandler()
 consolehandler.setFormatter(logformatter)
 logger.addHandler(consolehandler)
 
+# Time every stage of the deploy in the event log of the host. A deploy
+# which exits in the middle of a stage logs it as failed.
+eventlog = events.EventLog(
+    os.path.join(args.vmcreatelogdir, 'events.jsonl'), taskid, args.vmname)
+eventlog.emit('deploy', status='start', vmtmpl=args.vmtmpl)
+atexit.register(eventlog.close)
+
 # Helper function to clean vm directory when error occured.
 
 
 def cleanfailedcreate():
     logger.debug("Cleaning failed create.")
+    if vmipam is not None:
+        try:
+            with vmipam.locked():
+                vmipam.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release ip addresses. "
+                        + str(sys.exc_info()[1]))
+    if vmpinning is not None:
+        try:
+            with vmpinning.locked():
+                vmpinning.release(args.vmname)
+        except Exception:
+            logger.warn("Failed to release numa pinning. "
+                        + str(sys.exc_info()[1]))
+    if vmrbdimages:
+        try:
+            cluster = cephrbd.connect(args)
+            try:
+                for image in vmrbdimages:
+                    cluster.remove(image)
+            finally:
+                cluster.close()
+        except Exception:
+            logger.warn("Failed to remove the rbd images. "
+                        + str(sys.exc_info()[1]))
     shutil.rmtree(vmdir)
     sys.exit(1)
 
@@ -279,19 +446,76 @@ def cleanfailedcreate():
 ##############################
 
 # Exit when can't create vm directory, reason as: vmname already exist.
+eventlog.begin('mkdir')
 try:
     os.mkdir(vmdir)
 except Exception:
     logger.error("Failed to create vm directory. " + str(sys.exc_info()[1]))
     sys.exit(1)
 else:
+    eventlog.end('mkdir')
     logger.debug("Suceeded to create vm directory.")
 
+# Take the '<bridge>/auto' addresses from the ip pools of the bridges and
+# check the given ones against them, under the lock of the pools.
+vmipam = None
+vmpinning = None
+vmrbdimages = []
+eventlog.begin('ipam')
+try:
+    ippools = ipam.IPAM(args.vmdeploypath, ipam.parse_pools(args.ippool))
+    with ippools.locked():
+        args.vmnet = ippools.allocate(
+            args.vmname, args.vmnet, args.vmgateway,
+            args.vmnameserver.split(',') if args.vmnameserver else [])
+    vmipam = ippools
+    ipam.write_ifcfg(vmdir, args.vmnet)
+except Exception:
+    logger.error("Failed to allocate ip addresses. " + str(sys.exc_info()[1]))
+    cleanfailedcreate()
+else:
+    eventlog.end('ipam')
+    logger.debug("Suceeded to allocate ip addresses: "
+                 + ", ".join(args.vmnet) + ".")
+
+# Pin the vcpus and bind the memory to the least loaded numa nodes, under
+# the lock of the pinning state.
+vmplacement = None
+if args.vmnuma == 'auto':
+    eventlog.begin('numa')
+    try:
+        pinning = topology.Pinning(args.vmdeploypath)
+        with pinning.locked():
+            vmplacement = pinning.place(
+                args.vmname, vmcpunumber_max, vmmemsize_max * 1024 ** 3,
+                membacking.PAGE_SIZES.get(args.vmhugepages, 1024) * 1024)
+        vmpinning = pinning
+    except Exception:
+        logger.error("Failed to pin the vm to numa nodes. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+    else:
+        eventlog.end('numa', nodes=vmplacement['nodes'])
+        logger.debug("Suceeded to pin the vm to numa nodes: " + ",".join(
+            str(node) for node in vmplacement['nodes']) + ".")
+
+# Check the free hugepages of the host, or of the numa nodes of the vm.
+if args.vmhugepages != 'off':
+    try:
+        membacking.check_hugepages(
+            args.vmhugepages, vmmemsize_max * 1024 ** 3, vmplacement)
+    except membacking.MemoryBackingError:
+        logger.error("Failed to back the memory by hugepages. "
+                     + str(sys.exc_info()[1]))
+        cleanfailedcreate()
+
 
 ##############################
 #      Create XML file       #
 ##############################
 
+eventlog.begin('xml')
+
 # All xml element variable name start with 'x_' to avoid name conflict.
 x_domain = etree.Element('domain', type='kvm')
 
@@ -310,6 +534,21 @@ x_currentMemory.text = str(args.vmmemsize)
 x_vcpu = etree.SubElement(x_domain, 'vcpu', current=str(args.vmcpunumber))
 x_vcpu.text = str(vmcpunumber_max)
 
+# The iothread of the virtio-scsi controller of the disks.
+x_iothreads = scsidisk.iothreads_xml(x_vcpu)
+
+x_cpu = etree.SubElement(x_domain, 'cpu')
+if vmplacement is not None:
+    topology.placement_xml(x_iothreads, x_cpu, vmplacement,
+                           vmpinning.topology, scsidisk.IOTHREAD)
+if args.vmhugepages != 'off':
+    membacking.hugepages_xml(x_currentMemory, args.vmhugepages)
+if args.vmmemresv and args.vmmemresvmode == 'dimm':
+    membacking.hotplug_xml(x_memory, x_cpu, args.vmmemsize * 2,
+                           vmcpunumber_max, args.vmmemsize)
+if len(x_cpu) == 0:
+    x_domain.remove(x_cpu)
+
 x_os = etree.SubElement(x_domain, 'os')
 x_type = etree.SubElement(x_os, 'type', arch='x86_64')
 x_type.text = 'hvm'
@@ -348,41 +587,35 @@ x_emulator.text = '/usr/libexec/qemu-kvm'
 # Helper function to define disk info to xml file.
 
 
-def defdiskxml(parent, disk_source, disk_device):
+# 'disk_profiles' sets the cache attributes of the disk 'disk_name' (sys or
+# data).
+def defdiskxml(parent, disk_source, disk_device, disk_profiles, disk_name):
     x_disk = etree.SubElement(parent, 'disk', type='network', device='disk')
-    x_driver = etree.SubElement(x_disk, 'driver', name='qemu', discard='unmap')
-    x_auth = etree.SubElement(x_disk, 'auth', username='admin')
-    x_secret = etree.SubElement(x_auth, 'secret', type='ceph',
-                                uuid='848f89f7-71a0-4b28-a625-902a4d5f3219')
-    x_source = etree.SubElement(
-        x_disk, 'source', protocol='rbd', name=disk_source)
-    x_host = etree.SubElement(
-        x_source, 'host', name='172.16.0.11', port='6789')
-    x_host = etree.SubElement(
-        x_source, 'host', name='172.16.0.12', port='6789')
-    x_host = etree.SubElement(
-        x_source, 'host', name='172.16.0.13', port='6789')
+    x_driver = scsidisk.driver_xml(x_disk, disk_profiles, disk_name)
+    x_source = cephrbd.disk_source_xml(x_disk, disk_source, args)
     x_target = etree.SubElement(x_disk, 'target', dev=disk_device, bus='scsi')
 
 
-# Define disk info to xml file.
-defdiskxml(x_devices, vmsysfile, 'sda')
+# Define disk info to xml file, on a virtio-scsi controller with a queue
+# per vcpu.
+scsidisk.controller_xml(x_devices, vmcpunumber_max)
+disk_profiles = scsidisk.parse_spec(args.rbdcache)
+defdiskxml(x_devices, vmsysfile, 'sda', disk_profiles, 'sys')
 if args.vmdatasize > 0:
-    defdiskxml(x_devices, vmdatafile, 'sdb')
+    defdiskxml(x_devices, vmdatafile, 'sdb', disk_profiles, 'data')
 
 
 # Helper function to define network interface info to xml file.
-def defnetxml(parent, net_source):
-    x_interface = etree.SubElement(parent, 'interface', type='bridge')
-    x_source = etree.SubElement(x_interface, 'source', bridge=net_source)
-    x_model = etree.SubElement(x_interface, 'model', type='virtio')
+def defnetxml(parent, net_source, net_options):
+    x_interface = netif.interface_xml(
+        parent, net_source, net_options, vmcpunumber_max)
 
 
 # Define network info to xml file.
 # vmnet = ['br0/172.30.0.3/255.255.255.0', 'virbr0/192.168.44.3/24']
-for netitem in args.vmnet:
+for index, netitem in enumerate(args.vmnet):
     br_if = netitem.split('/')[0]
-    defnetxml(x_devices, br_if)
+    defnetxml(x_devices, br_if, vmnetopts[index])
 
 # Define other devices.
 x_serial = etree.SubElement(x_devices, 'serial', type='pty')
@@ -407,6 +640,7 @@ f = open(vmxmlfile, 'w')
 f.write(etree.tostring(x_domain, pretty_print=True))
 f.close()
 
+eventlog.end('xml')
 logger.debug("Suceeded to generate the xml file for guest domain.")
 
 
@@ -414,34 +648,60 @@ logger.debug("Suceeded to generate the xml file for guest domain.")
 #     Prepare VM's Disks     #
 ##############################
 
-# Prepare the sys disk.
-# Clone from template file.
-
+# Copying and creating disk images is throttled by '--iojobs'.
+ioslot = slots.Slots('diskio', args.iojobs)
+ioslot.acquire()
+
+# Clone the sys disk from the template and make the data disk over one
+# connection to the cluster, at the same time. A data disk is a clone of the
+# formatted image of its size, or a blank disk when it can not be made.
+# A failed deploy removes the images once they are made, or given by the
+# batch.
+eventlog.begin('clone')
+vmdataformatted = False
+cluster = cephrbd.connect(args)
 try:
-    subprocess.call(['rbd', 'clone', vmtmplfile, vmsysfile],
-                    stdout=open(os.devnull, 'wb'))
+    if args.rbdready:
+        # Made by the batch, a formatted data disk is a clone.
+        vmrbdimages = [vmsysfile] + ([vmdatafile] if args.vmdatasize else [])
+        for image in vmrbdimages:
+            if not cluster.exists(image):
+                raise cephrbd.CephError("Image " + image + " is missing.")
+        if args.vmdatasize > 0:
+            vmdataformatted = cluster.parent(vmdatafile) is not None
+    else:
+        vmdataformatted = cephrbd.make_images(cluster, args, args.cephjobs)
+        vmrbdimages = [vmsysfile] + ([vmdatafile] if args.vmdatasize else [])
+    vmclones = {vmsysfile: vmtmplfile}
+    if vmdataformatted:
+        vmclones[vmdatafile] = cluster.parent(vmdatafile)
 except Exception:
     logger.error(
         "Failed to clone from " + vmtmplfile + " to " + vmsysfile
-        + ". " + str(sys.exc_info()[1]))
+        + " or create data disk. " + str(sys.exc_info()[1]))
     cleanfailedcreate()
 else:
+    eventlog.end('clone', formatted=vmdataformatted)
     logger.debug("Succeed to clone from " + vmtmplfile + " to " + vmsysfile)
 
-
-# Prepare the data disk.
-if args.vmdatasize > 0:
+    # Record the clones for the flatten scheduler (see vmdeploy.flatten)
+    # over the connection, which rebuilds the lineage of the vms deployed
+    # before it when there is none yet. The vm is deployed even if they are
+    # not recorded.
     try:
-        subprocess.call(['rbd', 'create', '--image-format', '2',
-                         '--size', str(args.vmdatasize * 1024), vmdatafile],
-                        stdout=open(os.devnull, 'wb'))
+        lineage = flatten.Lineage(args.vmdeploypath)
+        with lineage.locked(cluster):
+            for image, parent in sorted(vmclones.items()):
+                lineage.add(image, parent, args.vmname)
     except Exception:
-        logger.error(
-            "Failed to create data disk: " + vmdatafile
-            + ". " + str(sys.exc_info()[1]))
-        cleanfailedcreate()
+        logger.warn("Failed to record the rbd clones. "
+                    + str(sys.exc_info()[1]))
     else:
-        logger.debug("Suceeded to create data disk: " + vmdatafile)
+        logger.debug("Suceeded to record the rbd clones.")
+finally:
+    cluster.close()
+
+ioslot.release()
 
 
 # Prepare the swap disk.
@@ -452,22 +712,49 @@ if args.vmdatasize > 0:
 #    Manipulate file's content      #
 #####################################
 
-# Mount sys disk to a temporary directory.
+# Loop devices and mounts are throttled by '--loopjobs'.
+loopslot = slots.Slots('loop', args.loopjobs)
+loopslot.acquire()
+
+# Mount sys disk to a temporary directory. The kernel client fails to map
+# an image whose features or striping it does not know (see
+# vmdeploy.rbdlayout), nothing is injected into an unmounted directory.
+eventlog.begin('mount')
+rbddev = ''
+mountpoint = None
 try:
     logger.debug("Mount sys disk to a temporary directory.")
 
-    pobj = subprocess.Popen(['rbd', 'map', vmsysfile], stdout=subprocess.PIPE)
-    rbddev = pobj.communicate()[0].strip()
+    pobj = subprocess.Popen(['rbd', 'map', vmsysfile],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = pobj.communicate()
+    rbddev = out.strip()
+    if pobj.returncode != 0 or not rbddev:
+        raise OSError("rbd map returned {0}. {1}".format(
+            pobj.returncode, err.strip()))
     rbdmap = rbddev + "p1"
 
     mountpoint = tempfile.mkdtemp(dir='/tmp', prefix='kvm-mount-')
-    subprocess.call(['mount', rbdmap, mountpoint],
-                    stdout=open(os.devnull, 'wb'))
+    returncode = subprocess.call(['mount', rbdmap, mountpoint],
+                                 stdout=open(os.devnull, 'wb'))
+    if returncode != 0:
+        raise OSError("mount returned " + str(returncode))
 except Exception:
-    subprocess.call(['rbd', 'unmap', rbddev], stdout=open(os.devnull, 'wb'))
-    sys.exit(1)
+    logger.error("Failed to mount sys disk " + vmsysfile + ". "
+                 + str(sys.exc_info()[1]))
+    if mountpoint is not None:
+        os.rmdir(mountpoint)
+    if rbddev:
+        subprocess.call(['rbd', 'unmap', rbddev],
+                        stdout=open(os.devnull, 'wb'))
+    loopslot.release()
+    cleanfailedcreate()
+else:
+    eventlog.end('mount')
+    logger.debug("Suceeded to mount sys disk.")
 
 # Change file's content
+eventlog.begin('inject')
 try:
 
     # grubcfg_file = mountpoint + "/boot/grub2/grub.cfg"
@@ -478,10 +765,14 @@ try:
     #    f.write(new_content)
 
     fstab_file = mountpoint + "/etc/fstab"
+    # A blank data disk has to be formatted first, its entry is left
+    # commented out.
     if args.vmdatasize > 0:
         entry_string = (
-            "#/dev/sdb\t\t/export\t\t\txfs\tdefaults,noatime,discard\t0 0\n"
+            "/dev/sdb\t\t/export\t\t\txfs\tdefaults,noatime,discard\t0 0\n"
         )
+        if not vmdataformatted:
+            entry_string = "#" + entry_string
         with open(fstab_file, 'a') as f:
             f.write(entry_string)
 
@@ -510,6 +801,8 @@ try:
             "BOOTPROTO=static\nIPADDR={1}\nNETMASK={2}\n")
         with open(if_file, 'w') as f:
             f.write(if_file_content.format(if_name, if_ip, if_mask))
+            f.write(netif.ethtool_opts(
+                if_name, vmnetopts[index], vmcpunumber_max))
 
     network_file = mountpoint + "/etc/sysconfig/network"
     network_file_content = ("NETWORKING=yes\nHOSTNAME={0}\nNOZEROCONF=yes\n")
@@ -545,10 +838,15 @@ try:
             f.write("restorecon -R /root/.ssh\n"
                     "rm -rf /etc/udev/rules.d/70-persistent-net.rules\n")
 
+    eventlog.end('inject')
+
 finally:
     logger.debug("Umount the temporary directory.")
+    eventlog.begin('umount')
     subprocess.call(['umount', mountpoint])
     subprocess.call(['rbd', 'unmap', rbddev], stdout=open(os.devnull, 'wb'))
+    eventlog.end('umount')
+    loopslot.release()
 
 
 # Print summary description of this vm.
@@ -591,6 +889,9 @@ all_vars.update(vars())
 logger.debug("VM's summary information.")
 logger.debug(end_desc_str(all_vars))
 
+logger.debug("Slowest stages.\n" + eventlog.summary_str())
+eventlog.close()
+
 logger.debug(
     "Copy %s to the destination KVM HOST and start %s at there."
     % (vmxmlfile, args.vmname))
@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from vmdeploy import cephrbd
+from vmdeploy import flatten
+
+MiB = 1024 ** 2
+DAY = 86400
+NOW = 100 * DAY
+PARENT = 'rbd/vm.rbd@vm.rbd.snap'
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FlattenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.deploypath = os.path.join(self.tmpdir, 'vmimages')
+        os.mkdir(self.deploypath)
+        self.cluster = cephrbd.LocalCluster(
+            os.path.join(self.tmpdir, 'cluster.json'))
+        self.cluster.create('rbd/vm.rbd', 100 * MiB)
+        self.cluster.snapshot(PARENT)
+        self.lineage = flatten.Lineage(self.deploypath)
+        self.clock = Clock(NOW)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # Deploy 'vmname' 'age' days ago, its sys image read at 'read_rate'
+    # MiB/s.
+    def deploy(self, vmname, age, read_rate=0):
+        image = 'rbd/' + vmname + '.rbd'
+        os.mkdir(os.path.join(self.deploypath, vmname))
+        self.cluster.clone(PARENT, image)
+        with self.cluster.state() as state:
+            state['images'][image]['read_rate'] = read_rate * MiB
+        with self.lineage.locked(self.cluster):
+            self.lineage.add(image, PARENT, vmname, NOW - age * DAY)
+        return image
+
+    def remove(self, vmname):
+        shutil.rmtree(os.path.join(self.deploypath, vmname))
+        self.cluster.remove('rbd/' + vmname + '.rbd')
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('budget', 50 * MiB)
+        return flatten.Scheduler(self.lineage, self.cluster,
+                                 clock=self.clock, sleep=self.clock.sleep,
+                                 **kwargs)
+
+    def test_order(self):
+        self.deploy('vm1', 3)
+        self.deploy('vm2', 1, read_rate=5)
+        self.deploy('vm3', 2)
+        # The most read first, then the oldest.
+        self.assertEqual(self.scheduler().run_once(dry_run=True),
+                         ['rbd/vm2.rbd', 'rbd/vm1.rbd', 'rbd/vm3.rbd'])
+        self.assertEqual(self.cluster.children(PARENT),
+                         ['rbd/vm1.rbd', 'rbd/vm2.rbd', 'rbd/vm3.rbd'])
+
+    def test_budget(self):
+        for vmname in ('vm1', 'vm2', 'vm3'):
+            self.deploy(vmname, 2)
+        done = self.scheduler().run_once()
+        self.assertEqual(done, ['rbd/vm1.rbd', 'rbd/vm2.rbd', 'rbd/vm3.rbd'])
+        # 100 MiB at 50 MiB/s, a flatten every 2 seconds.
+        self.assertEqual(self.clock.sleeps, [2.0, 2.0])
+        self.assertEqual(self.cluster.children(PARENT), [])
+        with self.lineage.locked(self.cluster):
+            self.assertEqual(self.lineage.pending(self.clock(), 0), {})
+        self.assertEqual(self.scheduler().run_once(), [])
+
+    def test_min_age(self):
+        self.deploy('vm1', 2)
+        self.deploy('vm2', 0.5)
+        self.assertEqual(self.scheduler(min_age=DAY).run_once(),
+                         ['rbd/vm1.rbd'])
+
+    def test_max_load(self):
+        self.deploy('vm1', 2)
+        with self.cluster.state() as state:
+            state['load'] = 500 * MiB
+        self.assertEqual(self.scheduler(max_load=400 * MiB).run_once(), [])
+        self.assertEqual(self.cluster.children(PARENT), ['rbd/vm1.rbd'])
+        with self.cluster.state() as state:
+            state['load'] = 100 * MiB
+        self.assertEqual(self.scheduler(max_load=400 * MiB).run_once(),
+                         ['rbd/vm1.rbd'])
+
+    def test_report(self):
+        self.deploy('vm1', 2)
+        self.deploy('vm2', 1)
+        with self.lineage.locked(self.cluster):
+            result = flatten.report(self.lineage, self.cluster)
+        self.assertEqual(result, [(PARENT, ['rbd/vm1.rbd', 'rbd/vm2.rbd'])])
+
+        self.remove('vm1')
+        self.remove('vm2')
+        lineage = flatten.Lineage(self.deploypath)
+        with lineage.locked(self.cluster):
+            self.assertEqual(lineage.images, {})
+            result = flatten.report(lineage, self.cluster)
+        self.assertEqual(result, [(PARENT, [])])
+        self.assertTrue(flatten.report_str(result).splitlines()[1].endswith(
+            "can be unprotected"))
+
+        # A removed parent is forgotten.
+        self.cluster.remove(PARENT)
+        with lineage.locked(self.cluster):
+            self.assertEqual(flatten.report(lineage, self.cluster), [])
+        with open(lineage.statefile()) as f:
+            self.assertEqual(json.load(f)['parents'], [])
+
+    def test_rebuild(self):
+        image = self.deploy('vm1', 2)
+        xmlfile = os.path.join(self.deploypath, 'vm1', 'vm1.xml')
+        with open(xmlfile, 'w') as f:
+            f.write("<domain><devices><disk type='network'>"
+                    "<source protocol='rbd' name='" + image + "'/>"
+                    "</disk></devices></domain>")
+        os.remove(self.lineage.statefile())
+        lineage = flatten.Lineage(self.deploypath)
+        with lineage.locked(self.cluster):
+            self.assertEqual(list(lineage.images), [image])
+            self.assertEqual(lineage.images[image]['parent'], PARENT)
+            self.assertEqual(lineage.parents, set([PARENT]))
+
+
+if __name__ == '__main__':
+    unittest.main()
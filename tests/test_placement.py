@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from vmdeploy import placement
+
+
+def host(name, memory, bridges=('br0',), interfaces=None, vms=()):
+    return {'name': name, 'memory_free': memory, 'vcpus_free': 32,
+            'disk_free': 500, 'bridges': list(bridges),
+            'interfaces': list(interfaces or bridges), 'vms': list(vms)}
+
+
+def need(vmname='vm', memory=4, **spec):
+    spec.setdefault('vmnet', 'br0/auto')
+    return placement.requirements(
+        dict(spec, vmname=vmname, vmmemsize=str(memory), vmsyssize='20'))
+
+
+class JsonSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_directory(self):
+        for name in ('kvm02', 'kvm01'):
+            with open(os.path.join(self.tmpdir, name + '.json'), 'w') as f:
+                json.dump(host(name, 16), f)
+        source = placement.make_source('json:' + self.tmpdir)
+        self.assertEqual([h['name'] for h in source.hosts()],
+                         ['kvm01', 'kvm02'])
+
+    def test_file(self):
+        path = os.path.join(self.tmpdir, 'hosts.json')
+        with open(path, 'w') as f:
+            json.dump([host('kvm01', 16), host('kvm02', 32)], f)
+        hosts = placement.make_source('json:' + path).hosts()
+        self.assertEqual([h['memory_free'] for h in hosts], [16, 32])
+
+    def test_invalid(self):
+        self.assertRaises(placement.PlacementError,
+                          placement.make_source, 'nfs:/tmp')
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def hosts(self):
+        return [host('kvm01', 16), host('kvm02', 32)]
+
+    def test_pack(self):
+        scheduler = placement.Scheduler(self.hosts(), policy='pack')
+        self.assertEqual(scheduler.place('vm1', need()), 'kvm01')
+        self.assertEqual(scheduler.place('vm2', need()), 'kvm01')
+        # 8 GB left on kvm01.
+        self.assertEqual(scheduler.place('vm3', need(memory=12)), 'kvm02')
+
+    def test_spread(self):
+        scheduler = placement.Scheduler(self.hosts(), policy='spread')
+        self.assertEqual(scheduler.place('vm1', need(memory=8)), 'kvm02')
+        self.assertEqual(scheduler.place('vm2', need(memory=8)), 'kvm02')
+        # 16 GB left on both, kvm01 has more disk.
+        self.assertEqual(scheduler.place('vm3', need(memory=8)), 'kvm01')
+
+    def test_no_host_fits(self):
+        scheduler = placement.Scheduler(self.hosts())
+        self.assertRaises(placement.PlacementError,
+                          scheduler.place, 'vm1', need(memory=64))
+        self.assertRaises(placement.PlacementError,
+                          scheduler.place, 'vm1', need(vmnet='br1/auto'))
+
+    def test_affinity(self):
+        scheduler = placement.Scheduler(self.hosts(), policy='spread')
+        self.assertEqual(scheduler.place('web1', need(affinity='web')),
+                         'kvm02')
+        self.assertEqual(scheduler.place('web2', need(affinity='web')),
+                         'kvm02')
+        self.assertEqual(scheduler.place('other', need()), 'kvm02')
+        scheduler.place('big', need(memory=20))
+        # kvm02 is full, kvm01 is not of the group.
+        self.assertRaises(placement.PlacementError, scheduler.place,
+                          'web3', need(affinity='web'))
+
+    def test_antiaffinity(self):
+        scheduler = placement.Scheduler(self.hosts(), policy='pack')
+        self.assertEqual(scheduler.place('db1', need(antiaffinity='db')),
+                         'kvm01')
+        self.assertEqual(scheduler.place('db2', need(antiaffinity='db')),
+                         'kvm02')
+        self.assertRaises(placement.PlacementError, scheduler.place,
+                          'db3', need(antiaffinity='db'))
+
+    def test_in_flight(self):
+        scheduler = placement.Scheduler(self.hosts(), now=1000)
+        scheduler.place('vm1', need(memory=32))
+        # A later run sees vm1 in flight until it shows up on kvm02.
+        scheduler = placement.Scheduler(
+            self.hosts(), scheduler.placed, now=1100)
+        self.assertRaises(placement.PlacementError,
+                          scheduler.place, 'vm2', need(memory=20))
+        hosts = self.hosts()
+        hosts[1]['memory_free'] = 0
+        hosts[1]['vms'] = ['vm1']
+        scheduler = placement.Scheduler(hosts, scheduler.placed, now=1100)
+        self.assertEqual(scheduler.place('vm2', need(memory=12)), 'kvm01')
+
+    def test_macvtap(self):
+        hosts = [host('kvm01', 16, interfaces=['br0', 'eth0']),
+                 host('kvm02', 32, interfaces=['br0', 'eth1'])]
+        scheduler = placement.Scheduler(hosts, policy='spread')
+        vmnet = 'eth0/10.0.0.5/24:macvtap,br0/auto:vhost'
+        self.assertEqual(scheduler.place('vm1', need(vmnet=vmnet)), 'kvm01')
+        self.assertRaises(placement.PlacementError, scheduler.place, 'vm2',
+                          need(vmnet='eth2/10.0.0.6/24:macvtap'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmdeploy import topology
+
+GiB = 1024 ** 3
+
+
+# A sysfs tree of 2 nodes of 4 cpus and 4 GiB each, the cores of node 0
+# have 2 threads ('0,2' and '1,3').
+def make_sysfs(root):
+    def write(path, text):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+    for node, cpus in ((0, '0-3'), (1, '4-7')):
+        write('node/node{0}/cpulist'.format(node), cpus + '\n')
+        write('node/node{0}/meminfo'.format(node),
+              'Node {0} MemTotal:        4194304 kB\n'.format(node))
+    for cpu, siblings in ((0, '0,2'), (1, '1,3'), (2, '0,2'), (3, '1,3')):
+        write('cpu/cpu{0}/topology/thread_siblings_list'.format(cpu),
+              siblings + '\n')
+
+
+class TopologyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        make_sysfs(self.tmpdir)
+        self.topology = topology.Topology.read(self.tmpdir)
+        self.pinning = topology.Pinning(self.tmpdir, self.topology)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        self.assertEqual(self.topology.nodes, {0: [0, 1, 2, 3],
+                                               1: [4, 5, 6, 7]})
+        self.assertEqual(self.topology.memory, {0: 4 * GiB, 1: 4 * GiB})
+        self.assertEqual(self.topology.siblings[2], [0, 2])
+        # No thread_siblings_list, one thread per core.
+        self.assertEqual(self.topology.siblings[5], [5])
+        self.assertEqual(self.topology.thread_index(2), 1)
+
+    def test_place_one_node(self):
+        placement = self.pinning.place('vm1', 2, GiB)
+        self.assertEqual(placement['nodes'], [0])
+        # First threads of the cores before their siblings.
+        self.assertEqual(placement['cpus'], [0, 1])
+        self.assertEqual(placement['memory'], [GiB])
+        # The least loaded node next.
+        placement = self.pinning.place('vm2', 2, GiB)
+        self.assertEqual(placement['nodes'], [1])
+        self.assertEqual(placement['cpus'], [4, 5])
+
+    def test_place_split(self):
+        placement = self.pinning.place('vm1', 6, 6 * GiB)
+        self.assertEqual(placement['nodes'], [0, 1])
+        self.assertEqual(placement['cells'], [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(placement['memory'], [3 * GiB, 3 * GiB])
+        self.assertEqual(placement['cpus'], [0, 1, 2, 4, 5, 6])
+
+    def test_place_memory_of_cut_nodes(self):
+        # 6 GiB needs both nodes, 1 vcpu only gets one of them.
+        self.assertRaises(topology.TopologyError,
+                          self.pinning.place, 'vm1', 1, 6 * GiB)
+        self.assertEqual(self.pinning.vms, {})
+
+    def test_release(self):
+        self.pinning.place('vm1', 4, GiB)
+        self.pinning.release('vm1')
+        self.assertEqual(self.pinning.place('vm2', 2, GiB)['cpus'], [0, 1])
+
+    def test_split_memory(self):
+        self.assertEqual(topology.split_memory(6, [1, 1], [10, 10], 1),
+                         [3, 3])
+        # The first node only has room for 2, the rest goes to the second.
+        self.assertEqual(topology.split_memory(6, [1, 1], [2, 10], 1),
+                         [2, 4])
+        # Cells of whole units, the last takes the rest.
+        self.assertEqual(topology.split_memory(5, [1, 1], [10, 10], 2),
+                         [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
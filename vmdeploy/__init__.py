@@ -0,0 +1,4 @@
+# Helper modules shared by the deploy-vm-*.py scripts.
+#
+# The deploy scripts live at the top of the repository and put their own
+# directory on sys.path, so they import these modules as 'vmdeploy.<name>'.
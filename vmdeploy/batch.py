@@ -0,0 +1,159 @@
+# Batch mode of the deploy-vm-*.py scripts.
+#
+# A manifest is an ini file in the format of deploy-vm.conf. Every section
+# is one vm (the section name is the vm's name unless 'vmname' is given) and
+# its options use the same names as deploy-vm.conf, options in [DEFAULT]
+# apply to every vm of the manifest:
+#
+#   [DEFAULT]
+#   vmtmpl = centos-7.2-x64
+#   vmcpunumber = 2
+#
+#   [web01]
+#   vmnet = virbr1/172.18.28.101/24
+#
+#   [db01]
+#   vmmemsize = 8
+#   vmdatasize = 100
+#   vmnet = virbr1/172.18.28.102/24,br0//
+#
+# Each vm is deployed by a child process of the same script, at most
+# 'batchjobs' at a time. Disk I/O and loop/mount work of the children are
+# throttled separately by 'iojobs' and 'loopjobs' (see vmdeploy.slots).
+
+import os
+import sys
+import time
+import random
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+# Options that only make sense for the batch itself.
+BATCH_DESTS = (
+    'conf_file', 'manifest', 'plan', 'batchjobs', 'iojobs', 'loopjobs')
+
+TRUE_STRINGS = ('1', 'yes', 'true', 'on')
+
+
+# Read the manifest, return a list of dicts (one per vm) in file order.
+def read_manifest(manifest_file):
+    config = configparser.ConfigParser()
+    if not config.read([manifest_file]):
+        raise IOError("Can not read manifest file: " + manifest_file)
+
+    specs = []
+    for section in config.sections():
+        spec = dict(config.items(section))
+        spec.setdefault('vmname', section)
+        specs.append(spec)
+    return specs
+
+
+# Translate a vm spec into the command line of a child deploy process.
+def spec_to_argv(script, parser, conf_file, spec, iojobs=None, loopjobs=None):
+    actions = dict((a.dest, a) for a in parser._actions if a.option_strings)
+
+    argv = [sys.executable, script, '--conf', conf_file]
+    for dest in sorted(spec):
+        value = spec[dest]
+        action = actions.get(dest)
+        if action is None or dest in BATCH_DESTS or dest == 'help':
+            raise ValueError("Unknown option '{0}' for vm {1}.".format(
+                dest, spec['vmname']))
+
+        flag = action.option_strings[0]
+        if action.nargs == 0:
+            # Option like '--crsv' which takes no value.
+            if str(value).lower() in TRUE_STRINGS:
+                argv.append(flag)
+        elif action.nargs == '+':
+            # Multiple values separated by comma, like 'vmnet'.
+            argv.append(flag)
+            argv.extend(value.split(','))
+        else:
+            argv.extend([flag, str(value)])
+
+    if iojobs:
+        argv.extend(['--iojobs', str(iojobs)])
+    if loopjobs:
+        argv.extend(['--loopjobs', str(loopjobs)])
+    return argv
+
+
+# Run one child deploy process, its output goes to 'outfile'.
+def deploy_one(job):
+    vmname, argv, outfile = job
+    start = time.time()
+    try:
+        with open(outfile, 'w') as f:
+            returncode = subprocess.call(
+                argv, stdout=f, stderr=subprocess.STDOUT)
+    except Exception:
+        returncode = -1
+        with open(outfile, 'a') as f:
+            f.write("Failed to run deploy: " + str(sys.exc_info()[1]) + "\n")
+    return (vmname, returncode, time.time() - start, outfile)
+
+
+# Summary description of the batch, one line per vm.
+def summary_str(results):
+    lines = ["{0:<24s}{1:<10s}{2:>10s}  {3}".format(
+        "VM's Name:", "Status:", "Seconds:", "Output:")]
+    for vmname, returncode, elapsed, outfile in results:
+        if returncode == 0:
+            status = 'ok'
+        else:
+            status = 'failed(' + str(returncode) + ')'
+        lines.append("{0:<24s}{1:<10s}{2:>10.1f}  {3}".format(
+            vmname, status, elapsed, outfile))
+    return "\n".join(lines)
+
+
+# Deploy every vm of 'args.manifest' and return the number of failed vms.
+# 'prepare(specs)' runs before the deploys and may add options to the specs.
+def run(script, parser, args, logdir, prepare=None):
+    try:
+        specs = read_manifest(args.manifest)
+        if prepare is not None:
+            prepare(specs)
+        jobs = []
+        # Same six-bits random number as the taskid of a single deploy.
+        batchid = str(random.random()).split('.')[1][0:6]
+        for spec in specs:
+            argv = spec_to_argv(
+                os.path.abspath(script), parser, args.conf_file, spec,
+                args.iojobs, args.loopjobs)
+            outfile = os.path.join(
+                logdir, batchid + '_batch_' + spec['vmname'] + '.out')
+            jobs.append((spec['vmname'], argv, outfile))
+    except Exception:
+        print("Invalid manifest " + args.manifest + ". "
+              + str(sys.exc_info()[1]))
+        return 1
+
+    if not os.path.exists(logdir):
+        os.mkdir(logdir, 0o755)
+
+    print("Deploy {0} vms, {1} at a time.".format(len(jobs), args.batchjobs))
+    pool = ThreadPool(args.batchjobs)
+    results = []
+    try:
+        for result in pool.imap_unordered(deploy_one, jobs):
+            print("{0}: returncode {1}, {2:.1f} seconds.".format(*result[:3]))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Keep the order of the manifest in the summary.
+    order = dict((job[0], index) for index, job in enumerate(jobs))
+    results.sort(key=lambda result: order[result[0]])
+    print("=" * 20)
+    print(summary_str(results))
+
+    return len([r for r in results if r[1] != 0])
@@ -0,0 +1,673 @@
+# Rbd images of the ceph deploys.
+#
+# The images are cloned and created over one cluster connection of the
+# rados/rbd python bindings (python-rados, python-rbd), instead of one 'rbd'
+# process, and one handshake with the monitors, each. The connection is
+# shared by threads, at most 'cephjobs' clones and creates run at a time.
+# Without the bindings the same calls run the 'rbd' command, whose return
+# codes are checked.
+#
+# The cluster is set by deploy-vm.conf:
+#
+#   cephconf = /etc/ceph/ceph.conf
+#   cephuser = admin
+#   cephmons = 172.16.0.11:6789,172.16.0.12:6789,172.16.0.13:6789
+#   cephsecret = 848f89f7-71a0-4b28-a625-902a4d5f3219
+#
+# 'cephmons' and 'cephsecret' (the uuid of the libvirt secret of the key of
+# 'cephuser') also go to the <disk> elements of the domain xml.
+#
+# In batch mode the parent process makes the images of all the vms over its
+# connection before the children run (see prepare_batch), the children
+# only check them.
+
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import rados
+    import rbd
+except ImportError:
+    rados = None
+    rbd = None
+
+if rbd is not None:
+    FEATURES = {
+        'layering': rbd.RBD_FEATURE_LAYERING,
+        'exclusive-lock': rbd.RBD_FEATURE_EXCLUSIVE_LOCK,
+        'object-map': rbd.RBD_FEATURE_OBJECT_MAP,
+        'fast-diff': rbd.RBD_FEATURE_FAST_DIFF}
+
+from vmdeploy import conf
+from vmdeploy import datadisk
+from vmdeploy import rbdlayout
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = '6789'
+
+
+class CephError(Exception):
+    pass
+
+
+# Parse 'cephmons' like '172.16.0.11,172.16.0.12:6790', return a list of
+# (host, port).
+def parse_mons(value):
+    mons = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(':')
+        mons.append((host, port or DEFAULT_PORT))
+    return mons
+
+
+# Split 'pool/image@snap' into (pool, image, snap), snap may be None.
+def split_spec(spec):
+    pool, sep, rest = spec.partition('/')
+    if not sep or not pool or not rest:
+        raise CephError("Invalid rbd image '" + spec + "', the format is "
+                        "'<pool>/<image>[@<snap>]'.")
+    image, _, snap = rest.partition('@')
+    return pool, image, snap or None
+
+
+# The 'rbd' command of 'user' on the cluster of 'conffile' and 'mons' (a
+# list of (host, port)), for the calls the bindings do not make, like map.
+def rbd_argv(conffile=None, user='admin', mons=()):
+    argv = ['rbd', '--id', user or 'admin']
+    if conffile:
+        argv.extend(['--conf', conffile])
+    if mons:
+        argv.extend(['--mon_host', ",".join(
+            host + ':' + port for host, port in mons)])
+    return argv
+
+
+class Cluster(object):
+
+    def __init__(self, conffile=None, user='admin', mons=None):
+        self.conffile = conffile
+        self.user = user or 'admin'
+        self.mons = parse_mons(mons)
+        self.argv = rbd_argv(conffile, user, self.mons)
+        self.cluster = None
+        self.ioctxs = {}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.cluster is not None:
+                return self.cluster
+            conf = {}
+            if self.mons:
+                conf['mon_host'] = ",".join(
+                    host + ':' + port for host, port in self.mons)
+            try:
+                cluster = rados.Rados(
+                    conffile=self.conffile or '', rados_id=self.user,
+                    conf=conf)
+                cluster.connect()
+            except rados.Error:
+                raise CephError("Failed to connect to the ceph cluster. "
+                                + str(sys.exc_info()[1]))
+            self.cluster = cluster
+            return cluster
+
+    def ioctx(self, pool):
+        cluster = self.connect()
+        with self.lock:
+            if pool not in self.ioctxs:
+                try:
+                    self.ioctxs[pool] = cluster.open_ioctx(pool)
+                except rados.Error:
+                    raise CephError("Failed to open pool " + pool + ". "
+                                    + str(sys.exc_info()[1]))
+            return self.ioctxs[pool]
+
+    def close(self):
+        with self.lock:
+            for ioctx in self.ioctxs.values():
+                ioctx.close()
+            self.ioctxs = {}
+            if self.cluster is not None:
+                self.cluster.shutdown()
+                self.cluster = None
+
+    def exists(self, spec):
+        pool, name, snap = split_spec(spec)
+        try:
+            image = rbd.Image(self.ioctx(pool), name, snapshot=snap,
+                              read_only=True)
+        except rbd.ImageNotFound:
+            return False
+        image.close()
+        return True
+
+    # Return the parent 'pool/image@snap' of the clone 'spec', or None.
+    def parent(self, spec):
+        pool, name, _ = split_spec(spec)
+        try:
+            image = rbd.Image(self.ioctx(pool), name, read_only=True)
+        except rbd.ImageNotFound:
+            raise CephError("Image " + spec + " does not exist.")
+        try:
+            parent_pool, parent_name, parent_snap = image.parent_info()
+        except rbd.ImageNotFound:
+            return None
+        finally:
+            image.close()
+        return "{0}/{1}@{2}".format(parent_pool, parent_name, parent_snap)
+
+    # Clone the snapshot 'parent' to 'child' of 'layout' (see
+    # vmdeploy.rbdlayout).
+    def clone(self, parent, child, layout=None):
+        parent_pool, parent_name, parent_snap = split_spec(parent)
+        if parent_snap is None:
+            raise CephError("The parent " + parent + " is not a snapshot.")
+        child_pool, child_name, _ = split_spec(child)
+        try:
+            rbd.RBD().clone(
+                self.ioctx(parent_pool), parent_name, parent_snap,
+                self.ioctx(child_pool), child_name,
+                **layout_kwargs(layout))
+        except rbd.Error:
+            raise CephError("Failed to clone " + parent + " to " + child
+                            + ". " + str(sys.exc_info()[1]))
+
+    # Create the image 'spec' of 'size' bytes and 'layout'.
+    def create(self, spec, size, layout=None):
+        pool, name, _ = split_spec(spec)
+        try:
+            rbd.RBD().create(self.ioctx(pool), name, size, old_format=False,
+                             **layout_kwargs(layout))
+        except rbd.Error:
+            raise CephError("Failed to create " + spec + ". "
+                            + str(sys.exc_info()[1]))
+
+    # Create and protect the snapshot 'spec', so it can be cloned.
+    def snapshot(self, spec):
+        pool, name, snap = split_spec(spec)
+        if snap is None:
+            raise CephError("Invalid snapshot " + spec + ".")
+        image = self.open(pool + '/' + name)
+        try:
+            image.create_snap(snap)
+            image.protect_snap(snap)
+        except rbd.Error:
+            raise CephError("Failed to snapshot " + spec + ". "
+                            + str(sys.exc_info()[1]))
+        finally:
+            image.close()
+
+    def remove(self, spec):
+        pool, name, _ = split_spec(spec)
+        try:
+            rbd.RBD().remove(self.ioctx(pool), name)
+        except rbd.ImageNotFound:
+            pass
+        except rbd.Error:
+            raise CephError("Failed to remove " + spec + ". "
+                            + str(sys.exc_info()[1]))
+
+    def open(self, spec, read_only=False):
+        pool, name, snap = split_spec(spec)
+        try:
+            return rbd.Image(self.ioctx(pool), name, snapshot=snap,
+                             read_only=read_only)
+        except rbd.ImageNotFound:
+            raise CephError("Image " + spec + " does not exist.")
+
+    # Size of the image 'spec' in bytes.
+    def size(self, spec):
+        image = self.open(spec, read_only=True)
+        try:
+            return image.size()
+        finally:
+            image.close()
+
+    # Clones of the snapshot 'spec', as 'pool/image'.
+    def children(self, spec):
+        image = self.open(spec, read_only=True)
+        try:
+            return sorted(pool + '/' + name
+                          for pool, name in image.list_children())
+        finally:
+            image.close()
+
+    # Copy the data of the parent into the clone 'spec' and detach it. The
+    # bindings release the GIL, other threads go on meanwhile.
+    def flatten(self, spec):
+        image = self.open(spec)
+        try:
+            image.flatten()
+        except rbd.Error:
+            raise CephError("Failed to flatten " + spec + ". "
+                            + str(sys.exc_info()[1]))
+        finally:
+            image.close()
+
+    # Client io of the cluster in bytes per second, read and write.
+    def load(self):
+        ret, out, err = self.connect().mon_command(
+            json.dumps({'prefix': 'status', 'format': 'json'}), b'')
+        if ret != 0:
+            raise CephError("ceph status returned {0}. {1}".format(ret, err))
+        return status_load(json.loads(out.decode('utf-8', 'replace')))
+
+    # Read bytes per second of the images of 'pool' ({'pool/image': rate}),
+    # from the rbd_support module of the manager. Empty when it is not on.
+    def read_rates(self, pool):
+        try:
+            ret, out, _ = self.connect().mgr_command(json.dumps({
+                'prefix': 'rbd perf image stats', 'pool_spec': pool,
+                'sort_by': 'read_bytes', 'format': 'json'}), b'')
+        except (AttributeError, rados.Error):
+            return {}
+        if ret != 0:
+            return {}
+        return image_read_rates(pool, out.decode('utf-8', 'replace'))
+
+
+# The calls of Cluster by the 'rbd' command.
+class CliCluster(object):
+
+    def __init__(self, conffile=None, user='admin', mons=None):
+        self.argv = rbd_argv(conffile, user, parse_mons(mons))
+
+    def run(self, *argv):
+        pobj = subprocess.Popen(
+            self.argv + list(argv), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = pobj.communicate()
+        if pobj.returncode != 0:
+            raise CephError("rbd {0} returned {1}. {2}".format(
+                " ".join(argv), pobj.returncode,
+                err.decode('utf-8', 'replace').strip()))
+        return out.decode('utf-8', 'replace')
+
+    def close(self):
+        pass
+
+    def exists(self, spec):
+        split_spec(spec)
+        try:
+            self.run('info', spec)
+        except CephError:
+            return False
+        return True
+
+    def parent(self, spec):
+        try:
+            info = json.loads(self.run('info', '--format', 'json', spec))
+        except ValueError:
+            return None
+        parent = info.get('parent')
+        if not parent:
+            return None
+        return "{0}/{1}@{2}".format(
+            parent['pool'], parent['image'], parent['snapshot'])
+
+    def clone(self, parent, child, layout=None):
+        split_spec(child)
+        if split_spec(parent)[2] is None:
+            raise CephError("The parent " + parent + " is not a snapshot.")
+        argv = rbdlayout.rbd_args(layout or {}) + [parent, child]
+        self.run('clone', *argv)
+
+    def create(self, spec, size, layout=None):
+        split_spec(spec)
+        argv = rbdlayout.rbd_args(layout or {}) + [spec]
+        self.run('create', '--image-format', '2',
+                 '--size', str(size // 1024 ** 2), *argv)
+
+    def snapshot(self, spec):
+        if split_spec(spec)[2] is None:
+            raise CephError("Invalid snapshot " + spec + ".")
+        self.run('snap', 'create', spec)
+        self.run('snap', 'protect', spec)
+
+    def remove(self, spec):
+        if self.exists(spec):
+            self.run('rm', spec)
+
+    def info(self, spec):
+        try:
+            return json.loads(self.run('info', '--format', 'json', spec))
+        except ValueError:
+            raise CephError("Invalid rbd info of " + spec + ".")
+
+    def size(self, spec):
+        return int(self.info(spec)['size'])
+
+    def children(self, spec):
+        split_spec(spec)
+        try:
+            children = json.loads(
+                self.run('children', '--format', 'json', spec))
+        except ValueError:
+            raise CephError("Invalid rbd children of " + spec + ".")
+        # Older rbd lists 'pool/image' strings.
+        return sorted(child if not isinstance(child, dict) else
+                      child['pool'] + '/' + child['image']
+                      for child in children)
+
+    def flatten(self, spec):
+        split_spec(spec)
+        self.run('--no-progress', 'flatten', spec)
+
+    def load(self):
+        pobj = subprocess.Popen(
+            ['ceph'] + self.argv[1:] + ['status', '--format', 'json'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = pobj.communicate()
+        if pobj.returncode != 0:
+            raise CephError("ceph status returned {0}. {1}".format(
+                pobj.returncode, err.decode('utf-8', 'replace').strip()))
+        try:
+            return status_load(json.loads(out.decode('utf-8', 'replace')))
+        except ValueError:
+            raise CephError("Invalid ceph status.")
+
+    # 'rbd perf image iostat' does not stop by itself, the images are
+    # ordered by age alone.
+    def read_rates(self, pool):
+        return {}
+
+
+# A cluster kept in a json file, a stand-in of the rbd calls for testing
+# (see vmdeploy.flatten). The file is
+#
+#   {"load": <bytes/s>,
+#    "images": {"rbd/vm.rbd": {"size": <bytes>, "parent": null,
+#                              "read_rate": <bytes/s>},
+#               "rbd/vm.rbd@vm.rbd.snap": {...}, ...}}
+#
+# snapshots are images whose name has '@', a clone has the snapshot as
+# 'parent'. Flattening one takes 'flatten_time' seconds per GiB.
+class LocalCluster(object):
+
+    def __init__(self, path, flatten_time=0):
+        self.path = path
+        self.flatten_time = flatten_time
+        self.argv = ['rbd']
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def state(self):
+        with self.lock:
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                state = {}
+            state.setdefault('images', {})
+            yield state
+            with open(self.path, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+
+    def get(self, spec):
+        split_spec(spec)
+        with self.state() as state:
+            if spec not in state['images']:
+                raise CephError("Image " + spec + " does not exist.")
+            return dict(state['images'][spec])
+
+    def close(self):
+        pass
+
+    def exists(self, spec):
+        split_spec(spec)
+        with self.state() as state:
+            return spec in state['images']
+
+    def parent(self, spec):
+        return self.get(spec).get('parent')
+
+    def clone(self, parent, child, layout=None):
+        split_spec(child)
+        if split_spec(parent)[2] is None:
+            raise CephError("The parent " + parent + " is not a snapshot.")
+        size = self.get(parent).get('size', 0)
+        with self.state() as state:
+            if child in state['images']:
+                raise CephError("Image " + child + " exists.")
+            state['images'][child] = {
+                'size': size, 'parent': parent, 'layout': layout or {}}
+
+    def create(self, spec, size, layout=None):
+        split_spec(spec)
+        with self.state() as state:
+            if spec in state['images']:
+                raise CephError("Image " + spec + " exists.")
+            state['images'][spec] = {
+                'size': size, 'parent': None, 'layout': layout or {}}
+
+    def snapshot(self, spec):
+        pool, name, snap = split_spec(spec)
+        if snap is None:
+            raise CephError("Invalid snapshot " + spec + ".")
+        size = self.size(pool + '/' + name)
+        with self.state() as state:
+            if spec in state['images']:
+                raise CephError("Image " + spec + " exists.")
+            state['images'][spec] = {'size': size, 'parent': None}
+
+    def remove(self, spec):
+        with self.state() as state:
+            state['images'].pop(spec, None)
+
+    def size(self, spec):
+        return self.get(spec).get('size', 0)
+
+    def children(self, spec):
+        with self.state() as state:
+            return sorted(name for name, image in state['images'].items()
+                          if image.get('parent') == spec)
+
+    def flatten(self, spec):
+        size = self.size(spec)
+        time.sleep(self.flatten_time * size / 1024.0 ** 3)
+        with self.state() as state:
+            state['images'][spec]['parent'] = None
+
+    def load(self):
+        with self.state() as state:
+            return state.get('load', 0)
+
+    def read_rates(self, pool):
+        with self.state() as state:
+            return dict((name, image['read_rate'])
+                        for name, image in state['images'].items()
+                        if name.startswith(pool + '/')
+                        and image.get('read_rate'))
+
+
+# Keyword arguments of RBD.create and RBD.clone of 'layout'. Without
+# 'features' librbd takes the cluster's rbd_default_features, like the rbd
+# command.
+def layout_kwargs(layout):
+    layout = layout or {}
+    kwargs = {}
+    if 'object_size' in layout:
+        # log2 of the object size.
+        kwargs['order'] = layout['object_size'].bit_length() - 1
+    if 'stripe_unit' in layout:
+        kwargs['stripe_unit'] = layout['stripe_unit']
+        kwargs['stripe_count'] = layout['stripe_count']
+    if 'features' in layout:
+        features = 0
+        for name in layout['features']:
+            features |= FEATURES[name]
+        if 'stripe_unit' in layout:
+            features |= rbd.RBD_FEATURE_STRIPINGV2
+        kwargs['features'] = features
+    return kwargs
+
+
+# Client io in bytes per second of the json of 'ceph status', the rates are
+# left out when the cluster is idle.
+def status_load(status):
+    pgmap = status.get('pgmap', {})
+    return (pgmap.get('read_bytes_sec', 0)
+            + pgmap.get('write_bytes_sec', 0))
+
+
+# Parse the json of 'rbd perf image stats' of 'pool', return the read bytes
+# per second of each image.
+def image_read_rates(pool, out):
+    try:
+        stats = json.loads(out)
+        column = stats['stat_descriptors'].index('read_bytes')
+        return dict((pool + '/' + name.split('/')[-1], values[column])
+                    for name, values in stats['stats'].items())
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        logger.debug("Invalid image stats of pool " + pool + ".")
+        return {}
+
+
+# The cluster of the ceph options of 'args', over the python bindings when
+# they are installed.
+def connect(args):
+    if rbd is not None:
+        return Cluster(args.cephconf, args.cephuser, args.cephmons)
+    logger.debug("No rados/rbd python bindings, use the rbd command.")
+    return CliCluster(args.cephconf, args.cephuser, args.cephmons)
+
+
+# Run the 'tasks' ((name, function) pairs), at most 'jobs' at a time.
+# Return {name: error message} of the failed ones.
+def run_tasks(tasks, jobs):
+    def run_one(task):
+        name, function = task
+        try:
+            function()
+        except Exception:
+            return name, str(sys.exc_info()[1])
+        return name, None
+
+    if not tasks:
+        return {}
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        results = pool.map(run_one, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((name, error) for name, error in results if error)
+
+
+# Add the <auth> and <source> of the rbd image 'spec' to 'x_disk'.
+def disk_source_xml(x_disk, spec, args):
+    if args.cephsecret:
+        x_auth = x_disk.makeelement(
+            'auth', {'username': args.cephuser or 'admin'})
+        x_auth.append(x_auth.makeelement(
+            'secret', {'type': 'ceph', 'uuid': args.cephsecret}))
+        x_disk.append(x_auth)
+    x_source = x_disk.makeelement('source', {'protocol': 'rbd', 'name': spec})
+    for host, port in parse_mons(args.cephmons):
+        x_source.append(x_source.makeelement(
+            'host', {'name': host, 'port': port}))
+    x_disk.append(x_source)
+    return x_source
+
+
+# Image names of the sys and data disks of 'vmname' in 'pool'.
+def image_names(pool, vmname):
+    return (pool + '/' + vmname + '.rbd', pool + '/' + vmname + '-export.rbd')
+
+
+# Make the data image of the vm of 'vmargs': a clone of the formatted image
+# of its size (see vmdeploy.datadisk), or a blank image when that can not be
+# made. Return True if it is formatted.
+def make_datadisk(cluster, vmargs):
+    dataimage = image_names(vmargs.vmpool, vmargs.vmname)[1]
+    layout = rbdlayout.layouts(vmargs.rbdlayout)['data']
+    if vmargs.vmdatafs == 'xfs':
+        try:
+            datadisk.RbdDataDisks(vmargs.vmpool, cluster).clone(
+                vmargs.vmdatasize, dataimage, layout)
+            return True
+        except Exception:
+            logger.warn("Failed to clone formatted data disk, create a "
+                        "blank one. " + str(sys.exc_info()[1]))
+    cluster.create(dataimage, vmargs.vmdatasize * 1024 ** 3, layout)
+    return False
+
+
+# Clone the sys image and make the data image of the vm of 'vmargs', of
+# their layouts of 'rbdlayout', 'jobs' images at a time. Return whether the
+# data image is formatted, the images made are removed when one fails.
+def make_images(cluster, vmargs, jobs):
+    sysimage, dataimage = image_names(vmargs.vmpool, vmargs.vmname)
+    formatted = []
+    layout = rbdlayout.layouts(vmargs.rbdlayout)['sys']
+    tasks = [(sysimage, lambda: cluster.clone(
+        vmargs.vmtmpl, sysimage, layout))]
+    if vmargs.vmdatasize > 0:
+        tasks.append((dataimage, lambda: formatted.append(
+            make_datadisk(cluster, vmargs))))
+    errors = run_tasks(tasks, jobs)
+    if errors:
+        for name, _ in tasks:
+            if name not in errors:
+                try:
+                    cluster.remove(name)
+                except CephError:
+                    logger.warn(str(sys.exc_info()[1]))
+        raise CephError(" ".join(errors[name] for name, _ in tasks
+                                 if name in errors))
+    return bool(formatted and formatted[0])
+
+
+# Make the images of the vms of the manifest 'specs' over one connection
+# before their deploys, 'cephjobs' at a time. The specs of the vms whose
+# images are made get 'rbdready', the others are left for their deploys to
+# make (or to fail on). Return the number of vms made ready.
+def prepare_batch(make_parser, args, specs):
+    from vmdeploy import plan
+
+    parser = make_parser(False)
+    parser.set_defaults(**conf.read_defaults(args.conf_file))
+    vms = []
+    for spec in specs:
+        try:
+            vms.append((spec, plan.spec_to_args(
+                parser, args.conf_file, spec)))
+        except Exception:
+            # Reported by the deploy of the vm.
+            continue
+
+    cluster = connect(args)
+    tasks = []
+    try:
+        for index, (spec, vmargs) in enumerate(vms):
+            if cluster.exists(image_names(vmargs.vmpool, vmargs.vmname)[0]):
+                continue
+            tasks.append((index, lambda vmargs=vmargs: make_images(
+                cluster, vmargs, 1)))
+        errors = run_tasks(tasks, args.cephjobs)
+    except CephError:
+        print("Failed to prepare the images. " + str(sys.exc_info()[1]))
+        return 0
+    finally:
+        cluster.close()
+    for index, _ in tasks:
+        spec = vms[index][0]
+        if index in errors:
+            print("Failed to prepare the images of {0}. {1}".format(
+                spec['vmname'], errors[index]))
+        else:
+            spec['rbdready'] = 'yes'
+    print("Prepared the images of {0} vms.".format(
+        len(tasks) - len(errors)))
+    return len(tasks) - len(errors)
@@ -0,0 +1,88 @@
+# Client side of the deploy daemon (vmdeploy.daemon).
+#
+# The deploy scripts call forward() before anything else. When the daemon
+# is listening on its unix socket the deploy is sent to it, its output is
+# printed as it comes and the script exits with its return code. Without
+# a daemon (or inside a deploy run by the daemon) forward() returns None
+# and the script deploys by itself.
+#
+# This module is imported before lxml and netaddr, keep its imports light.
+
+import os
+import sys
+import json
+import socket
+
+# Unix socket of the daemon, $VMDEPLOY_SOCKET if set.
+SOCKET = '/var/run/vmdeploy.sock'
+
+# Set in the environment of deploys run by the daemon.
+DAEMON_ENV = 'VMDEPLOY_DAEMON'
+
+
+def socket_path():
+    return os.environ.get('VMDEPLOY_SOCKET', SOCKET)
+
+
+def connect(path=None):
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # Stale socket of a daemon which is gone.
+        sock.close()
+        return None
+    return sock
+
+
+# Iterate over the json lines received on 'sock'.
+def read_messages(sock):
+    buf = b''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            yield json.loads(line.decode('utf-8'))
+
+
+# Run 'script' with 'argv' in the daemon, return its return code or None
+# if there is no daemon.
+def forward(script, argv):
+    if os.environ.get(DAEMON_ENV):
+        return None
+    sock = connect()
+    if sock is None:
+        return None
+
+    request = {
+        'script': os.path.basename(script), 'argv': list(argv),
+        'cwd': os.getcwd(), 'env': dict(os.environ)}
+    try:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        for message in read_messages(sock):
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+            elif 'queued' in message:
+                sys.stderr.write(
+                    "Queued by the deploy daemon, {0} ahead.\n".format(
+                        message['queued']))
+            elif 'error' in message:
+                sys.stderr.write(message['error'] + "\n")
+                return 1
+            elif 'returncode' in message:
+                return message['returncode']
+    except (socket.error, ValueError):
+        sys.stderr.write("Lost the deploy daemon. " + str(sys.exc_info()[1])
+                         + "\n")
+        return 1
+    finally:
+        sock.close()
+    sys.stderr.write("The deploy daemon closed the connection.\n")
+    return 1
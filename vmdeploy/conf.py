@@ -0,0 +1,68 @@
+# Command line and configuration file (deploy-vm.conf) of the deploy
+# scripts.
+#
+# Options of the [DEFAULT] section of the configuration file are the
+# defaults of the command line options with the same dest. The parsed
+# section is cached by path and mtime, a deploy run by the deploy daemon
+# (vmdeploy.daemon) reuses what the daemon parsed when it started.
+
+import os
+import sys
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+_cache = {}
+
+
+# Return the options of the [DEFAULT] section of 'conf_file' as a dict.
+def read_defaults(conf_file):
+    conf_file = os.path.abspath(conf_file)
+    try:
+        mtime = os.path.getmtime(conf_file)
+    except OSError:
+        mtime = None
+    cached = _cache.get(conf_file)
+    if cached is not None and cached[0] == mtime:
+        return dict(cached[1])
+
+    config = configparser.ConfigParser()
+    config.read([conf_file])
+
+    # Function items() return a list of (name, value) pairs for each option
+    # in the given section of the configuration file.
+    options_default = dict(config.items('DEFAULT'))
+
+    # Translate 'vmnet' from string (separated by comma) to list.
+    if 'vmnet' in options_default:
+        options_default['vmnet'] = options_default['vmnet'].split(',')
+
+    _cache[conf_file] = (mtime, options_default)
+    return dict(options_default)
+
+
+# Parse the command line of a deploy script whose parser is made by
+# 'make_parser(batchmode)'.
+def parse_args(make_parser, argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Batch mode does not need '--name' and '--net', so look for
+    # '--manifest' before validating the command line.
+    batchmode = '--manifest' in argv or any(
+        a.startswith('--manifest=') for a in argv)
+    parser = make_parser(batchmode)
+
+    # Print help messages.
+    if not argv:
+        parser.print_help()
+        sys.exit(1)
+
+    # The first pass validates the command line (and prints help) and
+    # finds the configuration file, whose options become the defaults of
+    # the second pass.
+    args = parser.parse_args(argv)
+    parser.set_defaults(**read_defaults(args.conf_file))
+    return parser.parse_args(argv)
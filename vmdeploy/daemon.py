@@ -0,0 +1,315 @@
+# Deploy daemon.
+#
+#   python -m vmdeploy.daemon --conf deploy-vm.conf --jobs 4
+#
+# A deploy run from the shell pays the start up of python, the imports of
+# lxml and netaddr, and the parsing of the command line and the
+# configuration file before any real work. The daemon pays it once: it
+# imports the deploy modules and parses the configuration files given by
+# '--conf' when it starts, then listens on a unix socket (see
+# vmdeploy.client, which the deploy scripts use to forward themselves).
+#
+# Requests are queued and at most '--jobs' run at a time. Every deploy is
+# run by a forked child of the daemon, which inherits the warm modules and
+# configuration and runs the deploy script as __main__ with the argv, the
+# working directory and the environment of the client. Its output is sent
+# back to the client as it comes.
+#
+# The protocol is json lines. The client sends one request
+#
+#   {"script": "deploy-vm-centos7.py", "argv": [...], "cwd": ..., "env": {}}
+#
+# and receives {"queued": <deploys ahead>}, {"output": <text>} (many) and
+# at last {"returncode": <int>} or {"error": <text>}.
+#
+# The daemon is single threaded (select), forking from it is safe.
+
+import os
+import sys
+import json
+import errno
+import codecs
+import signal
+import select
+import socket
+import logging
+import argparse
+import traceback
+from collections import deque
+
+from vmdeploy import client
+from vmdeploy import conf
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Scripts which may be run, all in BASE_DIR.
+SCRIPTS = (
+    'deploy-vm-centos6.py', 'deploy-vm-centos7.py',
+    'deploy-vm-ceph-centos6.py')
+
+# Imported once by the daemon, deploys find them in sys.modules.
+WARM_MODULES = (
+    'argparse', 'uuid', 'random', 'datetime', 'shutil', 'subprocess',
+    'tempfile', 'netaddr', 'lxml.etree', 'vmdeploy.batch', 'vmdeploy.cephrbd',
+    'vmdeploy.datadisk', 'vmdeploy.diskprofile', 'vmdeploy.events',
+    'vmdeploy.flatten', 'vmdeploy.ipam', 'vmdeploy.iso9660',
+    'vmdeploy.loopdev', 'vmdeploy.membacking', 'vmdeploy.netif',
+    'vmdeploy.nocloud', 'vmdeploy.parttable', 'vmdeploy.plan',
+    'vmdeploy.provision', 'vmdeploy.rawdisk', 'vmdeploy.rbdlayout',
+    'vmdeploy.scsidisk', 'vmdeploy.slots', 'vmdeploy.sparsecopy',
+    'vmdeploy.stages', 'vmdeploy.tmplcache', 'vmdeploy.topology',
+    'vmdeploy.util', 'vmdeploy.warmpool')
+
+
+def warm_up(conf_files):
+    for name in WARM_MODULES:
+        try:
+            __import__(name)
+        except ImportError:
+            logger.warn("Failed to import " + name + ". "
+                        + str(sys.exc_info()[1]))
+    for conf_file in conf_files:
+        conf.read_defaults(os.path.abspath(conf_file))
+
+
+def send(sock, message):
+    try:
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+    except socket.error:
+        # The client is gone, the deploy goes on.
+        pass
+
+
+class Request(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+        self.message = None
+        self.pid = None
+        self.pipe = None
+        # A utf-8 character of the output may span two reads.
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+
+class Daemon(object):
+
+    def __init__(self, path, jobs=4):
+        self.path = path
+        # Max number of deploys running at the same time.
+        self.jobs = jobs
+        self.listener = None
+        # Connections still sending their request.
+        self.reading = []
+        self.queue = deque()
+        # Read end of the output pipe of running deploys.
+        self.running = {}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            if client.connect(self.path) is not None:
+                raise OSError("A daemon is listening on " + self.path)
+            os.remove(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(64)
+        logger.debug("Listening on " + self.path + ".")
+
+    def serve_forever(self):
+        self.listen()
+        try:
+            while True:
+                self.serve_once()
+        finally:
+            self.listener.close()
+            os.remove(self.path)
+
+    def serve_once(self, timeout=1):
+        rlist = [self.listener] + [r.sock for r in self.reading] + \
+            list(self.running)
+        try:
+            readable = select.select(rlist, [], [], timeout)[0]
+        except select.error:
+            if sys.exc_info()[1].args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            if fd is self.listener:
+                sock = self.listener.accept()[0]
+                self.reading.append(Request(sock))
+            elif fd in self.running:
+                self.relay(fd)
+            else:
+                request = [r for r in self.reading if r.sock is fd][0]
+                self.read_request(request)
+
+        while self.queue and len(self.running) < self.jobs:
+            self.start(self.queue.popleft())
+
+    def read_request(self, request):
+        data = request.sock.recv(65536)
+        if not data:
+            self.reading.remove(request)
+            request.sock.close()
+            return
+        request.buf += data
+        if b'\n' not in request.buf:
+            return
+        self.reading.remove(request)
+        try:
+            request.message = json.loads(
+                request.buf.split(b'\n', 1)[0].decode('utf-8'))
+            if request.message['script'] not in SCRIPTS:
+                raise ValueError(
+                    "Unknown script: " + request.message['script'])
+        except (ValueError, KeyError, TypeError):
+            send(request.sock, {
+                'error': "Invalid request. " + str(sys.exc_info()[1])})
+            request.sock.close()
+            return
+        if self.queue or len(self.running) >= self.jobs:
+            send(request.sock, {'queued': len(self.queue)})
+        self.queue.append(request)
+
+    def start(self, request):
+        message = request.message
+        logger.debug("Run {0} {1}.".format(
+            message['script'], " ".join(message['argv'])))
+        rfd, wfd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            returncode = 1
+            try:
+                os.close(rfd)
+                self.listener.close()
+                for other in list(self.running.values()) + \
+                        list(self.queue) + self.reading + [request]:
+                    other.sock.close()
+                    if other.pipe:
+                        other.pipe.close()
+                returncode = run_script(message, wfd)
+            finally:
+                os._exit(returncode)
+
+        os.close(wfd)
+        request.pid = pid
+        pipe = os.fdopen(rfd, 'rb', 0)
+        request.pipe = pipe
+        self.running[pipe] = request
+
+    # Send the output of a running deploy to its client, and its return
+    # code when it is done.
+    def relay(self, pipe):
+        request = self.running[pipe]
+        data = os.read(pipe.fileno(), 65536)
+        if data:
+            send(request.sock, {'output': request.decoder.decode(data)})
+            return
+
+        del self.running[pipe]
+        pipe.close()
+        status = os.waitpid(request.pid, 0)[1]
+        if os.WIFEXITED(status):
+            returncode = os.WEXITSTATUS(status)
+        else:
+            returncode = 128 + os.WTERMSIG(status)
+        logger.debug("{0} {1} returned {2}.".format(
+            request.message['script'], " ".join(request.message['argv']),
+            returncode))
+        send(request.sock, {'returncode': returncode})
+        request.sock.close()
+
+
+# Run the deploy script of 'message' as __main__, in a forked child of the
+# daemon whose output goes to 'wfd'. Return its exit code.
+def run_script(message, wfd):
+    import atexit
+    import runpy
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.dup2(wfd, 1)
+    os.dup2(wfd, 2)
+    os.close(wfd)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+    # The deploy sets up its own logging.
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    os.environ.clear()
+    os.environ.update(message.get('env') or {})
+    os.environ[client.DAEMON_ENV] = '1'
+    script = os.path.join(BASE_DIR, message['script'])
+    sys.argv = [script] + [str(a) for a in message['argv']]
+    try:
+        os.chdir(message.get('cwd') or BASE_DIR)
+        runpy.run_path(script, run_name='__main__')
+        returncode = 0
+    except SystemExit:
+        code = sys.exc_info()[1].code
+        if code is None:
+            returncode = 0
+        elif isinstance(code, int):
+            returncode = code
+        else:
+            sys.stderr.write(str(code) + "\n")
+            returncode = 1
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    # The child ends by os._exit(), run the exit functions of the deploy
+    # (like closing its event log) now.
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run deploy requests of the deploy-vm-*.py scripts')
+    parser.add_argument(
+        '--socket', help="unix socket to listen on. "
+        "(Default: %(default)s)", dest='socket',
+        default=client.socket_path())
+    parser.add_argument(
+        '--jobs', help="number of deploys run at the same time. "
+        "(Default: %(default)s)", dest='jobs', type=int, default=4)
+    parser.add_argument(
+        '--conf', help="configuration files parsed in advance, this can "
+        "be used many times.", dest='conf_files', action='append',
+        default=[])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(process)d] [%(levelname)-5.5s]  %(message)s")
+
+    # Leave serve_forever() by an exception so the socket is removed.
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    warm_up(args.conf_files)
+    daemon = Daemon(args.socket, args.jobs)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# Data disks which are formatted already.
+#
+# The guests mount their data disk from fstab (/dev/vdc on /web, /dev/sdb on
+# /export), a blank disk has to be formatted on first boot first. Instead an
+# empty xfs image of each size is made once and cloned for every vm:
+#
+#   - DataDisks keeps '<vmdeploypath>/.datadisks/xfs-<size>G.raw' and clones
+#     it by reflink (falls back to a sparse copy, an empty xfs is a few MB
+#     of data);
+#   - RbdDataDisks keeps the protected snapshot
+#     '<pool>/datadisk-xfs-<size>G.rbd@formatted' and makes the data disk an
+#     rbd clone of it.
+#
+# Like the sys disks cloned from a template, the data disks of all the vms
+# share the uuid of their file system.
+
+import os
+import sys
+import uuid
+import fcntl
+import logging
+import subprocess
+
+from vmdeploy import provision
+from vmdeploy import rawdisk
+from vmdeploy import rbdlayout
+from vmdeploy import sparsecopy
+
+logger = logging.getLogger(__name__)
+
+CACHEDIR = '.datadisks'
+RBD_SNAP = 'formatted'
+
+
+def mkfs_xfs(device):
+    try:
+        returncode = subprocess.call(
+            ['mkfs.xfs', '-q', '-f', device], stdout=open(os.devnull, 'wb'))
+    except OSError:
+        raise OSError("Failed to run mkfs.xfs. " + str(sys.exc_info()[1]))
+    if returncode != 0:
+        raise OSError("mkfs.xfs returned " + str(returncode))
+
+
+class DataDisks(object):
+
+    def __init__(self, vmdeploypath):
+        self.cachedir = os.path.join(vmdeploypath, CACHEDIR)
+
+    def image(self, size):
+        return os.path.join(self.cachedir, 'xfs-{0}G.raw'.format(size))
+
+    # Return the formatted image of 'size' GB, made by the first deploy
+    # which needs it while the others wait.
+    def get(self, size):
+        image = self.image(size)
+        if os.path.exists(image):
+            return image
+        if not os.path.exists(self.cachedir):
+            try:
+                os.mkdir(self.cachedir, 0o755)
+            except OSError:
+                # Created by a concurrent deploy.
+                pass
+        fd = os.open(image + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.path.exists(image):
+                return image
+            tmpfile = os.path.join(
+                self.cachedir, '.' + str(uuid.uuid4()) + '.tmp')
+            try:
+                rawdisk.create(tmpfile, size * rawdisk.GIB)
+                mkfs_xfs(tmpfile)
+                os.rename(tmpfile, image)
+            except Exception:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            logger.debug("Made formatted data disk " + image + ".")
+            return image
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    # Make 'dst' a formatted data disk of 'size' GB, return the method.
+    def clone(self, size, dst, allocation='off'):
+        image = self.get(size)
+        try:
+            provision.reflink(image, dst)
+            method = 'reflink'
+        except OSError:
+            exc = sys.exc_info()[1]
+            if exc.errno not in provision.NO_REFLINK_ERRNOS:
+                raise
+            sparsecopy.copy(image, dst)
+            method = 'copy'
+        rawdisk.allocate(dst, allocation)
+        return method
+
+
+class RbdDataDisks(object):
+
+    # 'cluster' (see vmdeploy.cephrbd) checks, creates, snapshots and
+    # clones the images over its connection, instead of the rbd command,
+    # and maps them by the rbd command of its user and monitors.
+    def __init__(self, pool, cluster=None):
+        self.pool = pool
+        self.cluster = cluster
+
+    def image(self, size):
+        return '{0}/datadisk-xfs-{1}G.rbd'.format(self.pool, size)
+
+    def exists(self, name):
+        if self.cluster is not None:
+            return self.cluster.exists(name)
+        return subprocess.call(
+            ['rbd', 'info', name], stdout=open(os.devnull, 'wb'),
+            stderr=subprocess.STDOUT) == 0
+
+    # Return the snapshot of the formatted image of 'size' GB.
+    def get(self, size):
+        image = self.image(size)
+        snap = image + '@' + RBD_SNAP
+        if self.exists(snap):
+            return snap
+
+        # One deploy of this host makes it, 'rbd create' fails if a deploy
+        # of another host is making it.
+        lockfile = os.path.join(
+            '/tmp', 'kvm-' + image.replace('/', '_') + '.lock')
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self.exists(snap):
+                return snap
+            if self.cluster is not None:
+                self.cluster.create(image, size * 1024 ** 3)
+            else:
+                self.rbd('create', '--image-format', '2',
+                         '--size', str(size * 1024), image)
+            pobj = subprocess.Popen(
+                self.argv() + ['map', image], stdout=subprocess.PIPE)
+            device = pobj.communicate()[0].decode('utf-8').strip()
+            if pobj.returncode != 0 or not device:
+                raise OSError("Failed to map " + image)
+            try:
+                mkfs_xfs(device)
+            finally:
+                self.rbd('unmap', device)
+            if self.cluster is not None:
+                self.cluster.snapshot(snap)
+            else:
+                self.rbd('snap', 'create', snap)
+                self.rbd('snap', 'protect', snap)
+            logger.debug("Made formatted data disk " + snap + ".")
+            return snap
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def argv(self):
+        if self.cluster is not None:
+            return list(self.cluster.argv)
+        return ['rbd']
+
+    def rbd(self, *argv):
+        returncode = subprocess.call(
+            self.argv() + list(argv), stdout=open(os.devnull, 'wb'))
+        if returncode != 0:
+            raise OSError("rbd {0} returned {1}".format(
+                " ".join(argv), returncode))
+
+    # Make 'dst' an rbd clone of the formatted image of 'size' GB, of
+    # 'layout' (see vmdeploy.rbdlayout).
+    def clone(self, size, dst, layout=None):
+        if self.cluster is not None:
+            self.cluster.clone(self.get(size), dst, layout)
+        else:
+            argv = rbdlayout.rbd_args(layout or {})
+            self.rbd('clone', *(argv + [self.get(size), dst]))
+        return 'clone'
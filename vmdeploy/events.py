@@ -0,0 +1,163 @@
+# Structured event log of a deploy.
+#
+# Every stage of a deploy (mkdir, xml, template, copy, resize, mount, ...)
+# is timed by a monotonic clock and written as one JSON object per line to
+# 'events.jsonl' in 'vmcreatelogdir', which is shared by all deploys of the
+# host so the time of many deploys can be compared:
+#
+#   {"event": "stage", "host": "kvm01", "seconds": 12.345,
+#    "stage": "copy", "status": "ok", "taskid": "539658",
+#    "time": 1514736000.0, "vmname": "vm1"}
+#
+# A 'deploy' event with status 'start' is written when a deploy begins and
+# one with the final status ('ok' or 'failed') and its total seconds when
+# it ends. Stages still running when the deploy ends are logged as failed.
+
+import os
+import sys
+import json
+import time
+import ctypes
+import socket
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# clock_gettime(CLOCK_MONOTONIC) of glibc for python without
+# time.monotonic.
+def _libc_monotonic():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        t = timespec()
+        if func(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = _libc_monotonic() or time.time
+
+
+class EventLog(object):
+
+    def __init__(self, path, taskid, vmname):
+        # Nothing is written if path is None.
+        self.path = path
+        self.taskid = taskid
+        self.vmname = vmname
+        self.host = socket.gethostname()
+        self.lock = threading.Lock()
+        # Start of running stages.
+        self.running = {}
+        # (name, seconds, status) of finished stages.
+        self.stages = []
+        self.start = monotonic()
+        self.closed = False
+
+    def emit(self, event, **fields):
+        if self.path is None:
+            return
+        record = {
+            'event': event, 'taskid': self.taskid, 'vmname': self.vmname,
+            'host': self.host, 'time': time.time()}
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            try:
+                # One write per event, lines of concurrent deploys do not
+                # interleave.
+                fd = os.open(
+                    self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line.encode('utf-8'))
+                finally:
+                    os.close(fd)
+            except (IOError, OSError):
+                logger.warn("Failed to write event log " + self.path + ". "
+                            + str(sys.exc_info()[1]))
+
+    def begin(self, stage):
+        with self.lock:
+            self.running[stage] = monotonic()
+
+    # Finish 'stage' and return its seconds, extra fields are added to its
+    # event.
+    def end(self, stage, status='ok', **fields):
+        with self.lock:
+            start = self.running.pop(stage, None)
+            if start is None:
+                return None
+            seconds = monotonic() - start
+            self.stages.append((stage, seconds, status))
+        self.emit('stage', stage=stage, status=status,
+                  seconds=round(seconds, 3), **fields)
+        return seconds
+
+    # Time the block as 'stage', it fails if the block raises:
+    #
+    #   with eventlog.stage('copy'):
+    #       ...
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        except BaseException:
+            self.end(name, 'failed', error=str(sys.exc_info()[1]))
+            raise
+        self.end(name)
+
+    # Stages finished so far, the slowest first.
+    def slowest(self, count=5):
+        with self.lock:
+            stages = list(self.stages)
+        stages.sort(key=lambda s: s[1], reverse=True)
+        return stages[:count]
+
+    def summary_str(self, count=5):
+        lines = ["{0:<16s}{1:>10s}  {2}".format(
+            "Stage:", "Seconds:", "Status:")]
+        for name, seconds, status in self.slowest(count):
+            lines.append("{0:<16s}{1:>10.3f}  {2}".format(
+                name, seconds, status))
+        lines.append("{0:<16s}{1:>10.3f}".format(
+            "total", monotonic() - self.start))
+        return "\n".join(lines)
+
+    # End the deploy. Its status is 'failed' if a stage failed or is still
+    # running (the deploy exited in the middle of it).
+    def close(self, status=None):
+        if self.closed:
+            return
+        self.closed = True
+        for name in list(self.running):
+            self.end(name, 'failed')
+        if status is None:
+            failed = [s for s in self.stages if s[2] != 'ok']
+            status = 'failed' if failed else 'ok'
+        self.emit('deploy', status=status,
+                  seconds=round(monotonic() - self.start, 3))
+
+
+# Event log which writes nothing, for callers without one.
+def null():
+    return EventLog(None, None, None)
@@ -0,0 +1,378 @@
+# Flattening of the rbd clones of the ceph deploys.
+#
+# The sys disk of a ceph vm is a clone of the snapshot of its template
+# ('rbd/vm.rbd@vm.rbd.snap'), a formatted data disk a clone of
+# '<pool>/datadisk-xfs-<size>G.rbd@formatted'. The reads of a clone fall
+# through to its parent for every object it has not written yet, and the
+# snapshot can not be unprotected (and the template not be replaced) while
+# it has clones. Flattening copies the data of the parent into the clone,
+# which then stands alone.
+#
+# Every deploy records its clones in '<vmdeploypath>/.rbd-lineage.json',
+# changed under the lock '<vmdeploypath>/.rbd-lineage.lock':
+#
+#   {"images": {"rbd/vm1.rbd": {"vm": "vm1",
+#                               "parent": "rbd/vm.rbd@vm.rbd.snap",
+#                               "created": <time>, "flattened": null}},
+#    "parents": ["rbd/vm.rbd@vm.rbd.snap"]}
+#
+# The clones of a vm whose directory is gone are forgotten, their parents
+# are kept until the parent is removed from the cluster. The lineage is
+# rebuilt from the rbd disks of the vms' xml when it is missing, or by
+#
+#   python -m vmdeploy.flatten --path <vmdeploypath> rebuild
+#
+# The scheduler runs in the background,
+#
+#   python -m vmdeploy.flatten --path <vmdeploypath> run --budget 50
+#
+# and every '--interval' seconds flattens the clones older than '--min-age'
+# hours:
+#
+#   - the clones with the highest score first, the age in days plus
+#     '--read-weight' per MiB/s read from the image, so the vms reading the
+#     most through their parent and the oldest ones go first;
+#   - one at a time, the copies make at most '--budget' MiB/s on average
+#     (the size of each clone over its time, a clone of a big image waits
+#     longer before the next one starts);
+#   - none while the client io of the cluster is over '--max-load' MiB/s,
+#     the pass stops and the rest waits for the next.
+#
+#   python -m vmdeploy.flatten --path <vmdeploypath> report
+#
+# shows the parents of the clones ever recorded with their clones left,
+# those with none can be unprotected ('rbd snap unprotect'). '--cluster
+# local:<file>' runs all of it on a json file instead of the cluster (see
+# vmdeploy.cephrbd.LocalCluster).
+
+import os
+import sys
+import time
+import logging
+import argparse
+import contextlib
+from xml.etree import ElementTree
+
+from vmdeploy import conf
+from vmdeploy import cephrbd
+from vmdeploy import util
+
+logger = logging.getLogger(__name__)
+
+STATEFILE = '.rbd-lineage.json'
+LOCKFILE = '.rbd-lineage.lock'
+
+MiB = 1024 ** 2
+
+
+class Lineage(object):
+
+    def __init__(self, deploypath):
+        self.deploypath = deploypath
+        # {image: record}, a record is a dict with 'vm', 'parent' (the
+        # snapshot it was cloned from), 'created' and 'flattened' (times, or
+        # None).
+        self.images = {}
+        # Snapshots the recorded clones were cloned from, the clones of
+        # removed vms included.
+        self.parents = set()
+
+    def statefile(self):
+        return os.path.join(self.deploypath, STATEFILE)
+
+    def lockfile(self):
+        return os.path.join(self.deploypath, LOCKFILE)
+
+    # Load the state under the lock and save it when the block exits
+    # without error. 'cluster' rebuilds a missing state.
+    @contextlib.contextmanager
+    def locked(self, cluster=None):
+        with util.flocked(self.lockfile()):
+            self.load(cluster)
+            yield self
+            self.save()
+
+    def load(self, cluster=None):
+        state = util.load_state(self.statefile())
+        if state is None:
+            self.images = {}
+            self.parents = set()
+            if cluster is not None:
+                logger.debug("Rebuild the rbd lineage of "
+                             + self.deploypath + ".")
+                self.rebuild(cluster)
+            return
+        self.images = state.get('images', {})
+        self.parents = set(state.get('parents', []))
+        self.parents.update(
+            record['parent'] for record in self.images.values())
+        # Vms removed by hand take their clones with them.
+        for image, record in list(self.images.items()):
+            if not os.path.isdir(os.path.join(self.deploypath, record['vm'])):
+                del self.images[image]
+
+    def save(self):
+        util.save_state(self.statefile(), {'images': self.images,
+                                           'parents': sorted(self.parents)})
+
+    # Record the clone 'image' of 'parent' made for 'vmname'.
+    def add(self, image, parent, vmname, created=None):
+        self.parents.add(parent)
+        self.images[image] = {
+            'vm': vmname, 'parent': parent, 'flattened': None,
+            'created': time.time() if created is None else created}
+
+    # Rebuild the state from the rbd disks of the vms' xml under
+    # 'deploypath', asking 'cluster' for their parents. The age of a clone
+    # is the age of its xml.
+    def rebuild(self, cluster):
+        self.images = {}
+        for vmname in sorted(os.listdir(self.deploypath)):
+            xmlfile = os.path.join(self.deploypath, vmname, vmname + '.xml')
+            if vmname.startswith('.') or not os.path.isfile(xmlfile):
+                continue
+            try:
+                tree = ElementTree.parse(xmlfile)
+            except ElementTree.ParseError:
+                logger.warn("Invalid xml " + xmlfile + ".")
+                continue
+            for x_source in tree.findall('devices/disk/source'):
+                image = x_source.get('name')
+                if x_source.get('protocol') != 'rbd' or not image:
+                    continue
+                try:
+                    parent = cluster.parent(image)
+                except cephrbd.CephError:
+                    logger.warn(str(sys.exc_info()[1]))
+                    continue
+                if parent is not None:
+                    self.add(image, parent, vmname,
+                             os.path.getmtime(xmlfile))
+
+    def flattened(self, image, when=None):
+        self.images[image]['flattened'] = (
+            time.time() if when is None else when)
+
+    # Clones not flattened yet which are older than 'min_age' seconds.
+    def pending(self, now, min_age=0):
+        return dict((image, dict(record))
+                    for image, record in self.images.items()
+                    if record['flattened'] is None
+                    and now - record['created'] >= min_age)
+
+
+# Score of the clone 'record' read at 'read_rate' bytes per second, the
+# clones with the highest are flattened first.
+def score(record, now, read_rate=0, read_weight=1.0):
+    age_days = max(0, now - record['created']) / 86400.0
+    return age_days + read_weight * read_rate / float(MiB)
+
+
+class Scheduler(object):
+
+    def __init__(self, lineage, cluster, budget=50 * MiB, max_load=None,
+                 min_age=0, read_weight=1.0, clock=time.time,
+                 sleep=time.sleep):
+        self.lineage = lineage
+        self.cluster = cluster
+        # Bytes per second.
+        self.budget = budget
+        self.max_load = max_load
+        # Seconds.
+        self.min_age = min_age
+        self.read_weight = read_weight
+        self.clock = clock
+        self.sleep = sleep
+        # When the budget allows the next flatten.
+        self.next_time = 0
+
+    # Clones to flatten, with the highest score first.
+    def queue(self):
+        now = self.clock()
+        with self.lineage.locked(self.cluster):
+            pending = self.lineage.pending(now, self.min_age)
+        rates = {}
+        for pool in set(cephrbd.split_spec(image)[0] for image in pending):
+            try:
+                rates.update(self.cluster.read_rates(pool))
+            except cephrbd.CephError:
+                logger.debug(str(sys.exc_info()[1]))
+        return sorted(pending, key=lambda image: (-score(
+            pending[image], now, rates.get(image, 0), self.read_weight),
+            image))
+
+    def busy(self):
+        if self.max_load is None:
+            return False
+        load = self.cluster.load()
+        if load > self.max_load:
+            logger.debug("The client io of the cluster is {0:.1f} MiB/s, "
+                         "over {1:.1f} MiB/s.".format(
+                             load / float(MiB), self.max_load / float(MiB)))
+            return True
+        return False
+
+    # Flatten the clone 'image', after waiting for the budget. Return the
+    # bytes copied.
+    def flatten(self, image):
+        if self.cluster.parent(image) is None:
+            # Flattened by hand.
+            return 0
+        size = self.cluster.size(image)
+        wait = self.next_time - self.clock()
+        if wait > 0:
+            self.sleep(wait)
+        start = self.clock()
+        self.cluster.flatten(image)
+        self.next_time = start + size / float(self.budget)
+        return size
+
+    # Flatten the clones in order until the cluster is busy. Return the
+    # clones flattened, 'dry_run' only returns what would be.
+    def run_once(self, dry_run=False):
+        done = []
+        for image in self.queue():
+            if dry_run:
+                done.append(image)
+                continue
+            try:
+                if self.busy():
+                    break
+                if not self.cluster.exists(image):
+                    logger.debug("Image " + image + " is gone.")
+                    size = None
+                else:
+                    size = self.flatten(image)
+            except cephrbd.CephError:
+                logger.warn("Failed to flatten " + image + ". "
+                            + str(sys.exc_info()[1]))
+                continue
+            with self.lineage.locked(self.cluster):
+                if image not in self.lineage.images:
+                    continue
+                if size is None:
+                    del self.lineage.images[image]
+                    continue
+                self.lineage.flattened(image, self.clock())
+            logger.debug("Suceeded to flatten {0}, {1} MiB.".format(
+                image, size // MiB))
+            done.append(image)
+        return done
+
+    def run(self, interval, dry_run=False):
+        while True:
+            self.run_once(dry_run)
+            self.sleep(interval)
+
+
+# The parents ever recorded in 'lineage' with the clones they have left,
+# [(parent, children)], a parent without children can be unprotected.
+# Parents removed from the cluster are forgotten, call it under
+# lineage.locked() to keep that.
+def report(lineage, cluster):
+    result = []
+    for parent in sorted(lineage.parents):
+        try:
+            if not cluster.exists(parent):
+                lineage.parents.discard(parent)
+                continue
+            children = cluster.children(parent)
+        except cephrbd.CephError:
+            logger.warn(str(sys.exc_info()[1]))
+            continue
+        result.append((parent, children))
+    return result
+
+
+def report_str(result):
+    lines = ["{0:<48s}{1:<10s}{2}".format("Parent:", "Clones:", "")]
+    for parent, children in result:
+        lines.append("{0:<48s}{1:<10d}{2}".format(
+            parent, len(children),
+            "can be unprotected" if not children else ""))
+    return "\n".join(line.rstrip() for line in lines)
+
+
+# 'local:<file>' is a stand-in of the cluster, otherwise the ceph options of
+# 'args'.
+def make_cluster(args):
+    if args.cluster and args.cluster.startswith('local:'):
+        return cephrbd.LocalCluster(args.cluster[len('local:'):])
+    return cephrbd.connect(args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Flatten the rbd clones of the ceph deploys')
+    parser.add_argument('--path', dest='vmdeploypath', required=True)
+    parser.add_argument(
+        '--conf', help="configuration file of the ceph options. "
+        "(Default: %(default)s)", dest='conf_file', default='deploy-vm.conf')
+    parser.add_argument(
+        '--cluster', help="'local:<file>' for a json stand-in of the "
+        "cluster.", dest='cluster')
+    parser.add_argument(
+        '--budget', help="MiB/s copied on average. (Default: %(default)s)",
+        dest='budget', type=float, default=50)
+    parser.add_argument(
+        '--max-load', help="client io of the cluster in MiB/s over which "
+        "nothing is flattened.", dest='max_load', type=float)
+    parser.add_argument(
+        '--min-age', help="hours a clone lives before it is flattened. "
+        "(Default: %(default)s)", dest='min_age', type=float, default=24)
+    parser.add_argument(
+        '--read-weight', help="score of 1 MiB/s read, against 1 day of "
+        "age. (Default: %(default)s)", dest='read_weight', type=float,
+        default=1.0)
+    parser.add_argument(
+        '--interval', help="seconds between the passes. "
+        "(Default: %(default)s)", dest='interval', type=float, default=600)
+    parser.add_argument(
+        '--once', help="run one pass and exit.", dest='once',
+        action='store_true', default=False)
+    parser.add_argument(
+        '--dry-run', help="show the clones in order, flatten nothing.",
+        dest='dry_run', action='store_true', default=False)
+    parser.add_argument('action', choices=['run', 'report', 'rebuild'])
+    args = parser.parse_args(argv)
+
+    defaults = conf.read_defaults(args.conf_file)
+    for name in ('cephconf', 'cephuser', 'cephmons'):
+        setattr(args, name, defaults.get(name))
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(process)d] [%(levelname)-5.5s]  %(message)s")
+
+    lineage = Lineage(args.vmdeploypath)
+    cluster = make_cluster(args)
+    try:
+        if args.action == 'rebuild':
+            with lineage.locked():
+                lineage.rebuild(cluster)
+            print("Recorded {0} clones.".format(len(lineage.images)))
+        elif args.action == 'report':
+            with lineage.locked(cluster):
+                result = report(lineage, cluster)
+            print(report_str(result))
+        else:
+            scheduler = Scheduler(
+                lineage, cluster, budget=args.budget * MiB,
+                max_load=None if args.max_load is None
+                else args.max_load * MiB,
+                min_age=args.min_age * 3600, read_weight=args.read_weight)
+            if args.once or args.dry_run:
+                for image in scheduler.run_once(args.dry_run):
+                    print(image)
+            else:
+                scheduler.run(args.interval)
+    except cephrbd.CephError:
+        logger.error(str(sys.exc_info()[1]))
+        return 1
+    finally:
+        cluster.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,348 @@
+# Inventory of the domains of this host and their overcommit.
+#
+#   python -m vmdeploy.inventory --path ./vmimages
+#   python -m vmdeploy.inventory --libvirt qemu:///system
+#
+# The domains are read from the '<vmdeploypath>/<vm>/<vm>.xml' files of the
+# deploy scripts, or from libvirt over a single connection (the 'libvirt'
+# python binding is needed then). Parsed domains are cached in
+# '<vmdeploypath>/.inventory.json' (or '--cache'), keyed by the mtime and
+# size of the xml file, a domain of libvirt by the mtime of its persistent
+# config under /etc/libvirt/qemu: a rerun only parses the changed domains.
+#
+# The report has the totals of memory, current/max vcpus and apparent
+# (virtual size) vs allocated (blocks on the host) size of the file disks,
+# with their ratio to the memory, cpus and file system of the host, and the
+# same totals per bridge (a vm with interfaces on two bridges counts in
+# both).
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+from xml.etree import ElementTree
+
+CACHEFILE = '.inventory.json'
+LIBVIRT_QEMU_DIR = '/etc/libvirt/qemu'
+
+# Bytes of the units of libvirt, KiB when there is no unit.
+UNITS = {
+    'b': 1, 'bytes': 1,
+    'KB': 1000, 'k': 1024, 'KiB': 1024,
+    'MB': 1000 ** 2, 'M': 1024 ** 2, 'MiB': 1024 ** 2,
+    'GB': 1000 ** 3, 'G': 1024 ** 3, 'GiB': 1024 ** 3,
+    'TB': 1000 ** 4, 'T': 1024 ** 4, 'TiB': 1024 ** 4,
+}
+
+
+def to_bytes(element):
+    if element is None or not element.text:
+        return 0
+    return int(element.text.strip()) * UNITS[element.get('unit', 'KiB')]
+
+
+# Return the resources of the domain xml 'text' as a dict.
+def parse_domain(text):
+    root = ElementTree.fromstring(text)
+    memory = to_bytes(root.find('memory'))
+    current_memory = to_bytes(root.find('currentMemory')) or memory
+    x_vcpu = root.find('vcpu')
+    vcpus = int(x_vcpu.text.strip()) if x_vcpu is not None else 1
+    current_vcpus = int(x_vcpu.get('current', vcpus)) \
+        if x_vcpu is not None else vcpus
+
+    disks = []
+    for x_disk in root.findall('devices/disk'):
+        if x_disk.get('device', 'disk') != 'disk':
+            continue
+        x_source = x_disk.find('source')
+        if x_source is None:
+            continue
+        if x_source.get('file'):
+            disks.append({'type': 'file', 'source': x_source.get('file')})
+        elif x_source.get('dev'):
+            disks.append({'type': 'block', 'source': x_source.get('dev')})
+        elif x_source.get('name'):
+            disks.append({'type': x_source.get('protocol', 'network'),
+                          'source': x_source.get('name')})
+
+    bridges = []
+    for x_interface in root.findall('devices/interface'):
+        x_source = x_interface.find('source')
+        if x_source is not None and x_source.get('bridge'):
+            bridges.append(x_source.get('bridge'))
+        elif x_source is not None and x_source.get('network'):
+            bridges.append('network:' + x_source.get('network'))
+        elif x_source is not None and x_source.get('dev'):
+            # macvtap on a host nic.
+            bridges.append('direct:' + x_source.get('dev'))
+
+    return {
+        'name': root.findtext('name'), 'uuid': root.findtext('uuid'),
+        'memory': memory, 'current_memory': current_memory,
+        'vcpus': vcpus, 'current_vcpus': current_vcpus,
+        'disks': disks, 'bridges': bridges}
+
+
+class Cache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        if not path:
+            return
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    # Return the domain cached as 'key' with 'stamp', or parse it by
+    # 'read()' which returns its xml.
+    def get(self, key, stamp, read):
+        entry = self.entries.get(key)
+        if entry is not None and stamp is not None \
+                and entry['stamp'] == stamp:
+            self.hits += 1
+            return entry['domain']
+        self.misses += 1
+        domain = parse_domain(read())
+        self.entries[key] = {'stamp': stamp, 'domain': domain}
+        self.changed = True
+        return domain
+
+    # Drop the domains which are gone, and write the cache if it changed.
+    def save(self, keys):
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+                self.changed = True
+        if not self.changed or not self.path:
+            return
+        try:
+            fd, tmpfile = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=os.path.basename(self.path) + '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError):
+            # The report does not need the cache.
+            pass
+
+
+def read_file(path):
+    def read():
+        with open(path) as f:
+            return f.read()
+    return read
+
+
+# Domains of the xml files under 'vmdeploypath'.
+def scan_deploypath(vmdeploypath, cache):
+    domains = []
+    keys = set()
+    for vmname in sorted(os.listdir(vmdeploypath)):
+        if vmname.startswith('.'):
+            continue
+        xmlfile = os.path.join(vmdeploypath, vmname, vmname + '.xml')
+        try:
+            st = os.stat(xmlfile)
+        except OSError:
+            continue
+        keys.add(xmlfile)
+        try:
+            domain = cache.get(
+                xmlfile, [st.st_mtime, st.st_size], read_file(xmlfile))
+        except (ElementTree.ParseError, ValueError, KeyError):
+            sys.stderr.write("Invalid xml " + xmlfile + ".\n")
+            continue
+        domain = dict(domain, active=None)
+        domains.append(domain)
+    cache.save(keys)
+    return domains
+
+
+# Domains of libvirt at 'uri', over one connection.
+def scan_libvirt(uri, cache):
+    import libvirt
+
+    conn = libvirt.openReadOnly(uri)
+    try:
+        domains = []
+        keys = set()
+        for dom in conn.listAllDomains():
+            key = 'libvirt:' + dom.UUIDString()
+            keys.add(key)
+            # The persistent config of the domain changes with it.
+            try:
+                st = os.stat(os.path.join(
+                    LIBVIRT_QEMU_DIR, dom.name() + '.xml'))
+                stamp = [st.st_mtime, st.st_size]
+            except OSError:
+                stamp = None
+            domain = cache.get(key, stamp, lambda: dom.XMLDesc(
+                libvirt.VIR_DOMAIN_XML_INACTIVE))
+            domain = dict(domain, active=bool(dom.isActive()))
+            domains.append(domain)
+        hostname = conn.getHostname()
+    finally:
+        conn.close()
+    cache.save(keys)
+    return hostname, domains
+
+
+def new_totals():
+    return {'vms': 0, 'memory': 0, 'current_memory': 0, 'vcpus': 0,
+            'current_vcpus': 0, 'apparent': 0, 'allocated': 0}
+
+
+def add_domain(totals, domain, disk_sizes):
+    totals['vms'] += 1
+    for key in ('memory', 'current_memory', 'vcpus', 'current_vcpus'):
+        totals[key] += domain[key]
+    for disk in domain['disks']:
+        apparent, allocated = disk_sizes.get(disk['source'], (0, 0))
+        totals['apparent'] += apparent
+        totals['allocated'] += allocated
+
+
+# Apparent and allocated size of the file disks, stat only.
+def stat_disks(domains):
+    sizes = {}
+    for domain in domains:
+        for disk in domain['disks']:
+            if disk['type'] != 'file' or disk['source'] in sizes:
+                continue
+            try:
+                st = os.stat(disk['source'])
+            except OSError:
+                continue
+            sizes[disk['source']] = (st.st_size, st.st_blocks * 512)
+    return sizes
+
+
+def host_resources(vmdeploypath=None):
+    memory = 0
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    memory = int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    disk = 0
+    if vmdeploypath:
+        st = os.statvfs(vmdeploypath)
+        disk = st.f_blocks * st.f_frsize
+    return {'memory': memory, 'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+            'disk': disk}
+
+
+def report(hostname, domains, host):
+    disk_sizes = stat_disks(domains)
+    totals = new_totals()
+    bridges = {}
+    for domain in domains:
+        add_domain(totals, domain, disk_sizes)
+        for bridge in set(domain['bridges']):
+            add_domain(bridges.setdefault(bridge, new_totals()), domain,
+                       disk_sizes)
+    return {'host': hostname, 'resources': host, 'totals': totals,
+            'bridges': bridges}
+
+
+def ratio(value, total):
+    return value / float(total) if total else 0.0
+
+
+def gib(value):
+    return value / 1024.0 ** 3
+
+
+def report_str(result):
+    host = result['resources']
+    totals = result['totals']
+    lines = [
+        "Host {0}: {1} vms, memory {2:.1f}GB, {3} cpus, disk {4:.1f}GB".format(
+            result['host'], totals['vms'], gib(host['memory']), host['cpus'],
+            gib(host['disk'])),
+        "{0:<16s}{1:>12s}{2:>12s}{3:>10s}".format(
+            "Resource:", "Current:", "Max:", "Ratio:"),
+        "{0:<16s}{1:>10.1f}GB{2:>10.1f}GB{3:>10.2f}".format(
+            "memory", gib(totals['current_memory']), gib(totals['memory']),
+            ratio(totals['memory'], host['memory'])),
+        "{0:<16s}{1:>12d}{2:>12d}{3:>10.2f}".format(
+            "vcpus", totals['current_vcpus'], totals['vcpus'],
+            ratio(totals['vcpus'], host['cpus'])),
+        "{0:<16s}{1:>10.1f}GB{2:>10.1f}GB{3:>10.2f}".format(
+            "disk", gib(totals['allocated']), gib(totals['apparent']),
+            ratio(totals['apparent'], host['disk'])),
+        "",
+        "{0:<16s}{1:>6s}{2:>12s}{3:>12s}{4:>12s}{5:>12s}".format(
+            "Bridge:", "VMs:", "Memory:", "VCPUs:", "Apparent:",
+            "Allocated:")]
+    for bridge in sorted(result['bridges']):
+        t = result['bridges'][bridge]
+        lines.append(
+            "{0:<16s}{1:>6d}{2:>10.1f}GB{3:>5d}/{4:<6d}{5:>10.1f}GB"
+            "{6:>10.1f}GB".format(
+                bridge, t['vms'], gib(t['memory']), t['current_vcpus'],
+                t['vcpus'], gib(t['apparent']), gib(t['allocated'])))
+    lines.append("")
+    lines.append("Ratio is max memory, max vcpus and apparent disk to "
+                 "the host.")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report the domains of this host and their overcommit')
+    parser.add_argument(
+        '--path', help="vmdeploypath of the deploy scripts, its "
+        "'<vm>/<vm>.xml' are read.", dest='vmdeploypath')
+    parser.add_argument(
+        '--libvirt', help="read the domains from libvirt at this uri "
+        "instead, like 'qemu:///system'.", dest='uri')
+    parser.add_argument(
+        '--cache', help="cache file of the parsed domains. "
+        "(Default: '<vmdeploypath>/" + CACHEFILE + "')", dest='cache_file')
+    parser.add_argument(
+        '--json', help="print the report as json.", dest='json',
+        action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    if not args.vmdeploypath and not args.uri:
+        parser.error("one of '--path' and '--libvirt' is required")
+    cache_file = args.cache_file
+    if not cache_file and args.vmdeploypath:
+        cache_file = os.path.join(args.vmdeploypath, CACHEFILE)
+    cache = Cache(cache_file)
+
+    if args.uri:
+        try:
+            hostname, domains = scan_libvirt(args.uri, cache)
+        except ImportError:
+            print("The libvirt python binding is needed by '--libvirt'.")
+            return 1
+    else:
+        hostname, domains = socket.gethostname(), scan_deploypath(
+            args.vmdeploypath, cache)
+
+    result = report(hostname, domains, host_resources(args.vmdeploypath))
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print(report_str(result))
+        print("{0} domains, {1} parsed, {2} from cache.".format(
+            len(domains), cache.misses, cache.hits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
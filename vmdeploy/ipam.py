@@ -0,0 +1,384 @@
+# IP address management of the bridges.
+#
+# Every bridge has a pool, the subnet its vms get addresses from. Pools are
+# set by 'ippool' of deploy-vm.conf
+#
+#   ippool = virbr1/172.18.28.0/24,br0/10.0.0.0/16
+#
+# or learned from the first address given on a bridge without pool
+# ('br1/192.168.1.5/24' makes the pool 192.168.1.0/24 of br1). The used
+# addresses of a pool are a bitmap of its subnet, one bit per address,
+# kept with the vm owning each address in '<vmdeploypath>/.ipam.json'.
+#
+#   - '--net br0/auto' takes the next free address of br0's pool, from a
+#     cursor which moves on after each allocation, so full bytes of the
+#     bitmap are skipped and the search stays short;
+#   - a given address is checked against the pool, an address outside the
+#     pool of its bridge or used by another vm is a conflict;
+#   - the network, broadcast, gateway and name server addresses are never
+#     given;
+#   - the addresses of a vm whose directory is gone are free again.
+#
+# The state is changed under the lock '<vmdeploypath>/.ipam.lock', by one
+# deploy at a time. Each deploy keeps the 'ifcfg-eth<N>' files of its
+# interfaces in its vm directory, the state is rebuilt from them (and the
+# bridges of the vms' xml) when it is missing, or by
+#
+#   python -m vmdeploy.ipam --path <vmdeploypath> rebuild
+
+import os
+import sys
+import zlib
+import base64
+import logging
+import argparse
+import contextlib
+from xml.etree import ElementTree
+
+import netaddr
+
+from vmdeploy import util
+
+logger = logging.getLogger(__name__)
+
+STATEFILE = '.ipam.json'
+LOCKFILE = '.ipam.lock'
+
+
+class IPAMError(Exception):
+    pass
+
+
+# Parse 'ippool' of deploy-vm.conf, return {bridge: network}.
+def parse_pools(value):
+    pools = {}
+    if not value:
+        return pools
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            bridge, network = item.split('/', 1)
+            pools[bridge] = str(netaddr.IPNetwork(network).cidr)
+        except (ValueError, netaddr.AddrFormatError):
+            raise IPAMError("Invalid ip pool '" + item + "', the format is "
+                            "'<bridge>/<network>/<prefixlen>'.")
+    return pools
+
+
+class Pool(object):
+
+    def __init__(self, network, bitmap=None, cursor=0):
+        self.network = netaddr.IPNetwork(network).cidr
+        self.size = self.network.size
+        if bitmap is None:
+            bitmap = bytearray((self.size + 7) // 8)
+        self.bitmap = bitmap
+        # Where the search of the next free address starts.
+        self.cursor = cursor
+
+    def index(self, ip):
+        ip = netaddr.IPAddress(ip)
+        if ip not in self.network:
+            raise IPAMError(str(ip) + " is not in " + str(self.network))
+        return int(ip) - self.network.first
+
+    def address(self, index):
+        return netaddr.IPAddress(self.network.first + index)
+
+    def used(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def use(self, index):
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+
+    def free(self, index):
+        self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    # Addresses of the subnet no vm gets.
+    def reserved(self, others=()):
+        reserved = set()
+        if self.size > 2:
+            reserved.update([0, self.size - 1])
+        for ip in others:
+            try:
+                reserved.add(self.index(ip))
+            except (IPAMError, ValueError, netaddr.AddrFormatError):
+                continue
+        return reserved
+
+    # Index of the next free address which is not in 'reserved'.
+    def next_free(self, reserved=()):
+        nbytes = len(self.bitmap)
+        start = self.cursor >> 3
+        for step in range(nbytes + 1):
+            byte = (start + step) % nbytes
+            if self.bitmap[byte] == 0xff:
+                continue
+            for bit in range(8):
+                index = byte * 8 + bit
+                if index >= self.size:
+                    break
+                if step == 0 and index < self.cursor:
+                    continue
+                if not self.used(index) and index not in reserved:
+                    self.cursor = (index + 1) % self.size
+                    return index
+        raise IPAMError("No free address in " + str(self.network))
+
+    def to_dict(self):
+        return {
+            'network': str(self.network),
+            'cursor': self.cursor,
+            'bitmap': base64.b64encode(
+                zlib.compress(bytes(self.bitmap))).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        bitmap = bytearray(zlib.decompress(base64.b64decode(data['bitmap'])))
+        return cls(data['network'], bitmap, data.get('cursor', 0))
+
+
+# Read a file of KEY=VALUE lines, like ifcfg-eth0.
+def read_keyvalues(path):
+    values = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                values[key.strip()] = value.strip().strip('"\'')
+    return values
+
+
+# Keep the addresses of a vm as 'ifcfg-eth<N>' files in its directory, for
+# rebuilding the state.
+def write_ifcfg(vmdir, vmnet):
+    for index, netitem in enumerate(vmnet):
+        fields = netitem.split('/')
+        content = "DEVICE=eth{0}\nBRIDGE={1}\n".format(index, fields[0])
+        if len(fields) >= 3 and fields[1] and fields[2]:
+            network = netaddr.IPNetwork(fields[1] + '/' + fields[2])
+            content += "IPADDR={0}\nPREFIX={1}\n".format(
+                network.ip, network.prefixlen)
+        with open(os.path.join(vmdir, 'ifcfg-eth' + str(index)), 'w') as f:
+            f.write(content)
+
+
+class IPAM(object):
+
+    def __init__(self, deploypath, pools=None):
+        self.deploypath = deploypath
+        # Configured pools, {bridge: network}.
+        self.config = pools or {}
+        self.pools = {}
+        # {bridge: {address: vmname}}
+        self.owners = {}
+
+    def statefile(self):
+        return os.path.join(self.deploypath, STATEFILE)
+
+    def lockfile(self):
+        return os.path.join(self.deploypath, LOCKFILE)
+
+    # Load the state under the lock and save it when the block exits
+    # without error:
+    #
+    #   with vmipam.locked():
+    #       vmnet = vmipam.allocate(...)
+    @contextlib.contextmanager
+    def locked(self):
+        with util.flocked(self.lockfile()):
+            self.load()
+            yield self
+            self.save()
+
+    def load(self):
+        self.pools = {}
+        self.owners = {}
+        state = util.load_state(self.statefile())
+        if state is None:
+            logger.debug("Rebuild the ip address state of "
+                         + self.deploypath + ".")
+            self.rebuild()
+            return
+        for bridge, data in state.get('pools', {}).items():
+            self.pools[bridge] = Pool.from_dict(data)
+            self.owners[bridge] = data.get('owners', {})
+        self.apply_config()
+        # Vms removed by hand give their addresses back.
+        vmnames = set()
+        for owners in self.owners.values():
+            vmnames.update(owners.values())
+        for vmname in vmnames:
+            if not os.path.isdir(os.path.join(self.deploypath, vmname)):
+                self.release(vmname)
+
+    def save(self):
+        state = {'pools': {}}
+        for bridge, pool in self.pools.items():
+            data = pool.to_dict()
+            data['owners'] = self.owners.get(bridge, {})
+            state['pools'][bridge] = data
+        util.save_state(self.statefile(), state)
+
+    # Make the pools match the configured networks, the addresses of a
+    # changed pool are marked again in its new bitmap.
+    def apply_config(self):
+        for bridge, network in self.config.items():
+            pool = self.pools.get(bridge)
+            if pool is not None and str(pool.network) == network:
+                continue
+            self.pools[bridge] = Pool(network)
+            owners = self.owners.get(bridge, {})
+            self.owners[bridge] = {}
+            for ip, vmname in owners.items():
+                self.mark(bridge, ip, vmname)
+
+    # Mark 'ip' as used by 'vmname', a learned pool is created for a
+    # bridge without pool. Return False if it is outside the pool.
+    def mark(self, bridge, ip, vmname, network=None):
+        pool = self.pools.get(bridge)
+        if pool is None:
+            if network is None:
+                return False
+            pool = self.pools[bridge] = Pool(network)
+        try:
+            index = pool.index(ip)
+        except IPAMError:
+            return False
+        pool.use(index)
+        self.owners.setdefault(bridge, {})[str(pool.address(index))] = vmname
+        return True
+
+    # Rebuild the state from the vm directories under 'deploypath'.
+    def rebuild(self):
+        self.pools = {}
+        self.owners = {}
+        self.apply_config()
+        for vmname in sorted(os.listdir(self.deploypath)):
+            vmdir = os.path.join(self.deploypath, vmname)
+            # Dot directories are not vms (warm pool, ...).
+            if vmname.startswith('.') or not os.path.isdir(vmdir):
+                continue
+            bridges = []
+            xmlfile = os.path.join(vmdir, vmname + '.xml')
+            if os.path.isfile(xmlfile):
+                try:
+                    # The bridge, or the host nic of a macvtap interface.
+                    for interface in ElementTree.parse(xmlfile).iter(
+                            'interface'):
+                        source = interface.find('source')
+                        if source is not None:
+                            bridges.append(
+                                source.get('bridge') or source.get('dev'))
+                except ElementTree.ParseError:
+                    logger.warn("Invalid xml " + xmlfile + ".")
+            for filename in sorted(os.listdir(vmdir)):
+                if not filename.startswith('ifcfg-eth'):
+                    continue
+                values = read_keyvalues(os.path.join(vmdir, filename))
+                ip = values.get('IPADDR')
+                if not ip:
+                    continue
+                bridge = values.get('BRIDGE')
+                if not bridge:
+                    index = int(filename[len('ifcfg-eth'):])
+                    if index >= len(bridges):
+                        continue
+                    bridge = bridges[index]
+                prefix = values.get('PREFIX') or values.get('NETMASK')
+                network = ip + '/' + prefix if prefix else None
+                self.mark(bridge, ip, vmname, network)
+
+    # Give the addresses of 'vmnet' ('<bridge>/<ipaddr>/<netmask>' items,
+    # '<bridge>/auto' for the next free address) to 'vmname'. Return vmnet
+    # with the allocated addresses.
+    def allocate(self, vmname, vmnet, gateway=None, nameservers=()):
+        others = [gateway] if gateway else []
+        others.extend(nameservers or [])
+        result = []
+        for netitem in vmnet:
+            fields = netitem.split('/')
+            bridge = fields[0]
+            if len(fields) == 2 and fields[1] == 'auto':
+                pool = self.pools.get(bridge)
+                if pool is None:
+                    raise IPAMError("No ip pool for bridge " + bridge)
+                index = pool.next_free(pool.reserved(others))
+                ip = pool.address(index)
+                self.mark(bridge, ip, vmname)
+                result.append("{0}/{1}/{2}".format(
+                    bridge, ip, pool.network.prefixlen))
+                continue
+
+            if len(fields) < 3 or not fields[1] or not fields[2]:
+                result.append(netitem)
+                continue
+
+            network = netaddr.IPNetwork(fields[1] + '/' + fields[2])
+            ip = str(network.ip)
+            pool = self.pools.get(bridge)
+            if pool is not None:
+                # Outside the pool it could be neither checked nor kept.
+                if network.ip not in pool.network:
+                    raise IPAMError("{0} on {1} is not in its pool "
+                                    "{2}.".format(ip, bridge, pool.network))
+                index = pool.index(ip)
+                if index in pool.reserved(others):
+                    raise IPAMError(
+                        ip + " on " + bridge + " is a reserved address.")
+                owner = self.owners.get(bridge, {}).get(ip)
+                if pool.used(index) and owner != vmname:
+                    raise IPAMError("{0} on {1} is used by {2}.".format(
+                        ip, bridge, owner))
+            self.mark(bridge, ip, vmname, str(network.cidr))
+            result.append(netitem)
+        return result
+
+    # Give back the addresses of 'vmname'.
+    def release(self, vmname):
+        for bridge, owners in self.owners.items():
+            pool = self.pools.get(bridge)
+            for ip, owner in list(owners.items()):
+                if owner != vmname:
+                    continue
+                del owners[ip]
+                if pool is not None:
+                    try:
+                        pool.free(pool.index(ip))
+                    except IPAMError:
+                        continue
+
+    def summary_str(self):
+        lines = ["{0:<12s}{1:<20s}{2:>8s}{3:>10s}".format(
+            "Bridge:", "Network:", "Used:", "Size:")]
+        for bridge in sorted(self.pools):
+            pool = self.pools[bridge]
+            lines.append("{0:<12s}{1:<20s}{2:>8d}{3:>10d}".format(
+                bridge, str(pool.network), len(self.owners.get(bridge, {})),
+                pool.size))
+        return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Show or rebuild the ip address state of the vms')
+    parser.add_argument('--path', dest='vmdeploypath', required=True)
+    parser.add_argument(
+        '--ippool', dest='ippool', help="pools like "
+        "'virbr1/172.18.28.0/24,br0/10.0.0.0/16'")
+    parser.add_argument('action', choices=['show', 'rebuild'])
+    args = parser.parse_args(argv)
+
+    vmipam = IPAM(args.vmdeploypath, parse_pools(args.ippool))
+    with vmipam.locked():
+        if args.action == 'rebuild':
+            vmipam.rebuild()
+    print(vmipam.summary_str())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
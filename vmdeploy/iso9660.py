@@ -0,0 +1,157 @@
+# Minimal ISO9660 image writer with Joliet names.
+#
+# Only what a cloud-init seed needs: a handful of small files in the root
+# directory of a volume with a given label. The primary volume descriptor
+# carries ISO9660 level 2 names (upper case, '-' mapped to '_'), the Joliet
+# supplementary descriptor carries the real names, which Linux uses when
+# it mounts the image.
+
+import time
+import struct
+
+SECTOR_SIZE = 2048
+
+# Sectors of the layout, 0-15 are the system area.
+PVD_SECTOR = 16
+SVD_SECTOR = 17
+TERMINATOR_SECTOR = 18
+PATH_TABLE_SECTORS = (19, 20, 21, 22)
+ROOT_SECTORS = (23, 24)
+FIRST_FILE_SECTOR = 25
+
+
+def both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def pad(data, size, fill=b' '):
+    data = data[:size]
+    return data + (fill * size)[:size - len(data)]
+
+
+def sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+# 7 bytes date of directory records.
+def dir_datetime(t):
+    tm = time.gmtime(t)
+    return struct.pack(
+        '<BBBBBBb', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday,
+        tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+
+
+# 17 bytes date of volume descriptors.
+def vd_datetime(t):
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(t)).encode('ascii') \
+        + b'\x00'
+
+
+def dir_record(identifier, extent, size, t, is_dir=False):
+    length = 33 + len(identifier)
+    if length % 2:
+        length += 1
+    record = struct.pack('<BB', length, 0) + both32(extent) + both32(size) \
+        + dir_datetime(t) + struct.pack('<BBB', 2 if is_dir else 0, 0, 0) \
+        + both16(1) + struct.pack('<B', len(identifier)) + identifier
+    return pad(record, length, b'\x00')
+
+
+def iso_name(name):
+    name = name.upper().replace('-', '_')
+    if '.' not in name:
+        name += '.'
+    return (name + ';1').encode('ascii')
+
+
+def joliet_name(name):
+    return (name + ';1').encode('utf-16-be')
+
+
+def joliet_text(text, size):
+    data = text.encode('utf-16-be')
+    return pad(data, size, b'\x00 ')
+
+
+def directory(files, extents, self_extent, t, name_func):
+    records = [
+        dir_record(b'\x00', self_extent, SECTOR_SIZE, t, True),
+        dir_record(b'\x01', self_extent, SECTOR_SIZE, t, True)]
+    for name, data in files:
+        records.append(
+            dir_record(name_func(name), extents[name], len(data), t))
+    data = b''.join(records)
+    if len(data) > SECTOR_SIZE:
+        raise ValueError("Too many files for the root directory.")
+    return pad(data, SECTOR_SIZE, b'\x00')
+
+
+def path_table(extent, big_endian):
+    fmt = '>IH' if big_endian else '<IH'
+    return struct.pack('<BB', 1, 0) + struct.pack(fmt, extent, 1) \
+        + b'\x00\x00'
+
+
+def volume_descriptor(joliet, label, total, path_table_sectors,
+                      root_sector, t):
+    if joliet:
+        text = joliet_text
+        # Escape sequence of Joliet level 3.
+        escape = b'%/E'
+    else:
+        def text(value, size):
+            return pad(value.encode('ascii'), size)
+        escape = b''
+
+    root = dir_record(b'\x00', root_sector, SECTOR_SIZE, t, True)
+    vd = struct.pack('<B', 2 if joliet else 1) + b'CD001' + b'\x01\x00' \
+        + text('LINUX', 32) + text(label, 32) + b'\x00' * 8 \
+        + both32(total) + pad(escape, 32, b'\x00') \
+        + both16(1) + both16(1) + both16(SECTOR_SIZE) \
+        + both32(len(path_table(0, False))) \
+        + struct.pack('<I', path_table_sectors[0]) + b'\x00' * 4 \
+        + struct.pack('>I', path_table_sectors[1]) + b'\x00' * 4 \
+        + root + text('', 128) + text('', 128) + text('', 128) \
+        + text('', 128) + text('', 37) + text('', 37) + text('', 37) \
+        + vd_datetime(t) + vd_datetime(t) + b'0' * 16 + b'\x00' \
+        + vd_datetime(t) + b'\x01\x00'
+    return pad(vd, SECTOR_SIZE, b'\x00')
+
+
+# Write 'files' (list of (name, bytes)) to the iso image 'path'.
+def write_iso(path, label, files, t=None):
+    if t is None:
+        t = time.time()
+    files = sorted(files)
+
+    extents = {}
+    sector = FIRST_FILE_SECTOR
+    for name, data in files:
+        extents[name] = sector
+        sector += max(sectors(len(data)), 1)
+    total = sector
+
+    terminator = pad(b'\xffCD001\x01', SECTOR_SIZE, b'\x00')
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * SECTOR_SIZE * PVD_SECTOR)
+        f.write(volume_descriptor(
+            False, label, total, PATH_TABLE_SECTORS[0:2],
+            ROOT_SECTORS[0], t))
+        f.write(volume_descriptor(
+            True, label, total, PATH_TABLE_SECTORS[2:4],
+            ROOT_SECTORS[1], t))
+        f.write(terminator)
+        # L and M path tables of both descriptors.
+        for extent in ROOT_SECTORS:
+            for big_endian in (False, True):
+                f.write(pad(path_table(extent, big_endian),
+                            SECTOR_SIZE, b'\x00'))
+        f.write(directory(files, extents, ROOT_SECTORS[0], t, iso_name))
+        f.write(directory(files, extents, ROOT_SECTORS[1], t, joliet_name))
+        for name, data in files:
+            f.write(pad(data, max(sectors(len(data)), 1) * SECTOR_SIZE,
+                        b'\x00'))
@@ -0,0 +1,100 @@
+# Loop devices, partition maps and mounts of disk images.
+#
+# A raw image is attached by losetup, a qcow2 image by qemu-nbd (see
+# vmdeploy.provision). kpartx maps the partitions of the device to
+# '/dev/mapper/<dev>p<number>'.
+
+import os
+import time
+import logging
+import tempfile
+import subprocess
+import contextlib
+
+from vmdeploy import events
+from vmdeploy import provision
+
+logger = logging.getLogger(__name__)
+
+
+# Helper function to losetup a file to loop device.
+def file_to_loop(file, fmt='raw'):
+    # qcow2 overlay can not be attached by losetup, use qemu-nbd instead.
+    if fmt == 'qcow2':
+        return provision.file_to_nbd(file)
+    pobj = subprocess.Popen(['losetup', '-f'], stdout=subprocess.PIPE)
+    loopdev = pobj.communicate()[0].strip()
+    subprocess.call(['losetup', loopdev, file])
+    return loopdev
+
+
+# Helper function to detach file with loop device.
+def unfile_to_loop(loopdev):
+    if loopdev.startswith('/dev/nbd'):
+        provision.unfile_to_nbd(loopdev)
+        return
+    subprocess.call(['losetup', '-d', loopdev],
+                    stdout=open(os.devnull, 'wb'))
+
+
+# Helper function to create device maps of an image file.
+def file_to_loop_kpartx(file, fmt='raw'):
+    loopdev = file_to_loop(file, fmt)
+    subprocess.call(['kpartx', '-avs', '-pp', loopdev],
+                    stdout=open(os.devnull, 'wb'))
+    return loopdev
+    # -a add partition devmappings
+    # -v verbose
+    # -s sync mode. Don't return until the partitions are created
+    # -p set device name-partition number delimiter
+
+
+# Helper function to delete device maps and detach file with loop device.
+def unfile_to_loop_kpartx(loopdev):
+    subprocess.call(['kpartx', '-dv', '-pp', loopdev],
+                    stdout=open(os.devnull, 'wb'))
+    unfile_to_loop(loopdev)
+
+
+# Mount partition 'number' of an image file to a temporary directory,
+# which is unmounted and detached when the block exits:
+#
+#   with loopdev.mount_partition(vmsysfile) as mountpoint:
+#       ...
+#
+# The 'mount' and 'umount' stages are timed in 'eventlog'.
+@contextlib.contextmanager
+def mount_partition(file, fmt='raw', number=1, eventlog=None):
+    if eventlog is None:
+        eventlog = events.null()
+    eventlog.begin('mount')
+    loopdev = file_to_loop_kpartx(file, fmt)
+    try:
+        time.sleep(2)
+        logger.debug(loopdev)
+        loopmap = "/dev/mapper/" + loopdev.split('/')[-1] + "p" + str(number)
+        logger.debug(loopmap)
+
+        mountpoint = tempfile.mkdtemp(dir='/tmp', prefix='kvm-mount-')
+        logger.debug(mountpoint)
+        returncode = subprocess.call(['mount', loopmap, mountpoint],
+                                     stdout=open(os.devnull, 'wb'))
+        if returncode != 0:
+            os.rmdir(mountpoint)
+            raise IOError("Failed to mount " + loopmap)
+        time.sleep(1)
+        eventlog.end('mount')
+
+        try:
+            yield mountpoint
+        finally:
+            logger.debug("Umount the temporary directory.")
+            eventlog.begin('umount')
+            if subprocess.call(['umount', mountpoint]) == 0:
+                os.rmdir(mountpoint)
+    finally:
+        unfile_to_loop_kpartx(loopdev)
+        # A failed mount is ended here as failed, a finished one is not
+        # running any more.
+        eventlog.end('mount', 'failed')
+        eventlog.end('umount')
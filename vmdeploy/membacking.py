@@ -0,0 +1,103 @@
+# Memory backing of the guest domain: hugepages and memory hotplug.
+#
+# '--hugepages 2M' or '--hugepages 1G' backs the guest ram with hugepages
+# of that size (<memoryBacking><hugepages>). The pages must be reserved on
+# the host beforehand (vm.nr_hugepages, or hugepages= on the kernel command
+# line for 1G); the deploy checks the free pages of
+#
+#   /sys/kernel/mm/hugepages/hugepages-<size>kB/free_hugepages
+#
+# or, for a vm pinned to numa nodes (see vmdeploy.topology), the pool of
+# each of its nodes under /sys/devices/system/node/node<N>/hugepages/.
+# Free pages are only taken when the vm starts, deploys running at the same
+# time may count the same pages.
+#
+# With '--mrsvmode dimm', '--mrsv' makes room to grow the memory online by
+# <maxMemory slots=...> of twice the memory, instead of <memory> of twice
+# the memory and a balloon down to the current memory. The host only
+# accounts the memory the guest has, more is added later by
+#
+#   virsh attach-device <vm> dimm.xml --live --config
+#
+# with <memory model='dimm'><target><size unit='GiB'>1</size>
+# <node>0</node></target></memory>. Memory hotplug needs a guest numa
+# cell, one cell of all the vcpus is added when the vm is not pinned.
+
+import os
+
+from vmdeploy import util
+
+SYSFS = '/sys'
+
+# Sizes of the pages in KiB.
+PAGE_SIZES = {'2M': 2048, '1G': 1024 ** 2}
+
+# Dimm slots of '--mrsvmode dimm'.
+HOTPLUG_SLOTS = 16
+
+RESERVE_MODES = ('balloon', 'dimm')
+
+
+class MemoryBackingError(Exception):
+    pass
+
+
+# Free pages of 'size' ('2M' or '1G') on the host, or on numa 'node'.
+def free_hugepages(size, node=None, root=SYSFS):
+    pagedir = 'hugepages-{0}kB'.format(PAGE_SIZES[size])
+    if node is None:
+        path = os.path.join(root, 'kernel', 'mm', 'hugepages', pagedir)
+    else:
+        path = os.path.join(root, 'devices', 'system', 'node',
+                            'node' + str(node), 'hugepages', pagedir)
+    try:
+        with open(os.path.join(path, 'free_hugepages')) as f:
+            return int(f.read().strip())
+    except (IOError, OSError):
+        return 0
+
+
+# Check that there are free pages of 'size' for 'memory' bytes, or for the
+# 'memory' bytes bound to each node of 'placement' (see vmdeploy.topology).
+def check_hugepages(size, memory, placement=None, root=SYSFS):
+    pagebytes = PAGE_SIZES[size] * 1024
+    if placement is None:
+        needs = [(None, memory)]
+    else:
+        needs = list(zip(placement['nodes'], placement['memory']))
+    for node, node_memory in needs:
+        if node_memory % pagebytes:
+            raise MemoryBackingError(
+                "Memory of {0} MiB is not a multiple of {1} pages.".format(
+                    node_memory // 1024 ** 2, size))
+        pages = node_memory // pagebytes
+        free = free_hugepages(size, node, root)
+        if free < pages:
+            raise MemoryBackingError(
+                "{0} free {1} pages{2}, {3} are needed.".format(
+                    free, size, "" if node is None else
+                    " on numa node " + str(node), pages))
+
+
+# Add <memoryBacking> with pages of 'size' after 'x_after'.
+def hugepages_xml(x_after, size):
+    x_backing = x_after.makeelement('memoryBacking', {})
+    x_hugepages = util.sub(x_backing, 'hugepages')
+    util.sub(x_hugepages, 'page', size=str(PAGE_SIZES[size]), unit='KiB')
+    x_after.addnext(x_backing)
+    return x_backing
+
+
+# Add <maxMemory> of 'maxmemory' GiB before 'x_memory', and a guest numa
+# cell of 'vcpus' and 'memory' GiB to 'x_cpu' if it has none.
+def hotplug_xml(x_memory, x_cpu, maxmemory, vcpus, memory,
+                slots=HOTPLUG_SLOTS):
+    x_maxmemory = x_memory.makeelement(
+        'maxMemory', {'slots': str(slots), 'unit': 'GiB'})
+    x_maxmemory.text = str(maxmemory)
+    x_memory.addprevious(x_maxmemory)
+    if x_cpu.find('numa') is None:
+        x_numa = util.sub(x_cpu, 'numa')
+        util.sub(x_numa, 'cell', id='0', cpus='0-' + str(vcpus - 1)
+                 if vcpus > 1 else '0', memory=str(memory), unit='GiB')
+    return x_maxmemory
@@ -0,0 +1,134 @@
+# Options of the network interfaces of the vms.
+#
+# An item of 'vmnet' may end with options separated by ':'
+#
+#   br0/172.30.0.3/24:vhost:queues=4:rx=1024
+#   eth1/172.30.0.3/24:macvtap
+#
+#   vhost         the virtio queues are served by the vhost-net kernel
+#                 module, with as many queues as vcpus of the vm unless
+#                 'queues' is given;
+#   queues=N      multiqueue virtio-net with N queues, the guest spreads its
+#                 interrupts and packets over N vcpus;
+#   rx=N, tx=N    sizes of the rx and tx rings (256, 512 or 1024);
+#   macvtap[=M]   a macvtap device on the host nic given instead of the
+#                 bridge (<interface type='direct'>), in mode M: bridge
+#                 (default), vepa, private or passthrough. It skips the linux
+#                 bridge, but the vm can not talk to the host over it.
+#
+# The deploy scripts take the options off the items first, the rest of the
+# code only sees '<bridge>/<ipaddr>/<netmask>'. With more than one queue the
+# guest turns its queues on by 'ethtool -L' (ETHTOOL_OPTS of ifcfg, or a
+# bootcmd of cloud-init).
+
+from vmdeploy import util
+
+MACVTAP_MODES = ('bridge', 'vepa', 'private', 'passthrough')
+RING_SIZES = (256, 512, 1024)
+
+
+def _positive(name, value):
+    try:
+        ivalue = int(value)
+    except (TypeError, ValueError):
+        ivalue = 0
+    if ivalue <= 0:
+        raise ValueError("'{0}' must be a positive int: {1}".format(
+            name, value))
+    return ivalue
+
+
+# Split 'netitem' into the item without options and a dict of options.
+def split(netitem):
+    fields = netitem.split(':')
+    options = {}
+    for field in fields[1:]:
+        name, sep, value = field.partition('=')
+        if name == 'vhost' and not sep:
+            options['vhost'] = True
+        elif name == 'queues':
+            options['queues'] = _positive(name, value)
+        elif name in ('rx', 'tx'):
+            size = _positive(name, value)
+            if size not in RING_SIZES:
+                raise ValueError("'{0}' must be one of {1}: {2}".format(
+                    name, ", ".join(str(s) for s in RING_SIZES), value))
+            options[name] = size
+        elif name == 'macvtap':
+            mode = value or 'bridge'
+            if mode not in MACVTAP_MODES:
+                raise ValueError("Unknown macvtap mode: " + mode)
+            options['macvtap'] = mode
+        else:
+            raise ValueError("Unknown option '{0}' of {1}".format(
+                field, netitem))
+    return fields[0], options
+
+
+# Split every item of 'vmnet', return the items and their options.
+def split_vmnet(vmnet):
+    items = []
+    options = []
+    for netitem in vmnet or []:
+        item, item_options = split(netitem)
+        items.append(item)
+        options.append(item_options)
+    return items, options
+
+
+# Number of queues of an interface of a vm with 'vcpus'.
+def queues(options, vcpus):
+    if 'queues' in options:
+        return options['queues']
+    if options.get('vhost'):
+        return max(1, vcpus)
+    return 1
+
+
+# Add the <interface> of 'source' (a bridge, or the host nic of macvtap)
+# with 'options' to 'parent'.
+def interface_xml(parent, source, options, vcpus, mac=None):
+    if 'macvtap' in options:
+        x_interface = util.sub(parent, 'interface', type='direct')
+    else:
+        x_interface = util.sub(parent, 'interface', type='bridge')
+    if mac:
+        util.sub(x_interface, 'mac', address=mac)
+    if 'macvtap' in options:
+        util.sub(x_interface, 'source', dev=source, mode=options['macvtap'])
+    else:
+        util.sub(x_interface, 'source', bridge=source)
+    util.sub(x_interface, 'model', type='virtio')
+
+    driver = {}
+    if options.get('vhost'):
+        driver['name'] = 'vhost'
+    count = queues(options, vcpus)
+    if count > 1:
+        driver['queues'] = str(count)
+    if 'rx' in options:
+        driver['rx_queue_size'] = str(options['rx'])
+    if 'tx' in options:
+        driver['tx_queue_size'] = str(options['tx'])
+    if driver:
+        util.sub(x_interface, 'driver', **driver)
+    return x_interface
+
+
+# ETHTOOL_OPTS line of the ifcfg of 'if_name', empty with one queue.
+def ethtool_opts(if_name, options, vcpus):
+    count = queues(options, vcpus)
+    if count <= 1:
+        return ""
+    return 'ETHTOOL_OPTS="-L {0} combined {1}"\n'.format(if_name, count)
+
+
+# Commands turning on the queues of the interfaces, for cloud-init.
+def ethtool_commands(vmnetopts, vcpus):
+    commands = []
+    for index, options in enumerate(vmnetopts):
+        count = queues(options, vcpus)
+        if count > 1:
+            commands.append(
+                ['ethtool', '-L', 'eth' + str(index), 'combined', str(count)])
+    return commands
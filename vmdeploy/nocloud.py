@@ -0,0 +1,107 @@
+# cloud-init NoCloud seed of a vm.
+#
+# The seed is an iso9660 image labeled 'cidata' with the files meta-data,
+# user-data and network-config. It carries the same settings the deploy
+# scripts otherwise write into the mounted sys disk (ifcfg-ethN, hostname,
+# fstab entries, authorized_keys), so the sys disk itself is never
+# mounted. The guest grows its root partition and file system itself
+# (cloud-init growpart and resize_rootfs).
+#
+# JSON is valid YAML, so the documents are written with the json module.
+
+import json
+import random
+
+import netaddr
+
+from vmdeploy import iso9660
+
+LABEL = 'cidata'
+
+# Explicit separators avoid trailing spaces of python 2.
+JSON_FORMAT = {'indent': 2, 'sort_keys': True, 'separators': (',', ': ')}
+
+
+# Random mac address in the range used by qemu/libvirt.
+def random_mac():
+    return '52:54:00:%02x:%02x:%02x' % (
+        random.randint(0, 255), random.randint(0, 255),
+        random.randint(0, 255))
+
+
+def render_meta_data(instance_id, hostname):
+    return json.dumps(
+        {'instance-id': instance_id, 'local-hostname': hostname},
+        **JSON_FORMAT) + '\n'
+
+
+# Network config version 1 from 'vmnet' items like 'br0/172.30.0.3/24' or
+# 'br1//'. Interfaces are matched by mac address and named eth0, eth1 ...
+# The gateway goes to the interface whose subnet contains it.
+def render_network_config(vmnet, macs, gateway=None, nameservers=None):
+    config = []
+    gateway_done = False
+    for index, netitem in enumerate(vmnet):
+        iface = {
+            'type': 'physical', 'name': 'eth' + str(index),
+            'mac_address': macs[index], 'subnets': []}
+        if_ip = netitem.split('/')[1]
+        if_mask = netitem.split('/')[2]
+        if if_ip != '' and if_mask != '':
+            if_network = netaddr.IPNetwork(netitem.split('/', 1)[1])
+            subnet = {
+                'type': 'static',
+                'address': str(if_network.ip),
+                'netmask': str(if_network.netmask)}
+            if gateway and not gateway_done and \
+                    netaddr.IPAddress(gateway) in if_network:
+                subnet['gateway'] = gateway
+                gateway_done = True
+            iface['subnets'].append(subnet)
+        config.append(iface)
+
+    if gateway and not gateway_done:
+        # The gateway is not in any subnet, use the first static one.
+        for iface in config:
+            if iface['subnets']:
+                iface['subnets'][0]['gateway'] = gateway
+                break
+
+    if nameservers:
+        config.append({'type': 'nameserver', 'address': list(nameservers)})
+
+    return json.dumps(
+        {'version': 1, 'config': config}, **JSON_FORMAT) + '\n'
+
+
+# cloud-config with the hostname, root's ssh keys and fstab entries.
+# 'mounts' is a list of fstab entries as lists of strings, 'bootcmds' a
+# list of commands run on every boot.
+def render_user_data(hostname, pubkeys=None, mounts=None, bootcmds=None):
+    config = {
+        'preserve_hostname': False,
+        'hostname': hostname,
+        'growpart': {'mode': 'auto', 'devices': ['/']},
+        'resize_rootfs': True,
+    }
+    if pubkeys:
+        config['disable_root'] = False
+        config['users'] = [
+            {'name': 'root', 'ssh_authorized_keys': list(pubkeys)}]
+        config['runcmd'] = [['restorecon', '-R', '/root/.ssh']]
+    if mounts:
+        config['mounts'] = [list(m) for m in mounts]
+    if bootcmds:
+        config['bootcmd'] = [list(c) for c in bootcmds]
+    return '#cloud-config\n' + json.dumps(config, **JSON_FORMAT) \
+        + '\n'
+
+
+# Write the seed image 'path'.
+def write_seed(path, meta_data, user_data, network_config=None):
+    files = [
+        ('meta-data', meta_data.encode('utf-8')),
+        ('user-data', user_data.encode('utf-8'))]
+    if network_config is not None:
+        files.append(('network-config', network_config.encode('utf-8')))
+    iso9660.write_iso(path, LABEL, files)
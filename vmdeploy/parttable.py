@@ -0,0 +1,217 @@
+# Read and grow the partition table (MBR or GPT) of a disk image.
+#
+# The image is changed in place through a plain file (a raw image or the
+# block device of an attached image), no loop device or fdisk is needed.
+# Only 512 bytes sectors are supported, which is what qemu presents for
+# file backed disks.
+
+import os
+import struct
+import zlib
+
+SECTOR_SIZE = 512
+
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_ENTRIES_OFFSET = 446
+MBR_ENTRY = struct.Struct('<B3sB3sII')
+MBR_TYPE_GPT = 0xee
+
+GPT_SIGNATURE = b'EFI PART'
+# signature, revision, header size, header crc32, reserved, current lba,
+# backup lba, first usable lba, last usable lba, disk guid, partition
+# entries lba, number of entries, entry size, entries crc32.
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+
+class PartitionError(Exception):
+    pass
+
+
+# Helper function to compute crc32 as stored in GPT.
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+# CHS address of 'lba' for MBR entries, like fdisk with 255 heads and 63
+# sectors per track. Addresses beyond CHS limits are 1023/254/63.
+def lba_to_chs(lba):
+    cylinder = lba // (255 * 63)
+    head = (lba // 63) % 255
+    sector = lba % 63 + 1
+    if cylinder > 1023:
+        cylinder, head, sector = 1023, 254, 63
+    return struct.pack(
+        '<BBB', head, ((cylinder >> 2) & 0xc0) | sector, cylinder & 0xff)
+
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise PartitionError("Short read at offset " + str(offset))
+    return data
+
+
+def write_at(f, offset, data):
+    f.seek(offset)
+    f.write(data)
+
+
+def disk_sectors(f):
+    f.seek(0, os.SEEK_END)
+    return f.tell() // SECTOR_SIZE
+
+
+# Return the MBR entries as a list of dicts (empty entries are skipped).
+def read_mbr(f):
+    mbr = read_at(f, 0, SECTOR_SIZE)
+    if mbr[510:512] != MBR_SIGNATURE:
+        raise PartitionError("No MBR signature found.")
+    entries = []
+    for index in range(4):
+        offset = MBR_ENTRIES_OFFSET + index * MBR_ENTRY.size
+        status, chs_first, ptype, chs_last, first, count = \
+            MBR_ENTRY.unpack(mbr[offset:offset + MBR_ENTRY.size])
+        if ptype == 0 or count == 0:
+            continue
+        entries.append({
+            'number': index + 1, 'offset': offset, 'status': status,
+            'type': ptype, 'first': first, 'last': first + count - 1})
+    return entries
+
+
+def read_gpt_header(f, lba):
+    header = read_at(f, lba * SECTOR_SIZE, GPT_HEADER.size)
+    fields = list(GPT_HEADER.unpack(header))
+    if fields[0] != GPT_SIGNATURE:
+        raise PartitionError("No GPT header at lba " + str(lba))
+    raw = read_at(f, lba * SECTOR_SIZE, fields[2])
+    check = raw[:16] + b'\x00\x00\x00\x00' + raw[20:]
+    if crc32(check) != fields[3]:
+        raise PartitionError("Bad GPT header checksum at lba " + str(lba))
+    return fields
+
+
+# Return 'mbr' or 'gpt' and the list of partitions as dicts with number,
+# first and last sector.
+def read_table(path):
+    with open(path, 'rb') as f:
+        entries = read_mbr(f)
+        if entries and entries[0]['type'] == MBR_TYPE_GPT:
+            header = read_gpt_header(f, 1)
+            entries_data = read_at(
+                f, header[10] * SECTOR_SIZE, header[11] * header[12])
+            partitions = []
+            for index in range(header[11]):
+                entry = GPT_ENTRY.unpack(
+                    entries_data[index * header[12]:
+                                 index * header[12] + GPT_ENTRY.size])
+                if entry[0] == b'\x00' * 16:
+                    continue
+                partitions.append({
+                    'number': index + 1, 'first': entry[2],
+                    'last': entry[3]})
+            return 'gpt', partitions
+        return 'mbr', entries
+
+
+# Last sector partition 'number' may grow to: the sector before the next
+# partition or 'limit'.
+def grow_limit(partitions, number, limit):
+    target = [p for p in partitions if p['number'] == number]
+    if not target:
+        raise PartitionError("Partition " + str(number) + " not found.")
+    target = target[0]
+    for p in partitions:
+        if p['first'] > target['first']:
+            limit = min(limit, p['first'] - 1)
+    return target, limit
+
+
+def grow_mbr(f, number):
+    partitions = read_mbr(f)
+    # MBR can not address more than 2^32 sectors.
+    limit = min(disk_sectors(f) - 1, 0xffffffff)
+    target, last = grow_limit(partitions, number, limit)
+    if last <= target['last']:
+        return target['first'], target['last']
+
+    entry = MBR_ENTRY.pack(
+        target['status'], lba_to_chs(target['first']), target['type'],
+        lba_to_chs(last), target['first'], last - target['first'] + 1)
+    write_at(f, target['offset'], entry)
+    return target['first'], last
+
+
+def grow_gpt(f, number):
+    sectors = disk_sectors(f)
+    primary = read_gpt_header(f, 1)
+    entries_size = primary[11] * primary[12]
+    entries_sectors = (entries_size + SECTOR_SIZE - 1) // SECTOR_SIZE
+    entries_data = bytearray(
+        read_at(f, primary[10] * SECTOR_SIZE, entries_size))
+
+    # Move the backup header and entries to the new end of the disk.
+    old_backup_lba = primary[6]
+    backup_lba = sectors - 1
+    backup_entries_lba = backup_lba - entries_sectors
+    last_usable = backup_entries_lba - 1
+
+    partitions = []
+    for index in range(primary[11]):
+        offset = index * primary[12]
+        entry = GPT_ENTRY.unpack(
+            bytes(entries_data[offset:offset + GPT_ENTRY.size]))
+        if entry[0] != b'\x00' * 16:
+            partitions.append({
+                'number': index + 1, 'offset': offset,
+                'first': entry[2], 'last': entry[3]})
+    target, last = grow_limit(partitions, number, last_usable)
+    if last < target['last']:
+        raise PartitionError("Disk is smaller than partition " + str(number))
+
+    struct.pack_into('<Q', entries_data, target['offset'] + 40, last)
+    entries_crc = crc32(bytes(entries_data))
+
+    def pack_header(current_lba, other_lba, entries_lba):
+        fields = list(primary)
+        fields[3] = 0
+        fields[5] = current_lba
+        fields[6] = other_lba
+        fields[8] = last_usable
+        fields[10] = entries_lba
+        fields[13] = entries_crc
+        header = GPT_HEADER.pack(*fields)
+        header += b'\x00' * (primary[2] - len(header))
+        fields[3] = crc32(header)
+        return GPT_HEADER.pack(*fields) + header[GPT_HEADER.size:]
+
+    if old_backup_lba != backup_lba:
+        # Wipe the stale backup header inside the grown disk.
+        write_at(f, old_backup_lba * SECTOR_SIZE, b'\x00' * SECTOR_SIZE)
+    write_at(f, primary[10] * SECTOR_SIZE, bytes(entries_data))
+    write_at(f, 1 * SECTOR_SIZE, pack_header(1, backup_lba, primary[10]))
+    write_at(f, backup_entries_lba * SECTOR_SIZE, bytes(entries_data))
+    write_at(f, backup_lba * SECTOR_SIZE,
+             pack_header(backup_lba, 1, backup_entries_lba))
+
+    # The protective MBR covers the whole disk.
+    protective = read_mbr(f)[0]
+    write_at(f, protective['offset'] + 12, struct.pack(
+        '<I', min(sectors - 1, 0xffffffff)))
+    return target['first'], last
+
+
+# Extend partition 'number' to the end of the disk (or to the next
+# partition) in place. Return its first and last sector.
+def grow_partition(path, number=1):
+    with open(path, 'r+b') as f:
+        entries = read_mbr(f)
+        if entries and entries[0]['type'] == MBR_TYPE_GPT:
+            result = grow_gpt(f, number)
+        else:
+            result = grow_mbr(f, number)
+        f.flush()
+        os.fsync(f.fileno())
+    return result
@@ -0,0 +1,329 @@
+# Placement of new vms on a set of kvm hosts.
+#
+#   python -m vmdeploy.placement --hosts json:hosts/ --manifest vms.ini \
+#       --policy spread --output manifests/
+#
+# Picks a host for every vm of a manifest (the manifest of batch mode, see
+# vmdeploy.batch) from the free memory, vcpus and 'vmdeploypath' space and
+# the network interfaces of the hosts. A vm fits a host with enough of each,
+# all the bridges of its 'vmnet' and the host nics of its macvtap items (see
+# vmdeploy.netif); its memory and vcpus count twice with 'vmmemresv' and
+# 'vmcpuresv', its disk is the sys, swap and data disks. Among the hosts it
+# fits:
+#
+#   - 'pack' takes the one left with the least free memory (bin-packing,
+#     keeps other hosts empty);
+#   - 'spread' takes the one left with the most free memory.
+#
+# Two options of the manifest, only used here, group the vms:
+#
+#   - 'affinity = <group>': on the host which has vms of the group already;
+#   - 'antiaffinity = <group>': not on a host with a vm of the group.
+#
+# Hosts come from a host source, given as '<kind>:<argument>':
+#
+#   - 'json:<path>' reads a json file (a list of hosts) or every '*.json'
+#     of a directory (one host each), stand-ins for testing;
+#   - 'local:<vmdeploypath>' is this host, from /proc, /sys and the domain
+#     xml files (see vmdeploy.inventory).
+#
+# A host is a dict:
+#
+#   {"name": "kvm01", "memory_free": 64, "vcpus_free": 32,
+#    "disk_free": 500, "bridges": ["br0", "virbr1"],
+#    "interfaces": ["br0", "eth0", "eth1", "virbr1"], "vms": ["web01"]}
+#
+# with sizes in GB, 'interfaces' are all the network interfaces. Placed
+# vms are kept in the state file ('--state'), with their resources and
+# groups. Until it shows up in the 'vms' of its host (or 'RESERVATION_TTL'
+# passes) a placed vm is in flight and its resources are taken from the
+# free resources of its host, so deploys placed by concurrent runs do not
+# land on the same free memory.
+
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import argparse
+
+from vmdeploy import batch
+from vmdeploy import netif
+from vmdeploy import util
+
+POLICIES = ('pack', 'spread')
+
+# Seconds a placed vm is in flight at most.
+RESERVATION_TTL = 3600
+
+# Options of the manifest which are not options of the deploy scripts.
+PLACEMENT_KEYS = ('affinity', 'antiaffinity')
+
+# Vcpus of the local host per cpu.
+CPU_RATIO = 4
+
+
+class PlacementError(Exception):
+    pass
+
+
+class JsonSource(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def hosts(self):
+        if os.path.isdir(self.path):
+            hosts = []
+            for filename in sorted(glob.glob(
+                    os.path.join(self.path, '*.json'))):
+                with open(filename) as f:
+                    hosts.append(json.load(f))
+            return hosts
+        with open(self.path) as f:
+            hosts = json.load(f)
+        return hosts if isinstance(hosts, list) else [hosts]
+
+
+class LocalSource(object):
+
+    def __init__(self, vmdeploypath, cpu_ratio=CPU_RATIO,
+                 sys_class_net='/sys/class/net'):
+        self.vmdeploypath = vmdeploypath
+        self.cpu_ratio = cpu_ratio
+        self.sys_class_net = sys_class_net
+
+    def hosts(self):
+        from vmdeploy import inventory
+
+        cache = inventory.Cache(
+            os.path.join(self.vmdeploypath, inventory.CACHEFILE))
+        domains = inventory.scan_deploypath(self.vmdeploypath, cache)
+        resources = inventory.host_resources(self.vmdeploypath)
+        st = os.statvfs(self.vmdeploypath)
+        memory = resources['memory'] - sum(d['memory'] for d in domains)
+        vcpus = resources['cpus'] * self.cpu_ratio - \
+            sum(d['vcpus'] for d in domains)
+        interfaces = sorted(os.listdir(self.sys_class_net))
+        bridges = [name for name in interfaces
+                   if os.path.isdir(os.path.join(
+                       self.sys_class_net, name, 'bridge'))]
+        return [{
+            'name': socket.gethostname(),
+            'memory_free': memory / 1024.0 ** 3, 'vcpus_free': vcpus,
+            'disk_free': st.f_bavail * st.f_frsize / 1024.0 ** 3,
+            'bridges': bridges, 'interfaces': interfaces,
+            'vms': [d['name'] for d in domains]}]
+
+
+SOURCES = {'json': JsonSource, 'local': LocalSource}
+
+
+# Make the host source of '<kind>:<argument>'.
+def make_source(value):
+    kind, _, argument = value.partition(':')
+    if kind not in SOURCES or not argument:
+        raise PlacementError(
+            "Invalid host source '" + value + "', the format is "
+            "'<kind>:<argument>' with kind in " + ", ".join(sorted(SOURCES)))
+    return SOURCES[kind](argument)
+
+
+def spec_int(spec, key, default):
+    value = spec.get(key)
+    return int(value) if value not in (None, '') else default
+
+
+# Resources needed by the vm of a manifest spec.
+def requirements(spec):
+    memsize = spec_int(spec, 'vmmemsize', 1)
+    cpus = spec_int(spec, 'vmcpunumber', 1)
+    if str(spec.get('vmmemresv', '')).lower() in batch.TRUE_STRINGS \
+            and spec.get('vmmemresvmode', 'balloon') == 'balloon':
+        memsize *= 2
+    if str(spec.get('vmcpuresv', '')).lower() in batch.TRUE_STRINGS:
+        cpus *= 2
+    disk = spec_int(spec, 'vmsyssize', 20) + \
+        spec_int(spec, 'vmswapsize', spec_int(spec, 'vmmemsize', 1)) + \
+        spec_int(spec, 'vmdatasize', 0)
+    # A macvtap item is on a host nic, not a bridge.
+    bridges = []
+    nics = []
+    for netitem in spec.get('vmnet', '').split(','):
+        if not netitem:
+            continue
+        item, options = netif.split(netitem)
+        if 'macvtap' in options:
+            nics.append(item.split('/')[0])
+        else:
+            bridges.append(item.split('/')[0])
+    groups = {}
+    for key in PLACEMENT_KEYS:
+        if spec.get(key):
+            groups[key] = spec[key]
+    return {'memory': memsize, 'vcpus': cpus, 'disk': disk,
+            'bridges': bridges, 'nics': nics, 'groups': groups}
+
+
+class Scheduler(object):
+
+    def __init__(self, hosts, placed=None, policy='pack', now=None):
+        if policy not in POLICIES:
+            raise PlacementError("Unknown policy " + policy)
+        self.policy = policy
+        self.now = time.time() if now is None else now
+        self.hosts = {}
+        # {vmname: placement} of the state file, with the new ones.
+        self.placed = dict(placed or {})
+        # {group: set of hosts}
+        self.groups = {}
+        for host in hosts:
+            self.hosts[host['name']] = dict(
+                host, vms=set(host.get('vms', [])),
+                bridges=set(host.get('bridges', [])),
+                interfaces=set(host.get('interfaces', [])))
+        for vmname, placement in list(self.placed.items()):
+            host = self.hosts.get(placement['host'])
+            if host is not None and vmname in host['vms']:
+                self.join_groups(placement)
+            elif self.now - placement['time'] < RESERVATION_TTL:
+                # In flight, its resources are not free on its host yet.
+                if host is not None:
+                    self.take(host, placement)
+                self.join_groups(placement)
+            elif host is not None:
+                # The deploy failed or its vm was removed.
+                del self.placed[vmname]
+
+    def join_groups(self, placement):
+        for group in placement.get('groups', {}).values():
+            self.groups.setdefault(group, set()).add(placement['host'])
+
+    def take(self, host, need):
+        host['memory_free'] -= need['memory']
+        host['vcpus_free'] -= need['vcpus']
+        host['disk_free'] -= need['disk']
+
+    # Return the name of the host chosen for 'need', and take its resources.
+    def place(self, vmname, need):
+        if vmname in self.placed:
+            raise PlacementError("Already placed on "
+                                 + self.placed[vmname]['host'] + ".")
+        candidates = []
+        for name, host in self.hosts.items():
+            if vmname in host['vms']:
+                raise PlacementError("Already on " + name + ".")
+            if host['memory_free'] < need['memory'] \
+                    or host['vcpus_free'] < need['vcpus'] \
+                    or host['disk_free'] < need['disk']:
+                continue
+            if not set(need['bridges']) <= host['bridges'] \
+                    or not set(need['nics']) <= host['interfaces']:
+                continue
+            candidates.append(name)
+
+        groups = need['groups']
+        if groups.get('affinity') in self.groups:
+            candidates = [name for name in candidates
+                          if name in self.groups[groups['affinity']]]
+        if groups.get('antiaffinity') in self.groups:
+            candidates = [name for name in candidates
+                          if name not in self.groups[groups['antiaffinity']]]
+        if not candidates:
+            raise PlacementError("No host fits.")
+
+        def left(name):
+            host = self.hosts[name]
+            return (host['memory_free'] - need['memory'],
+                    host['disk_free'] - need['disk'], name)
+        if self.policy == 'pack':
+            chosen = min(candidates, key=left)
+        else:
+            chosen = max(candidates, key=left)
+
+        self.take(self.hosts[chosen], need)
+        placement = dict(need, host=chosen, time=self.now)
+        self.placed[vmname] = placement
+        self.join_groups(placement)
+        return chosen
+
+
+# Write the specs placed on each host to '<outdir>/<host>.ini', manifests
+# for the deploy scripts on that host.
+def write_manifests(outdir, specs, chosen):
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    byhost = {}
+    for spec in specs:
+        if spec['vmname'] in chosen:
+            byhost.setdefault(chosen[spec['vmname']], []).append(spec)
+    for host, host_specs in byhost.items():
+        with open(os.path.join(outdir, host + '.ini'), 'w') as f:
+            for spec in host_specs:
+                f.write("[{0}]\n".format(spec['vmname']))
+                for key in sorted(spec):
+                    if key not in PLACEMENT_KEYS + ('vmname',):
+                        f.write("{0} = {1}\n".format(key, spec[key]))
+                f.write("\n")
+    return sorted(byhost)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Place the vms of a manifest on kvm hosts')
+    parser.add_argument(
+        '--hosts', help="host source, like 'json:hosts/' or "
+        "'local:./vmimages'.", dest='hosts', required=True)
+    parser.add_argument(
+        '--manifest', help="manifest of the vms, as for batch mode.",
+        dest='manifest', required=True)
+    parser.add_argument(
+        '--policy', help="'pack' fills hosts one by one, 'spread' "
+        "balances the hosts. (Default: %(default)s)", dest='policy',
+        default='pack', choices=POLICIES)
+    parser.add_argument(
+        '--state', help="file of the placed vms, whose deploys are in "
+        "flight until their vm shows up on the host. "
+        "(Default: %(default)s)", dest='state', default='placement.json')
+    parser.add_argument(
+        '--output', help="write the vms of each host to "
+        "'<output>/<host>.ini'.", dest='output')
+    parser.add_argument(
+        '--dry-run', help="do not keep the placed vms in the state file.",
+        dest='dry_run', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    try:
+        hosts = make_source(args.hosts).hosts()
+        specs = batch.read_manifest(args.manifest)
+    except Exception:
+        print("Failed to read hosts or manifest. " + str(sys.exc_info()[1]))
+        return 1
+
+    with util.locked_state(args.state) as state:
+        scheduler = Scheduler(hosts, state.get('placed'), args.policy)
+        chosen = {}
+        failed = 0
+        print("{0:<24s}{1}".format("VM's Name:", "Host:"))
+        for spec in specs:
+            try:
+                chosen[spec['vmname']] = scheduler.place(
+                    spec['vmname'], requirements(spec))
+                print("{0:<24s}{1}".format(
+                    spec['vmname'], chosen[spec['vmname']]))
+            except (PlacementError, ValueError):
+                failed += 1
+                print("{0:<24s}- {1}".format(
+                    spec['vmname'], sys.exc_info()[1]))
+        if not args.dry_run:
+            state['placed'] = scheduler.placed
+
+    if args.output:
+        for host in write_manifests(args.output, specs, chosen):
+            print("Wrote " + os.path.join(args.output, host + '.ini'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
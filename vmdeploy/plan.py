@@ -0,0 +1,289 @@
+# Plan mode of the deploy-vm-*.py scripts.
+#
+#   deploy-vm-centos7.py --conf deploy-vm.conf --manifest vms.ini --plan
+#
+# Checks a vm (or every vm of a manifest) without deploying it: nothing is
+# created, no disk is touched and libvirt is not called. The manifest is
+# parsed by the parser of the script, so the rules of the options (sizes
+# multiple of 10, positive numbers, ...) are checked as a deploy would,
+# then every vm is checked for
+#
+#   - a name used by another vm of the manifest or under 'vmdeploypath'
+#     (or by an image of the ceph pool);
+#   - addresses used by another vm or reserved, and '<bridge>/auto'
+#     without free address (see vmdeploy.ipam, the state is not saved);
+#   - bridges which do not exist on this host;
+#   - a template missing from 'vmtmplpath' (or the ceph pool).
+#
+# At last the disk, memory and cpus of all the vms (twice the memory and
+# cpus of vms with '--mrsv' and '--crsv') are compared with what is free
+# on this host. Errors are printed per vm, the exit code is 1 if any.
+
+import os
+import sys
+import json
+import subprocess
+
+from vmdeploy import batch
+from vmdeploy import conf
+from vmdeploy import ipam
+from vmdeploy import membacking
+from vmdeploy import netif
+
+SYS_CLASS_NET = '/sys/class/net'
+
+
+class PlanError(Exception):
+    pass
+
+
+# Parse the spec of a manifest into the args of a single deploy.
+def spec_to_args(parser, conf_file, spec):
+    def error(message):
+        raise PlanError(message)
+    parser.error = error
+    argv = batch.spec_to_argv('', parser, conf_file, spec)[2:]
+    return parser.parse_args(argv)
+
+
+def read_meminfo(path='/proc/meminfo'):
+    meminfo = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return meminfo
+
+
+class Planner(object):
+
+    # 'backend' is 'file' for disk images under 'vmdeploypath' or 'rbd'
+    # for images in the ceph pool 'vmpool' of the vms.
+    def __init__(self, vmdeploypath, vmtmplpath=None, backend='file',
+                 ippools=None, sys_class_net=SYS_CLASS_NET):
+        self.vmdeploypath = vmdeploypath
+        self.vmtmplpath = vmtmplpath
+        self.backend = backend
+        self.sys_class_net = sys_class_net
+        try:
+            self.existing = set(
+                name for name in os.listdir(vmdeploypath)
+                if not name.startswith('.'))
+        except OSError:
+            self.existing = set()
+        self.ipam = ipam.IPAM(vmdeploypath, ippools)
+        if os.path.isdir(vmdeploypath):
+            self.ipam.load()
+        else:
+            self.ipam.apply_config()
+        self.names = set()
+        self.bridges = {}
+        self.rbd_images = {}
+        # Projected consumption of the planned vms.
+        self.disk = 0
+        self.rbd = 0
+        self.memory = 0
+        self.cpus = 0
+        # {page size: bytes}
+        self.hugepages = {}
+
+    def bridge_exists(self, bridge):
+        if bridge not in self.bridges:
+            self.bridges[bridge] = os.path.exists(
+                os.path.join(self.sys_class_net, bridge))
+        return self.bridges[bridge]
+
+    # Images and snapshots of a ceph pool, like 'vm.rbd@vm.rbd.snap'.
+    def list_rbd(self, pool):
+        if pool not in self.rbd_images:
+            try:
+                output = subprocess.check_output(
+                    ['rbd', 'ls', '-l', '--format', 'json', pool])
+                images = set()
+                for item in json.loads(output.decode('utf-8')):
+                    if item.get('snapshot'):
+                        images.add(item['image'] + '@' + item['snapshot'])
+                    else:
+                        images.add(item['image'])
+            except (OSError, subprocess.CalledProcessError, ValueError):
+                images = None
+            self.rbd_images[pool] = images
+        if self.rbd_images[pool] is None:
+            raise PlanError("Can not list ceph pool " + pool + ".")
+        return self.rbd_images[pool]
+
+    def check_template(self, vmtmpl):
+        if not vmtmpl:
+            raise PlanError("No template.")
+        if self.backend == 'rbd':
+            pool, _, image = vmtmpl.partition('/')
+            if image not in self.list_rbd(pool):
+                raise PlanError("Template " + vmtmpl + " is not in the "
+                                "ceph pool " + pool + ".")
+            return
+        tmplfile = os.path.join(self.vmtmplpath, vmtmpl + '.raw')
+        if not (os.path.exists(tmplfile)
+                or os.path.exists(tmplfile + '.tar.gz')):
+            raise PlanError("Template " + vmtmpl + " is not in "
+                            + self.vmtmplpath + ".")
+
+    # Return the errors of the vm of 'args', its resources are added to the
+    # projected consumption.
+    def check(self, args):
+        errors = []
+        vmname = args.vmname
+        if not vmname:
+            errors.append("No name.")
+        elif vmname in self.names:
+            errors.append("Name is used by another vm of the plan.")
+        elif vmname in self.existing:
+            errors.append("Name is used by a vm under "
+                          + self.vmdeploypath + ".")
+        self.names.add(vmname)
+
+        if self.backend == 'rbd' and vmname:
+            try:
+                if vmname + '.rbd' in self.list_rbd(args.vmpool):
+                    errors.append("Image " + vmname + ".rbd is in the ceph "
+                                  "pool " + args.vmpool + ".")
+            except PlanError:
+                errors.append(str(sys.exc_info()[1]))
+
+        vmnet = netif.split_vmnet(args.vmnet)[0]
+        if not vmnet:
+            errors.append("No network.")
+        for netitem in vmnet:
+            bridge = netitem.split('/')[0]
+            if not self.bridge_exists(bridge):
+                errors.append("Bridge " + bridge + " does not exist.")
+        try:
+            self.ipam.allocate(
+                vmname, vmnet, args.vmgateway,
+                args.vmnameserver.split(',') if args.vmnameserver else [])
+        except Exception:
+            errors.append(str(sys.exc_info()[1]))
+
+        try:
+            self.check_template(args.vmtmpl)
+        except PlanError:
+            errors.append(str(sys.exc_info()[1]))
+
+        memsize = args.vmmemsize * (
+            2 if args.vmmemresv and args.vmmemresvmode == 'balloon' else 1)
+        if args.vmhugepages != 'off':
+            # Hugepages are reserved out of the available memory already.
+            self.hugepages[args.vmhugepages] = self.hugepages.get(
+                args.vmhugepages, 0) + memsize * 1024 ** 3
+        else:
+            self.memory += memsize * 1024 ** 3
+        self.cpus += args.vmcpunumber * (2 if args.vmcpuresv else 1)
+        swapsize = args.vmswapsize or args.vmmemsize
+        disks = (args.vmsyssize + (args.vmdatasize or 0)) * 1024 ** 3
+        if self.backend == 'rbd':
+            self.rbd += disks
+        else:
+            self.disk += disks + swapsize * 1024 ** 3
+        # The same ceph pool error may come from the name and template.
+        return [e for i, e in enumerate(errors) if e not in errors[:i]]
+
+    # Errors of the projected consumption against this host.
+    def check_host(self):
+        errors = []
+        if self.disk:
+            try:
+                st = os.statvfs(self.vmdeploypath)
+                free = st.f_bavail * st.f_frsize
+                if self.disk > free:
+                    errors.append(
+                        "Disks need {0:.1f} GB, {1} has {2:.1f} GB "
+                        "free.".format(self.disk / 1024.0 ** 3,
+                                       self.vmdeploypath, free / 1024.0 ** 3))
+            except OSError:
+                errors.append("Can not stat " + self.vmdeploypath + ".")
+        meminfo = read_meminfo()
+        available = meminfo.get('MemAvailable', meminfo.get('MemFree'))
+        if available is not None and self.memory > available:
+            errors.append(
+                "Memory needs {0:.1f} GB, {1:.1f} GB is available.".format(
+                    self.memory / 1024.0 ** 3, available / 1024.0 ** 3))
+        for size, memory in sorted(self.hugepages.items()):
+            try:
+                membacking.check_hugepages(size, memory)
+            except membacking.MemoryBackingError:
+                errors.append(str(sys.exc_info()[1]))
+        return errors
+
+    def summary_str(self):
+        meminfo = read_meminfo()
+        lines = [
+            "{0:<12s}{1:>12s}  {2}".format("Resource:", "Planned:", "Host:"),
+            "{0:<12s}{1:>12d}  {2}".format(
+                "vms", len(self.names), len(self.existing)),
+            "{0:<12s}{1:>12d}  {2}".format(
+                "cpus", self.cpus, os.sysconf('SC_NPROCESSORS_ONLN')),
+            "{0:<12s}{1:>10.1f}GB  {2:.1f}GB available".format(
+                "memory", self.memory / 1024.0 ** 3,
+                meminfo.get('MemAvailable', 0) / 1024.0 ** 3)]
+        if self.disk:
+            lines.append("{0:<12s}{1:>10.1f}GB".format(
+                "disk", self.disk / 1024.0 ** 3))
+        if self.rbd:
+            lines.append("{0:<12s}{1:>10.1f}GB".format(
+                "ceph", self.rbd / 1024.0 ** 3))
+        for size, memory in sorted(self.hugepages.items()):
+            lines.append("{0:<12s}{1:>10.1f}GB".format(
+                "pages " + size, memory / 1024.0 ** 3))
+        return "\n".join(lines)
+
+
+# Check the vm of 'args', or every vm of 'args.manifest', and print the
+# errors. Return 1 if there is any.
+def run(make_parser, args, vmdeploypath, vmtmplpath=None, backend='file'):
+    try:
+        planner = Planner(vmdeploypath, vmtmplpath, backend,
+                          ipam.parse_pools(args.ippool))
+    except Exception:
+        print("Failed to read the ip pools. " + str(sys.exc_info()[1]))
+        return 1
+
+    if args.manifest:
+        try:
+            specs = batch.read_manifest(args.manifest)
+        except Exception:
+            print("Invalid manifest " + args.manifest + ". "
+                  + str(sys.exc_info()[1]))
+            return 1
+        parser = make_parser(False)
+        parser.set_defaults(**conf.read_defaults(args.conf_file))
+        vms = []
+        for spec in specs:
+            try:
+                vms.append((spec['vmname'], spec_to_args(
+                    parser, args.conf_file, spec), None))
+            except (PlanError, ValueError):
+                vms.append((spec['vmname'], None, str(sys.exc_info()[1])))
+    else:
+        vms = [(args.vmname, args, None)]
+
+    failed = 0
+    for vmname, vmargs, error in vms:
+        if vmargs is not None:
+            errors = planner.check(vmargs)
+        else:
+            errors = [error]
+        if errors:
+            failed += 1
+            for error in errors:
+                print("{0}: {1}".format(vmname, error))
+
+    host_errors = planner.check_host()
+    for error in host_errors:
+        print("host: " + error)
+    print("=" * 20)
+    print(planner.summary_str())
+    print("{0} vms planned, {1} with errors.".format(len(vms), failed))
+    return 1 if failed or host_errors else 0
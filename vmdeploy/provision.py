@@ -0,0 +1,112 @@
+# Provisioning of the vm's system disk from a raw template.
+#
+#   reflink  clone the template with the FICLONE ioctl, the clone shares all
+#            extents with the template until they are written (xfs with
+#            reflink=1, btrfs). Falls back to 'copy' if not supported.
+#   qcow2    create a qcow2 overlay whose backing file is the template.
+#            The overlay is attached through qemu-nbd instead of losetup.
+#   copy     sparse copy of the template by vmdeploy.sparsecopy.
+#   auto     the first one of reflink, qcow2 (when the nbd module is
+#            loaded) and copy that works.
+#
+# reflink and copy give a raw disk which still has to be resized, qcow2
+# is created with its final size.
+
+import os
+import sys
+import errno
+import fcntl
+import logging
+import subprocess
+
+from vmdeploy import sparsecopy
+
+logger = logging.getLogger(__name__)
+
+MODES = ('auto', 'reflink', 'qcow2', 'copy')
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# errno values meaning the filesystem can not clone the file.
+NO_REFLINK_ERRNOS = (
+    errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY)
+
+
+# Clone 'src' to 'dst' by FICLONE, raise OSError if not supported.
+def reflink(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                exc = sys.exc_info()[1]
+                fdst.close()
+                os.remove(dst)
+                raise OSError(exc.errno, "Failed to reflink: " + str(exc))
+
+
+# Create a qcow2 overlay 'dst' of 'size' GB backed by raw file 'backing'.
+def qcow2_overlay(backing, dst, size):
+    returncode = subprocess.call(
+        ['qemu-img', 'create', '-f', 'qcow2',
+            '-o', 'backing_file=' + os.path.abspath(backing)
+            + ',backing_fmt=raw', dst, str(size) + "G"],
+        stdout=open(os.devnull, 'wb'))
+    if returncode != 0:
+        raise OSError("qemu-img create returned " + str(returncode))
+
+
+# qcow2 overlays need the nbd module to be attached on the host.
+def nbd_available():
+    return os.path.exists('/sys/block/nbd0')
+
+
+# Create the system disk 'dst' from 'template' with the given mode.
+# Return the method actually used and the disk format ('raw' or 'qcow2').
+# 'progress' is passed to sparsecopy.copy().
+def provision_sysdisk(mode, template, dst, size, progress=None):
+    if mode not in MODES:
+        raise ValueError("Unknown provision mode: " + str(mode))
+
+    if mode in ('auto', 'reflink'):
+        try:
+            reflink(template, dst)
+        except OSError:
+            exc = sys.exc_info()[1]
+            if exc.errno not in NO_REFLINK_ERRNOS:
+                raise
+            logger.debug("Reflink is not supported. " + str(exc))
+        else:
+            return ('reflink', 'raw')
+
+    if mode == 'qcow2' or (mode == 'auto' and nbd_available()):
+        qcow2_overlay(template, dst, size)
+        return ('qcow2', 'qcow2')
+
+    sparsecopy.copy(template, dst, progress=progress)
+    return ('copy', 'raw')
+
+
+# Helper function to attach a qcow2 image to a free nbd device.
+def file_to_nbd(file, fmt='qcow2'):
+    index = 0
+    while os.path.exists('/sys/block/nbd' + str(index)):
+        nbddev = '/dev/nbd' + str(index)
+        index += 1
+        with open('/sys/block/' + nbddev[5:] + '/size') as f:
+            if f.read().strip() != '0':
+                continue
+        # qemu-nbd fails if another deploy took the device meanwhile.
+        returncode = subprocess.call(
+            ['qemu-nbd', '-c', nbddev, '-f', fmt, file],
+            stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
+        if returncode == 0:
+            return nbddev
+    raise OSError("No free nbd device, is the nbd module loaded?")
+
+
+# Helper function to detach an nbd device.
+def unfile_to_nbd(nbddev):
+    subprocess.call(['qemu-nbd', '-d', nbddev],
+                    stdout=open(os.devnull, 'wb'))
@@ -0,0 +1,128 @@
+# Raw disk images made in process, instead of running 'qemu-img create',
+# 'qemu-img resize' and 'mkswap' for every vm.
+#
+# The allocation of a new or grown image is one of ALLOCATIONS, the names of
+# the preallocation modes of qemu-img:
+#
+#   - 'off' only sets the size (ftruncate), the image is sparse;
+#   - 'falloc' also reserves its blocks (fallocate), writes to the image
+#     never fail for lack of space on the host.
+#
+# Errors are raised as OSError/IOError with the errno of the failed call.
+
+import os
+import uuid
+import errno
+import ctypes
+import struct
+
+ALLOCATIONS = ('off', 'falloc')
+
+GIB = 1024 ** 3
+
+# Signature at the end of the first page of a swap area (version 1).
+SWAP_SIGNATURE = b'SWAPSPACE2'
+
+# Fewest pages of a swap area, like mkswap.
+SWAP_MIN_PAGES = 10
+
+
+def _libc_fallocate():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.fallocate64
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                     ctypes.c_int64]
+
+    def fallocate(fd, offset, length):
+        if func(fd, 0, offset, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    return fallocate
+
+
+# fallocate(fd, offset, length), os.posix_fallocate of python 3 or
+# fallocate of glibc.
+if hasattr(os, 'posix_fallocate'):
+    fallocate = os.posix_fallocate
+else:
+    fallocate = _libc_fallocate()
+
+
+def _allocate(fd, offset, length, allocation):
+    if allocation not in ALLOCATIONS:
+        raise ValueError("Unknown allocation: " + str(allocation))
+    if allocation == 'falloc' and length > 0:
+        if fallocate is None:
+            raise OSError(errno.ENOTSUP, "fallocate is not available")
+        fallocate(fd, offset, length)
+
+
+# Create the raw image 'path' of 'size' bytes, an existing file is
+# truncated first.
+def create(path, size, allocation='off'):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        _allocate(fd, 0, size, allocation)
+    except Exception:
+        os.close(fd)
+        os.remove(path)
+        raise
+    os.close(fd)
+
+
+# Grow the raw image 'path' to 'size' bytes. Shrinking is refused, as
+# 'qemu-img resize' does without '--shrink'.
+def resize(path, size, allocation='off'):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        old_size = os.fstat(fd).st_size
+        if size < old_size:
+            raise OSError(errno.EINVAL, "Can not shrink {0} from {1} to "
+                          "{2} bytes".format(path, old_size, size))
+        os.ftruncate(fd, size)
+        _allocate(fd, old_size, size - old_size, allocation)
+    finally:
+        os.close(fd)
+
+
+# Reserve the blocks of the whole raw image 'path' by 'allocation', for an
+# image made by copy or reflink at its final size. Shared extents of a
+# reflinked image stay shared, only its holes are allocated.
+def allocate(path, allocation='off'):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        _allocate(fd, 0, os.fstat(fd).st_size, allocation)
+    finally:
+        os.close(fd)
+
+
+# Write the header of a linux swap area (version 1) on the image 'path',
+# like 'mkswap -f'. Return the uuid of the swap area.
+def mkswap(path, label=None, pagesize=None):
+    pagesize = pagesize or os.sysconf('SC_PAGESIZE')
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        pages = os.fstat(fd).st_size // pagesize
+        if pages < SWAP_MIN_PAGES:
+            raise OSError(errno.EINVAL, "Swap area {0} is too small: {1} "
+                          "pages".format(path, pages))
+        swap_uuid = uuid.uuid4()
+        # struct swap_header_v1_2 of linux/swap.h, after 1024 bytes of
+        # boot bits: version, last_page, nr_badpages, uuid, volume_name.
+        header = struct.pack(
+            '=III16s16s', 1, pages - 1, 0, swap_uuid.bytes,
+            (label or '').encode('utf-8')[:16])
+        page = bytearray(pagesize)
+        page[1024:1024 + len(header)] = header
+        page[-len(SWAP_SIGNATURE):] = SWAP_SIGNATURE
+        os.lseek(fd, 0, os.SEEK_SET)
+        if os.write(fd, bytes(page)) != pagesize:
+            raise IOError(errno.EIO, "Short write of the swap header")
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return str(swap_uuid)
@@ -0,0 +1,63 @@
+# Layout profiles of the rbd images of the ceph deploys.
+#
+# A profile is the object size, the striping and the features of an image,
+# given when the image is created or cloned (the layout of a clone does not
+# depend on its parent):
+#
+#   default     what the cluster chooses, 4M objects, no striping and the
+#               features of its rbd_default_features;
+#   managed     4M objects with layering, exclusive-lock, object-map and
+#               fast-diff, so flatten, rm, du and export-diff do not read
+#               every object;
+#   sequential  managed with 8M objects striped by 1M units over 8
+#               objects, a large sequential i/o goes to 8 osds at once;
+#   bulk        managed with 16M objects, fewer and larger ops for big
+#               files written once.
+#
+# Profiles are chosen per image, like 'sys=managed,data=sequential' (the
+# others unset keep 'default'), or one profile name for all the images.
+# The guests open their images by the librbd of qemu, but the deploy maps
+# the sys image by the kernel client ('rbd map') to inject the guest's
+# configuration. The kernel maps striped images since linux 4.17 and images
+# with object-map and fast-diff since 5.3, on older hosts a deploy with such
+# a profile for 'sys' fails at the mount.
+
+from vmdeploy import util
+
+DISKS = ('sys', 'data')
+
+MANAGED_FEATURES = ('layering', 'exclusive-lock', 'object-map', 'fast-diff')
+
+PROFILES = {
+    'default': {},
+    'managed': {'features': MANAGED_FEATURES},
+    'sequential': {
+        'object_size': 8 * 1024 ** 2, 'stripe_unit': 1024 ** 2,
+        'stripe_count': 8, 'features': MANAGED_FEATURES},
+    'bulk': {'object_size': 16 * 1024 ** 2, 'features': MANAGED_FEATURES},
+}
+
+
+# Parse 'sys=managed,data=sequential' or 'managed', return {disk: profile}.
+def parse_spec(value):
+    return util.parse_profile_spec(value, DISKS, PROFILES, "rbd layout",
+                                   item='image')
+
+
+# The layouts of the images of 'value', {disk: layout}.
+def layouts(value):
+    return dict((disk, PROFILES[name])
+                for disk, name in parse_spec(value).items())
+
+
+# Options of 'rbd create' and 'rbd clone' of 'layout'.
+def rbd_args(layout):
+    argv = []
+    if 'object_size' in layout:
+        argv.extend(['--object-size', str(layout['object_size'])])
+    if 'stripe_unit' in layout:
+        argv.extend(['--stripe-unit', str(layout['stripe_unit']),
+                     '--stripe-count', str(layout['stripe_count'])])
+    for feature in layout.get('features', ()):
+        argv.extend(['--image-feature', feature])
+    return argv
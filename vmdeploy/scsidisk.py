@@ -0,0 +1,68 @@
+# Virtio-scsi controller and cache profiles of the rbd disks of the ceph
+# deploys.
+#
+# The rbd disks are on the scsi bus. Without a controller libvirt adds one
+# of the default model with one queue, served by the main loop of qemu with
+# everything else. The domain gets instead
+#
+#   <controller type='scsi' index='0' model='virtio-scsi'>
+#     <driver queues='<vcpus>' iothread='1'/>
+#   </controller>
+#
+# one queue per vcpu, so every vcpu submits its requests on its own queue,
+# all of them served by a dedicated iothread (<iothreads>1</iothreads>).
+#
+# The <driver> of each disk gets the attributes of its cache profile:
+#
+#   default    discard=unmap, the cache mode of qemu (writeback);
+#   writeback  cache=writeback discard=unmap, the librbd cache is on and
+#              flushed by the guest;
+#   none       cache=none discard=unmap, the librbd cache is off, for
+#              databases which cache and sync by themselves.
+#
+# Profiles are chosen per disk, like 'sys=writeback,data=none' (the others
+# unset keep 'default'), or one profile name for all the disks.
+
+from vmdeploy import util
+
+DISKS = ('sys', 'data')
+
+PROFILES = {
+    'default': {'discard': 'unmap'},
+    'writeback': {'cache': 'writeback', 'discard': 'unmap'},
+    'none': {'cache': 'none', 'discard': 'unmap'},
+}
+
+# Id of the iothread of the controller.
+IOTHREAD = 1
+
+
+# Parse 'sys=writeback,data=none' or 'writeback', return {disk: profile}.
+def parse_spec(value):
+    return util.parse_profile_spec(value, DISKS, PROFILES, "cache profile")
+
+
+# Add <iothreads> of the iothread of the controller after 'x_vcpu'.
+def iothreads_xml(x_vcpu):
+    x_iothreads = x_vcpu.makeelement('iothreads', {})
+    x_iothreads.text = str(IOTHREAD)
+    x_vcpu.addnext(x_iothreads)
+    return x_iothreads
+
+
+# Add the virtio-scsi controller with a queue per vcpu to 'x_devices'.
+def controller_xml(x_devices, vcpus):
+    x_controller = util.sub(x_devices, 'controller', type='scsi',
+                            index='0', model='virtio-scsi')
+    util.sub(x_controller, 'driver', queues=str(max(1, vcpus)),
+             iothread=str(IOTHREAD))
+    return x_controller
+
+
+# Add the <driver> of 'disk' with the attributes of its profile in
+# 'profiles' ({disk: profile}) to 'x_disk'.
+def driver_xml(x_disk, profiles, disk):
+    x_driver = util.sub(x_disk, 'driver', name='qemu', type='raw')
+    for name, value in sorted(PROFILES[profiles[disk]].items()):
+        x_driver.set(name, value)
+    return x_driver
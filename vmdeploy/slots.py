@@ -0,0 +1,60 @@
+# Host wide concurrency limits shared by many deploy processes.
+#
+# A limit of N is a set of N lock files under LOCKDIR. Holding a flock on
+# any one of them means holding a slot, so separate deploy-vm-*.py processes
+# started by a batch (or by hand) never run more than N jobs of one kind at
+# the same time. The lock is released by the kernel if a process dies.
+
+import os
+import time
+import fcntl
+
+LOCKDIR = '/tmp/kvm-deploy-locks'
+
+
+class Slots(object):
+
+    def __init__(self, name, limit, lockdir=LOCKDIR, interval=0.2):
+        self.name = name
+        self.limit = limit
+        self.lockdir = lockdir
+        self.interval = interval
+        self.fd = None
+
+    def acquire(self):
+        # No limit means no locking at all, a single deploy is not throttled.
+        if not self.limit:
+            return
+        if not os.path.exists(self.lockdir):
+            try:
+                os.makedirs(self.lockdir, 0o1777)
+            except OSError:
+                # Created by a concurrent deploy.
+                pass
+
+        while True:
+            for index in range(self.limit):
+                lockfile = os.path.join(
+                    self.lockdir, '{0}.{1}.lock'.format(self.name, index))
+                fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    os.close(fd)
+                else:
+                    self.fd = fd
+                    return
+            time.sleep(self.interval)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
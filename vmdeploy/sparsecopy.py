@@ -0,0 +1,227 @@
+# In-process sparse copy of disk images.
+#
+# Only the data extents of the source are visited (lseek SEEK_DATA and
+# SEEK_HOLE), so the holes of a sparse template cost nothing and stay holes
+# in the destination. Extents are copied by copy_file_range(2), which lets
+# the kernel (or the filesystem) move the data without going through user
+# space, and by positioned reads and writes through one reused buffer when
+# copy_file_range is not available. The buffered path also skips blocks of
+# zeros like 'cp --sparse=always'.
+
+import os
+import sys
+import time
+import errno
+import ctypes
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# errno values meaning copy_file_range can not be used for this copy.
+NO_COPY_RANGE_ERRNOS = (
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+# copy_file_range of glibc for python without os.copy_file_range.
+def _libc_copy_file_range():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def copy_file_range(src, dst, count, offset_src, offset_dst):
+        off_in = ctypes.c_int64(offset_src)
+        off_out = ctypes.c_int64(offset_dst)
+        copied = func(src, ctypes.byref(off_in), dst, ctypes.byref(off_out),
+                      count, 0)
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return copied
+    return copy_file_range
+
+
+if hasattr(os, 'copy_file_range'):
+    copy_file_range = os.copy_file_range
+else:
+    copy_file_range = _libc_copy_file_range()
+
+
+# Yield (start, end) of every data extent of 'fd' whose size is 'size'.
+def data_extents(fd, size):
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError:
+            exc = sys.exc_info()[1]
+            if exc.errno == errno.ENXIO:
+                # No data after offset.
+                return
+            if exc.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                # SEEK_DATA is not supported, the rest is one extent.
+                yield (offset, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield (start, end)
+        offset = end
+
+
+# Copy statistics, passed to the progress callback and returned by copy().
+class CopyStats(object):
+
+    def __init__(self, size, data_size):
+        self.size = size
+        self.data_size = data_size
+        self.copied = 0
+        self.method = None
+        self.start = time.time()
+        self.seconds = 0.0
+
+    def update(self, copied):
+        self.copied += copied
+        self.seconds = time.time() - self.start
+
+    def rate(self):
+        # Bytes per second.
+        if self.seconds <= 0:
+            return 0.0
+        return self.copied / self.seconds
+
+    def __str__(self):
+        return (
+            "{0:.1f} MiB of {1:.1f} MiB data ({2:.1f} MiB disk) in "
+            "{3:.1f} seconds, {4:.1f} MiB/s by {5}".format(
+                self.copied / 1048576.0, self.data_size / 1048576.0,
+                self.size / 1048576.0, self.seconds,
+                self.rate() / 1048576.0, self.method))
+
+
+class Copier(object):
+
+    def __init__(self, chunk_size=CHUNK_SIZE, progress=None, bwlimit=None):
+        self.chunk_size = chunk_size
+        # Called as progress(stats) after every chunk.
+        self.progress = progress
+        # Max bytes per second, no limit if None.
+        self.bwlimit = bwlimit
+        self.use_copy_range = copy_file_range is not None
+        self.buf = None
+        self.zeros = None
+
+    def copy(self, src, dst):
+        fsrc = os.open(src, os.O_RDONLY)
+        try:
+            fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                size = os.fstat(fsrc).st_size
+                # Holes of the source are never written, so the destination
+                # gets its full size first and stays sparse.
+                os.ftruncate(fdst, size)
+                extents = list(data_extents(fsrc, size))
+                stats = CopyStats(size, sum(e - s for s, e in extents))
+                for start, end in extents:
+                    self.copy_extent(fsrc, fdst, start, end, stats)
+                os.fsync(fdst)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        if stats.method is None:
+            stats.method = 'none'
+        logger.debug("Copied " + src + " to " + dst + ": " + str(stats))
+        return stats
+
+    def copy_extent(self, fsrc, fdst, start, end, stats):
+        offset = start
+        while offset < end:
+            count = min(self.chunk_size, end - offset)
+            copied = 0
+            if self.use_copy_range:
+                try:
+                    copied = copy_file_range(fsrc, fdst, count, offset, offset)
+                    stats.method = 'copy_file_range'
+                except OSError:
+                    exc = sys.exc_info()[1]
+                    if exc.errno not in NO_COPY_RANGE_ERRNOS:
+                        raise
+                    logger.debug("copy_file_range is not usable. " + str(exc))
+                    self.use_copy_range = False
+            if not self.use_copy_range:
+                copied = self.copy_buffered(fsrc, fdst, offset, count)
+                stats.method = 'read/write'
+            if copied == 0:
+                # The source is shorter than it was.
+                raise IOError("Unexpected end of file at " + str(offset))
+            offset += copied
+            stats.update(copied)
+            self.throttle(stats)
+            if self.progress:
+                self.progress(stats)
+
+    def copy_buffered(self, fsrc, fdst, offset, count):
+        if self.buf is None:
+            self.buf = bytearray(self.chunk_size)
+            self.zeros = bytearray(self.chunk_size)
+        view = memoryview(self.buf)[:count]
+        os.lseek(fsrc, offset, os.SEEK_SET)
+        copied = 0
+        while copied < count:
+            n = self.read_into(fsrc, view[copied:])
+            if n == 0:
+                break
+            copied += n
+        # Blocks of zeros are left as holes.
+        if copied and view[:copied] != memoryview(self.zeros)[:copied]:
+            os.lseek(fdst, offset, os.SEEK_SET)
+            written = 0
+            while written < copied:
+                written += os.write(fdst, view[written:copied])
+        return copied
+
+    def read_into(self, fd, view):
+        if hasattr(os, 'readv'):
+            return os.readv(fd, [view])
+        # os.readv is missing in python 2.
+        data = os.read(fd, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def throttle(self, stats):
+        if not self.bwlimit:
+            return
+        expected = stats.copied / float(self.bwlimit)
+        if expected > stats.seconds:
+            time.sleep(expected - stats.seconds)
+
+
+# Sparse copy of 'src' to 'dst', return CopyStats.
+def copy(src, dst, chunk_size=CHUNK_SIZE, progress=None, bwlimit=None):
+    return Copier(chunk_size, progress, bwlimit).copy(src, dst)
+
+
+# Progress callback which logs every 'step' percent of the data copied.
+def progress_logger(log, step=10):
+    state = {'next': step}
+
+    def progress(stats):
+        if not stats.data_size:
+            return
+        percent = stats.copied * 100 // stats.data_size
+        if percent >= state['next']:
+            state['next'] = (percent // step + 1) * step
+            log.debug("Copied {0}% ({1:.1f} MiB/s).".format(
+                percent, stats.rate() / 1048576.0))
+    return progress
@@ -0,0 +1,129 @@
+# Run the stages of a deploy as a DAG.
+#
+# Every stage is a function with the names of the stages it depends on. A
+# stage starts in its own thread as soon as all of its dependencies are
+# done, so independent stages (xml rendering, swap and data disks) overlap
+# with the long copy of the system disk. When a stage fails no new stage is
+# started, the running ones are waited for and StageError is raised (or the
+# SystemExit or KeyboardInterrupt of the stage, again in the main thread).
+# Stages are timed in the deploy's event log (see vmdeploy.events) when
+# one is given.
+
+import sys
+import time
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+
+class StageError(Exception):
+
+    def __init__(self, stage, exc_info):
+        Exception.__init__(
+            self, "Stage '{0}' failed. {1}".format(stage, exc_info[1]))
+        self.stage = stage
+        self.exc_info = exc_info
+
+
+class Pipeline(object):
+
+    def __init__(self, workers=4, eventlog=None):
+        # Max number of stages running at the same time.
+        self.workers = workers
+        self.eventlog = eventlog
+        self.stages = []
+        self.deps = {}
+        self.funcs = {}
+        self.results = {}
+        # (start, end) of every finished stage, from time.time().
+        self.times = {}
+
+    def add(self, name, func, deps=()):
+        if name in self.funcs:
+            raise ValueError("Duplicate stage: " + name)
+        for dep in deps:
+            if dep not in self.funcs:
+                # Stages are added after their dependencies, so the graph
+                # can not have a cycle.
+                raise ValueError(
+                    "Stage '{0}' depends on unknown stage '{1}'.".format(
+                        name, dep))
+        self.stages.append(name)
+        self.deps[name] = tuple(deps)
+        self.funcs[name] = func
+
+    def result(self, name):
+        return self.results.get(name)
+
+    def run_stage(self, name, done):
+        start = time.time()
+        if self.eventlog:
+            self.eventlog.begin(name)
+        try:
+            self.results[name] = self.funcs[name]()
+        except BaseException:
+            # SystemExit (of cleanfailedcreate) and KeyboardInterrupt too,
+            # run() waits for every stage it started.
+            if self.eventlog:
+                self.eventlog.end(
+                    name, 'failed', error=str(sys.exc_info()[1]))
+            done.put((name, start, sys.exc_info()))
+        else:
+            if self.eventlog:
+                self.eventlog.end(name)
+            done.put((name, start, None))
+
+    def run(self):
+        pending = list(self.stages)
+        finished = set()
+        running = 0
+        failure = None
+        done = queue.Queue()
+
+        while pending or running:
+            if failure is None:
+                for name in list(pending):
+                    if running >= self.workers:
+                        break
+                    if all(dep in finished for dep in self.deps[name]):
+                        pending.remove(name)
+                        running += 1
+                        thread = threading.Thread(
+                            target=self.run_stage, args=(name, done),
+                            name=name)
+                        thread.daemon = True
+                        thread.start()
+            elif not running:
+                break
+
+            # Timeout keeps the main thread responsive to KeyboardInterrupt
+            # on python 2.
+            while True:
+                try:
+                    name, start, exc_info = done.get(timeout=1)
+                    break
+                except queue.Empty:
+                    continue
+            running -= 1
+            self.times[name] = (start, time.time())
+            if exc_info is not None:
+                logger.error("Stage '{0}' failed. {1}".format(
+                    name, exc_info[1]))
+                if failure is None:
+                    failure = (name, exc_info)
+            else:
+                finished.add(name)
+
+        if failure is not None:
+            exc_info = failure[1]
+            if not issubclass(exc_info[0], Exception):
+                # An exit of a stage is the exit of the deploy.
+                raise exc_info[1]
+            raise StageError(*failure)
+        return self.results
@@ -0,0 +1,259 @@
+# Cache of uncompressed templates under 'vmtmplpath'.
+#
+# A template is shipped as '<tmpl>.raw.tar.gz' and deployed from
+# '<tmpl>.raw'. The cache makes sure that
+#
+#   - only one deploy uncompresses a template, others wait for it on the
+#     template's lock file '.<tmpl>.lock' and then use the result;
+#   - the archive is uncompressed by pigz (multi-threaded) when available;
+#   - the archive is checked against '<tmpl>.raw.tar.gz.sha256' (output of
+#     sha256sum) when that file exists, its digest is recorded in
+#     '.<tmpl>.meta' and a changed archive is uncompressed again;
+#   - uncompressed templates that can be recreated from an archive are
+#     removed, least recently used first, when they take more space than
+#     the budget. Templates in use by a deploy hold a shared lock and
+#     pinned templates (backing files of qcow2 disks) are never removed.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# Decompressors tried in order, the first one found in PATH is used.
+DECOMPRESSORS = (['pigz', '-dc'], ['unpigz', '-c'], ['gzip', '-dc'])
+
+CHUNK_SIZE = 1024 * 1024
+
+
+# Helper function to find an executable in PATH.
+def which(command):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        filename = os.path.join(path, command)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+# Helper function to read the digest from a file written by sha256sum.
+def read_sha256(sha256file):
+    with open(sha256file) as f:
+        return f.read().split()[0].lower()
+
+
+class TemplateCache(object):
+
+    def __init__(self, tmplpath, budget=None):
+        self.tmplpath = tmplpath
+        # Budget of uncompressed templates. Unit: GB. No limit if None.
+        self.budget = budget
+        self.lockfds = {}
+        # Templates uncompressed by this process.
+        self.extracted = set()
+
+    def rawfile(self, name):
+        return os.path.join(self.tmplpath, name + '.raw')
+
+    def archive(self, name):
+        return self.rawfile(name) + '.tar.gz'
+
+    def lockfile(self, name):
+        return os.path.join(self.tmplpath, '.' + name + '.lock')
+
+    def metafile(self, name):
+        return os.path.join(self.tmplpath, '.' + name + '.meta')
+
+    def pinfile(self, name):
+        return os.path.join(self.tmplpath, '.' + name + '.pinned')
+
+    def read_meta(self, name):
+        try:
+            with open(self.metafile(name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_meta(self, name, meta):
+        fd, tmpfile = tempfile.mkstemp(
+            dir=self.tmplpath, prefix='.' + name + '.meta.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.rename(tmpfile, self.metafile(name))
+
+    # The uncompressed template is usable if it exists and was made from
+    # the current archive. Templates without archive and pinned templates
+    # (replacing them would corrupt their qcow2 overlays) are always usable.
+    def is_fresh(self, name):
+        if not os.path.isfile(self.rawfile(name)):
+            return False
+        if not os.path.isfile(self.archive(name)):
+            return True
+        if os.path.exists(self.pinfile(name)):
+            return True
+        meta = self.read_meta(name)
+        return meta.get('archive_mtime') == os.path.getmtime(
+            self.archive(name))
+
+    # Return the path of '<name>.raw', uncompress it first if needed. The
+    # template stays locked against eviction until release() is called or
+    # the process exits.
+    def acquire(self, name):
+        if name in self.lockfds:
+            return self.rawfile(name)
+
+        if not os.path.isfile(self.rawfile(name)) \
+                and not os.path.isfile(self.archive(name)):
+            raise IOError(
+                self.rawfile(name) + " is not a valid template file.")
+
+        fd = os.open(self.lockfile(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if not self.is_fresh(name):
+                # Wait for the deploy which is uncompressing it (if any),
+                # then check again before doing it ourselves.
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not self.is_fresh(name):
+                    self.extract(name)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+        except Exception:
+            os.close(fd)
+            raise
+
+        self.lockfds[name] = fd
+        meta = self.read_meta(name)
+        meta['last_used'] = time.time()
+        self.write_meta(name, meta)
+
+        try:
+            self.evict()
+        except Exception:
+            logger.warn("Failed to evict templates. " + str(sys.exc_info()[1]))
+        return self.rawfile(name)
+
+    # A template used as backing file of qcow2 overlays is never evicted.
+    def pin(self, name):
+        open(self.pinfile(name), 'a').close()
+
+    def release(self, name):
+        fd = self.lockfds.pop(name, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    # Uncompress the archive of template 'name', must hold its lock.
+    def extract(self, name):
+        archive = self.archive(name)
+        logger.debug("Begin to uncompress " + archive + ".")
+
+        decompressor = None
+        for command in DECOMPRESSORS:
+            if which(command[0]):
+                decompressor = command
+                break
+        if decompressor is None:
+            raise IOError("No gzip decompressor found in PATH.")
+
+        # Uncompress into a private directory and rename the result, so a
+        # half written '<name>.raw' is never seen by other deploys.
+        workdir = tempfile.mkdtemp(
+            dir=self.tmplpath, prefix='.' + name + '.extract.')
+        devnull = open(os.devnull, 'wb')
+        unzip = subprocess.Popen(
+            decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        untar = subprocess.Popen(
+            ['tar', '-Sxf', '-', '-C', workdir],
+            stdin=unzip.stdout, stdout=devnull)
+        unzip.stdout.close()
+        try:
+
+            # Feed the archive through python so it is hashed in the same
+            # pass as it is uncompressed.
+            digest = hashlib.sha256()
+            with open(archive, 'rb') as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    unzip.stdin.write(chunk)
+            unzip.stdin.close()
+
+            if unzip.wait() != 0 or untar.wait() != 0:
+                raise IOError("Failed to uncompress " + archive + ".")
+
+            sha256 = digest.hexdigest()
+            sha256file = archive + '.sha256'
+            if os.path.isfile(sha256file) and \
+                    read_sha256(sha256file) != sha256:
+                raise IOError("Checksum mismatch of " + archive + ".")
+
+            extracted = os.path.join(workdir, name + '.raw')
+            if not os.path.isfile(extracted):
+                raise IOError(archive + " does not contain " + name + ".raw.")
+            os.rename(extracted, self.rawfile(name))
+        finally:
+            for pobj in (unzip, untar):
+                if pobj.poll() is None:
+                    pobj.kill()
+                    pobj.wait()
+            devnull.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        meta = self.read_meta(name)
+        meta.update({
+            'archive_sha256': sha256,
+            'archive_mtime': os.path.getmtime(archive),
+            'extracted': time.time()})
+        self.write_meta(name, meta)
+        self.extracted.add(name)
+        logger.debug("Succeeded to uncompress " + archive + ".")
+
+    # Remove least recently used templates until the cache fits the budget.
+    def evict(self):
+        if not self.budget:
+            return
+
+        entries = []
+        total = 0
+        for filename in os.listdir(self.tmplpath):
+            if not filename.endswith('.raw') or filename.startswith('.'):
+                continue
+            name = filename[:-len('.raw')]
+            st = os.stat(self.rawfile(name))
+            # Allocated size, the templates are sparse files.
+            size = st.st_blocks * 512
+            total += size
+            meta = self.read_meta(name)
+            # Only templates that can be recreated from an archive.
+            if name in self.lockfds or os.path.exists(self.pinfile(name)):
+                continue
+            if not os.path.isfile(self.archive(name)):
+                continue
+            entries.append((meta.get('last_used', st.st_atime), name, size))
+
+        budget = self.budget * 1024 ** 3
+        for last_used, name, size in sorted(entries):
+            if total <= budget:
+                break
+            fd = os.open(self.lockfile(name), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # Skip templates used by other deploys.
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                continue
+            try:
+                os.remove(self.rawfile(name))
+                total -= size
+                logger.debug("Evicted template " + self.rawfile(name) + ".")
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
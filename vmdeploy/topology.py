@@ -0,0 +1,371 @@
+# NUMA topology of the host and pinning of the vms to it.
+#
+# The host is read from sysfs, '/sys/devices/system' or a fake tree of the
+# same layout:
+#
+#   node/node<N>/cpulist                        cpus of node N, '0-7,16-23'
+#   node/node<N>/meminfo                        'Node N MemTotal: ... kB'
+#   cpu/cpu<M>/topology/thread_siblings_list    hyperthreads of cpu M
+#
+# A host without node directories is one node of the cpus of 'cpu/online'.
+#
+# Every vcpu of a vm is pinned to one cpu of the host:
+#
+#   - the vm goes to the node with the fewest vcpus pinned per cpu which
+#     has the cpus and the memory for it, or to the fewest such nodes when
+#     no node has, its vcpus and memory split evenly between them;
+#   - in its nodes the vcpus take the cpus with the fewest vcpus pinned,
+#     first threads of the cores before their siblings;
+#   - the emulator threads and iothreads float over the cpus of its nodes;
+#   - its memory is bound to its nodes (<numatune> strict), the guest sees
+#     one numa cell per node.
+#
+# The pinned vms are kept in '<vmdeploypath>/.numa.json', changed under the
+# lock '<vmdeploypath>/.numa.lock' by one deploy at a time. The vcpus of a
+# vm whose directory is gone are free again. The state is rebuilt from the
+# <cputune> and <numatune> of the vms' xml when it is missing, or by
+#
+#   python -m vmdeploy.topology --path <vmdeploypath> rebuild
+
+import os
+import re
+import sys
+import glob
+import logging
+import argparse
+import contextlib
+from xml.etree import ElementTree
+
+from vmdeploy import inventory
+from vmdeploy import util
+
+logger = logging.getLogger(__name__)
+
+SYSFS = '/sys/devices/system'
+STATEFILE = '.numa.json'
+LOCKFILE = '.numa.lock'
+
+
+class TopologyError(Exception):
+    pass
+
+
+# Parse a cpu list like '0-3,8,10-11', return a sorted list of ints.
+def parse_cpulist(value):
+    cpus = set()
+    for item in value.strip().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+# Format a list of ints as a cpu list like '0-3,8,10-11'.
+def format_cpulist(cpus):
+    items = []
+    for cpu in sorted(set(cpus)):
+        if items and items[-1][1] == cpu - 1:
+            items[-1][1] = cpu
+        else:
+            items.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else "{0}-{1}".format(first, last)
+        for first, last in items)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class Topology(object):
+
+    # 'nodes' is {node: [cpus]}, 'memory' {node: bytes} and 'siblings'
+    # {cpu: [cpus of its core]}.
+    def __init__(self, nodes, memory, siblings=None):
+        self.nodes = dict((node, sorted(cpus)) for node, cpus in nodes.items())
+        self.memory = dict(memory)
+        self.siblings = siblings or {}
+
+    @classmethod
+    def read(cls, root=SYSFS):
+        nodes = {}
+        memory = {}
+        for nodedir in glob.glob(os.path.join(root, 'node', 'node[0-9]*')):
+            node = int(os.path.basename(nodedir)[len('node'):])
+            cpus = parse_cpulist(_read(os.path.join(nodedir, 'cpulist')))
+            if not cpus:
+                # Memory only node.
+                continue
+            nodes[node] = cpus
+            match = re.search(r'MemTotal:\s+(\d+) kB',
+                              _read(os.path.join(nodedir, 'meminfo')))
+            memory[node] = int(match.group(1)) * 1024 if match else 0
+        if not nodes:
+            nodes[0] = parse_cpulist(
+                _read(os.path.join(root, 'cpu', 'online')))
+            memory[0] = inventory.host_resources()['memory']
+
+        siblings = {}
+        for cpus in nodes.values():
+            for cpu in cpus:
+                try:
+                    siblings[cpu] = parse_cpulist(_read(os.path.join(
+                        root, 'cpu', 'cpu' + str(cpu), 'topology',
+                        'thread_siblings_list')))
+                except (IOError, OSError):
+                    siblings[cpu] = [cpu]
+        return cls(nodes, memory, siblings)
+
+    # 0 for the first thread of a core, 1 for its sibling ...
+    def thread_index(self, cpu):
+        siblings = self.siblings.get(cpu, [cpu])
+        return siblings.index(cpu) if cpu in siblings else 0
+
+
+class Pinning(object):
+
+    def __init__(self, deploypath, topology=None):
+        self.deploypath = deploypath
+        self.topology = topology or Topology.read()
+        # {vmname: placement}, a placement is a dict with 'cpus' (the host
+        # cpu of each vcpu), 'nodes' (the host node of each guest cell),
+        # 'cells' (the vcpus of each cell) and 'memory' (bytes of each
+        # cell).
+        self.vms = {}
+
+    def statefile(self):
+        return os.path.join(self.deploypath, STATEFILE)
+
+    def lockfile(self):
+        return os.path.join(self.deploypath, LOCKFILE)
+
+    # Load the state under the lock and save it when the block exits
+    # without error.
+    @contextlib.contextmanager
+    def locked(self):
+        with util.flocked(self.lockfile()):
+            self.load()
+            yield self
+            self.save()
+
+    def load(self):
+        state = util.load_state(self.statefile())
+        if state is None:
+            logger.debug("Rebuild the numa pinning of "
+                         + self.deploypath + ".")
+            self.rebuild()
+            return
+        self.vms = state.get('vms', {})
+        # Vms removed by hand give their cpus back.
+        for vmname in list(self.vms):
+            if not os.path.isdir(os.path.join(self.deploypath, vmname)):
+                self.release(vmname)
+
+    def save(self):
+        util.save_state(self.statefile(), {'vms': self.vms})
+
+    # Rebuild the state from the xml files of the vms under 'deploypath'.
+    def rebuild(self):
+        self.vms = {}
+        for vmname in sorted(os.listdir(self.deploypath)):
+            xmlfile = os.path.join(self.deploypath, vmname, vmname + '.xml')
+            if vmname.startswith('.') or not os.path.isfile(xmlfile):
+                continue
+            try:
+                placement = parse_placement(ElementTree.parse(xmlfile))
+            except (ElementTree.ParseError, ValueError):
+                logger.warn("Invalid xml " + xmlfile + ".")
+                continue
+            if placement is not None:
+                self.vms[vmname] = placement
+
+    # Vcpus pinned to each cpu, and memory bound to each node.
+    def usage(self):
+        cpus = dict((cpu, 0) for node_cpus in self.topology.nodes.values()
+                    for cpu in node_cpus)
+        memory = dict((node, 0) for node in self.topology.nodes)
+        for placement in self.vms.values():
+            for cpu in placement['cpus']:
+                cpus[cpu] = cpus.get(cpu, 0) + 1
+            for node, size in zip(placement['nodes'], placement['memory']):
+                memory[node] = memory.get(node, 0) + size
+        return cpus, memory
+
+    # Choose the nodes and cpus of 'vmname' with 'vcpus' vcpus and 'memory'
+    # bytes, in cells of multiples of 'unit' bytes (the size of its pages),
+    # keep and return its placement.
+    def place(self, vmname, vcpus, memory, unit=1024 ** 2):
+        if vmname in self.vms:
+            return self.vms[vmname]
+        cpu_usage, memory_used = self.usage()
+        nodes = self.topology.nodes
+
+        def load(node):
+            return (float(sum(cpu_usage[cpu] for cpu in nodes[node]))
+                    / len(nodes[node]),
+                    memory_used[node] - self.topology.memory[node], node)
+
+        def memory_free(node):
+            return self.topology.memory[node] - memory_used[node]
+
+        ordered = sorted(nodes, key=load)
+        chosen = None
+        for node in ordered:
+            if len(nodes[node]) >= vcpus and memory_free(node) >= memory:
+                chosen = [node]
+                break
+        if chosen is None:
+            chosen = []
+            for node in ordered:
+                chosen.append(node)
+                if sum(len(nodes[n]) for n in chosen) >= vcpus \
+                        and sum(memory_free(n) for n in chosen) >= memory:
+                    break
+            # No more nodes than vcpus, a cell has at least one vcpu. The
+            # nodes cut off may have been there for their memory.
+            chosen = sorted(chosen[:vcpus])
+            if sum(memory_free(n) for n in chosen) < memory:
+                raise TopologyError(
+                    "Not enough memory on the numa nodes{0}: {1} GiB "
+                    "free.".format(
+                        "" if len(chosen) == len(nodes) else
+                        " of " + str(vcpus) + " vcpus",
+                        sum(memory_free(n) for n in chosen) // 1024 ** 3))
+        else:
+            chosen = sorted(chosen)
+
+        placement = {'cpus': [], 'nodes': chosen, 'cells': [], 'memory': []}
+        vcpu = 0
+        for index, node in enumerate(chosen):
+            count = vcpus // len(chosen) + (
+                1 if index < vcpus % len(chosen) else 0)
+            cell = []
+            for i in range(count):
+                cpu = min(nodes[node], key=lambda c: (
+                    cpu_usage[c], self.topology.thread_index(c), c))
+                cpu_usage[cpu] += 1
+                placement['cpus'].append(cpu)
+                cell.append(vcpu)
+                vcpu += 1
+            placement['cells'].append(cell)
+        placement['memory'] = split_memory(
+            memory, [len(cell) for cell in placement['cells']],
+            [memory_free(node) for node in chosen], unit)
+        self.vms[vmname] = placement
+        return placement
+
+    # Give back the cpus and memory of 'vmname'.
+    def release(self, vmname):
+        self.vms.pop(vmname, None)
+
+    def summary_str(self):
+        cpu_usage, memory_used = self.usage()
+        lines = ["{0:<8s}{1:<20s}{2:>8s}{3:>12s}{4:>12s}".format(
+            "Node:", "Cpus:", "Vcpus:", "Memory:", "Bound:")]
+        for node in sorted(self.topology.nodes):
+            cpus = self.topology.nodes[node]
+            lines.append("{0:<8d}{1:<20s}{2:>8d}{3:>10.1f}GB{4:>10.1f}GB"
+                         .format(node, format_cpulist(cpus),
+                                 sum(cpu_usage[cpu] for cpu in cpus),
+                                 self.topology.memory[node] / 1024.0 ** 3,
+                                 memory_used[node] / 1024.0 ** 3))
+        return "\n".join(lines)
+
+
+# Split 'memory' bytes into cells of multiples of 'unit' bytes by
+# 'weights', no cell more than the 'free' bytes of its node while others
+# have room. The last cell takes the rest.
+def split_memory(memory, weights, free, unit=1024 ** 2):
+    sizes = [max(0, min(memory * weight // sum(weights), room)) // unit * unit
+             for weight, room in zip(weights, free)]
+    for index, room in enumerate(free):
+        more = min(memory - sum(sizes), room - sizes[index])
+        sizes[index] += max(0, more) // unit * unit
+    sizes[-1] += memory - sum(sizes)
+    return sizes
+
+
+# Return the placement of the parsed domain xml 'tree', None if its vcpus
+# are not pinned.
+def parse_placement(tree):
+    pins = {}
+    for x_vcpupin in tree.findall('cputune/vcpupin'):
+        pins[int(x_vcpupin.get('vcpu'))] = parse_cpulist(
+            x_vcpupin.get('cpuset'))[0]
+    if not pins:
+        return None
+    nodes = {}
+    for x_memnode in tree.findall('numatune/memnode'):
+        nodes[int(x_memnode.get('cellid'))] = parse_cpulist(
+            x_memnode.get('nodeset'))[0]
+    placement = {'cpus': [pins[vcpu] for vcpu in sorted(pins)],
+                 'nodes': [], 'cells': [], 'memory': []}
+    for x_cell in tree.findall('cpu/numa/cell'):
+        cellid = int(x_cell.get('id'))
+        if cellid not in nodes:
+            continue
+        placement['nodes'].append(nodes[cellid])
+        placement['cells'].append(parse_cpulist(x_cell.get('cpus')))
+        placement['memory'].append(int(x_cell.get('memory')) * inventory.UNITS[
+            x_cell.get('unit', 'KiB')])
+    return placement
+
+
+# Add <cputune> and <numatune> of 'placement' after 'x_after' (<vcpu>, or
+# <iothreads> with 'iothreads' of them) and the guest cells to 'x_cpu'.
+def placement_xml(x_after, x_cpu, placement, topology, iothreads=0):
+    nodecpus = []
+    for node in placement['nodes']:
+        nodecpus.extend(topology.nodes[node])
+    nodeset = format_cpulist(nodecpus)
+
+    x_cputune = x_after.makeelement('cputune', {})
+    for vcpu, cpu in enumerate(placement['cpus']):
+        util.sub(x_cputune, 'vcpupin', vcpu=str(vcpu), cpuset=str(cpu))
+    util.sub(x_cputune, 'emulatorpin', cpuset=nodeset)
+    for iothread in range(1, iothreads + 1):
+        util.sub(x_cputune, 'iothreadpin', iothread=str(iothread),
+                 cpuset=nodeset)
+
+    x_numatune = x_after.makeelement('numatune', {})
+    util.sub(x_numatune, 'memory', mode='strict',
+             nodeset=format_cpulist(placement['nodes']))
+    for cellid, node in enumerate(placement['nodes']):
+        util.sub(x_numatune, 'memnode', cellid=str(cellid),
+                 mode='strict', nodeset=str(node))
+
+    x_after.addnext(x_numatune)
+    x_after.addnext(x_cputune)
+
+    x_numa = util.sub(x_cpu, 'numa')
+    for cellid, cell in enumerate(placement['cells']):
+        util.sub(x_numa, 'cell', id=str(cellid),
+                 cpus=format_cpulist(cell),
+                 memory=str(placement['memory'][cellid] // 1024),
+                 unit='KiB')
+    return x_cputune, x_numatune, x_numa
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Show or rebuild the numa pinning of the vms')
+    parser.add_argument('--path', dest='vmdeploypath', required=True)
+    parser.add_argument(
+        '--sysfs', dest='sysfs', default=SYSFS,
+        help="sysfs tree of the host. (Default: %(default)s)")
+    parser.add_argument('action', choices=['show', 'rebuild'])
+    args = parser.parse_args(argv)
+
+    pinning = Pinning(args.vmdeploypath, Topology.read(args.sysfs))
+    with pinning.locked():
+        if args.action == 'rebuild':
+            pinning.rebuild()
+    print(pinning.summary_str())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# Helpers shared by the modules of the deploys.
+
+import os
+import json
+import fcntl
+import tempfile
+import contextlib
+
+
+# Parse a profile spec like 'sys=<profile>,data=<profile>' (the disks unset
+# keep 'default') or one profile name for all of 'disks', return
+# {disk: profile}. 'what' names the profiles and 'item' the disks in the
+# errors.
+def parse_profile_spec(value, disks, profiles, what, item='disk'):
+    result = dict((disk, 'default') for disk in disks)
+    if not value:
+        return result
+    if '=' not in value:
+        if value not in profiles:
+            raise ValueError("Unknown " + what + ": " + value)
+        return dict((disk, value) for disk in disks)
+    for spec in value.split(','):
+        disk, _, name = spec.strip().partition('=')
+        if disk not in disks:
+            raise ValueError("Unknown " + item + " '" + disk + "', the "
+                             + item + "s are " + ", ".join(disks))
+        if name not in profiles:
+            raise ValueError("Unknown " + what + ": " + name)
+        result[disk] = name
+    return result
+
+
+# Append a 'tag' element of 'attrib' to the lxml element 'parent'.
+def sub(parent, tag, **attrib):
+    element = parent.makeelement(tag, attrib)
+    parent.append(element)
+    return element
+
+
+# Hold the exclusive flock of 'lockfile' in the block, deploys of the host
+# running at the same time wait for each other.
+@contextlib.contextmanager
+def flocked(lockfile):
+    fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+# The json state in 'path', None when it is missing or invalid.
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# Replace the json state in 'path' by 'state' at once, a reader never sees
+# half of it.
+def save_state(path, state):
+    fd, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmpfile, path)
+
+
+# Load the json state in 'path' ({} when missing) under 'lockfile' (default
+# '<path>.lock') and save it when the block exits without error:
+#
+#   with util.locked_state(path) as state:
+#       state['key'] = value
+@contextlib.contextmanager
+def locked_state(path, lockfile=None):
+    with flocked(lockfile or path + '.lock'):
+        state = load_state(path)
+        if state is None:
+            state = {}
+        yield state
+        save_state(path, state)
@@ -0,0 +1,254 @@
+# Warm pool of ready made sys disks.
+#
+# For the (template, sys size) pairs listed in 'warmpool' of deploy-vm.conf,
+# like
+#
+#   warmpool = centos-7.2-x64/20:4,centos-7.2-x64/100:2
+#
+# sys disks are copied from the template, resized, their partition 1 grown
+# and their xfs file system grown ahead of time. They are kept under
+# '<vmdeploypath>/.pool/<tmpl>-<size>G/'. A deploy claims one by renaming
+# it to its own '<vmname>.sys': the pool is on the same file system as the
+# vm directories, so the rename is atomic and two deploys never get the
+# same disk. Then the deploy starts a replenisher in the background
+# ('python -m vmdeploy.warmpool') which fills the pool up again, only one
+# replenisher per pool runs at a time.
+#
+# Pool disks made before '<tmpl>.raw' was (re)uncompressed are stale and
+# removed instead of being claimed. The grown part of a pool disk has the
+# allocation ('--allocation') of the deploy which started its replenisher.
+
+import os
+import sys
+import uuid
+import errno
+import fcntl
+import logging
+import argparse
+import subprocess
+
+from vmdeploy import loopdev
+from vmdeploy import parttable
+from vmdeploy import provision
+from vmdeploy import rawdisk
+from vmdeploy import slots
+from vmdeploy import sparsecopy
+from vmdeploy import tmplcache
+
+logger = logging.getLogger(__name__)
+
+POOLDIR = '.pool'
+
+
+# Parse 'warmpool' of deploy-vm.conf, return {(tmpl, size): count}.
+def parse_spec(value):
+    pools = {}
+    if not value:
+        return pools
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            tmpl, rest = item.rsplit('/', 1)
+            size, count = rest.split(':')
+            size, count = int(size), int(count)
+        except ValueError:
+            raise ValueError("Invalid warm pool '" + item + "', the format "
+                             "is '<tmpl>/<size>:<count>'.")
+        if not tmpl or size <= 0 or count <= 0:
+            raise ValueError("Invalid warm pool '" + item + "'.")
+        pools[(tmpl, size)] = count
+    return pools
+
+
+class WarmPool(object):
+
+    def __init__(self, deploypath, tmpl, size):
+        self.tmpl = tmpl
+        # Size of the pool disks. Unit: GB.
+        self.size = size
+        self.pooldir = os.path.join(
+            deploypath, POOLDIR, '{0}-{1}G'.format(tmpl, size))
+
+    def lockfile(self):
+        return os.path.join(self.pooldir, '.fill.lock')
+
+    # Ready disks of the pool, the oldest first.
+    def disks(self):
+        try:
+            filenames = os.listdir(self.pooldir)
+        except OSError:
+            return []
+        disks = []
+        for filename in filenames:
+            if filename.startswith('.') or not filename.endswith('.sys'):
+                continue
+            path = os.path.join(self.pooldir, filename)
+            try:
+                disks.append((os.path.getmtime(path), path))
+            except OSError:
+                # Claimed meanwhile.
+                continue
+        return [path for mtime, path in sorted(disks)]
+
+    # Remove pool disks made from an older template than 'tmplfile'. tar
+    # keeps the mtime of the archived template, its ctime tells when it was
+    # uncompressed.
+    def remove_stale(self, tmplfile):
+        tmpl_ctime = os.stat(tmplfile).st_ctime
+        for path in self.disks():
+            try:
+                if os.path.getmtime(path) < tmpl_ctime:
+                    os.remove(path)
+                    logger.debug("Removed stale pool disk " + path + ".")
+            except OSError:
+                continue
+
+    # Move a ready disk to 'dst'. Return False if the pool is empty.
+    def claim(self, dst, tmplfile):
+        self.remove_stale(tmplfile)
+        for path in self.disks():
+            try:
+                os.rename(path, dst)
+            except OSError:
+                exc = sys.exc_info()[1]
+                if exc.errno == errno.ENOENT:
+                    # Another deploy was faster.
+                    continue
+                raise
+            logger.debug("Claimed pool disk " + path + ".")
+            return True
+        return False
+
+    # Make one ready disk from 'tmplfile'.
+    def make_disk(self, tmplfile, iojobs=None, loopjobs=None,
+                  allocation='off'):
+        name = str(uuid.uuid4())
+        # Work on a dot file, claim() only takes finished disks.
+        tmpfile = os.path.join(self.pooldir, '.' + name + '.sys.tmp')
+        try:
+            with slots.Slots('diskio', iojobs):
+                method, fmt = provision.provision_sysdisk(
+                    'reflink', tmplfile, tmpfile, self.size,
+                    progress=sparsecopy.progress_logger(logger))
+                logger.debug("Provisioned " + tmpfile + " by " + method + ".")
+                rawdisk.resize(tmpfile, self.size * rawdisk.GIB, allocation)
+
+            first, last = parttable.grow_partition(tmpfile)
+            logger.debug("Grew partition 1 to sectors {0}-{1}.".format(
+                first, last))
+
+            with slots.Slots('loop', loopjobs):
+                with loopdev.mount_partition(tmpfile) as mountpoint:
+                    returncode = subprocess.call(
+                        ['xfs_growfs', mountpoint],
+                        stdout=open(os.devnull, 'wb'))
+                    if returncode != 0:
+                        raise IOError("Failed to grow xfs of " + tmpfile)
+
+            path = os.path.join(self.pooldir, name + '.sys')
+            os.rename(tmpfile, path)
+        except Exception:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        logger.debug("Added pool disk " + path + ".")
+        return path
+
+    # Make disks until the pool has 'count' of them, grown by 'allocation'.
+    # Return the number of disks made, or None if another replenisher is
+    # filling the pool.
+    def fill(self, templates, count, iojobs=None, loopjobs=None,
+             allocation='off'):
+        if not os.path.isdir(self.pooldir):
+            os.makedirs(self.pooldir, 0o755)
+
+        fd = os.open(self.lockfile(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return None
+
+            # Leftovers of a replenisher which died.
+            for filename in os.listdir(self.pooldir):
+                if filename.endswith('.sys.tmp'):
+                    os.remove(os.path.join(self.pooldir, filename))
+
+            tmplfile = templates.acquire(self.tmpl)
+            try:
+                self.remove_stale(tmplfile)
+                made = 0
+                while len(self.disks()) < count:
+                    self.make_disk(tmplfile, iojobs, loopjobs, allocation)
+                    made += 1
+            finally:
+                templates.release(self.tmpl)
+            return made
+        finally:
+            os.close(fd)
+
+
+# Start a replenisher of the pool in the background, its output is
+# appended to 'logfile'.
+def replenish(deploypath, tmplpath, tmpl, size, count, logfile,
+              tmplcachesize=None, iojobs=None, loopjobs=None,
+              allocation='off'):
+    # The replenisher runs in the directory above vmdeploy.
+    argv = [sys.executable, '-m', 'vmdeploy.warmpool',
+            '--path', os.path.abspath(deploypath),
+            '--tmplpath', os.path.abspath(tmplpath), '--tmpl', tmpl,
+            '--sys', str(size), '--count', str(count)]
+    for flag, value in (('--tmplcachesize', tmplcachesize),
+                        ('--iojobs', iojobs), ('--loopjobs', loopjobs),
+                        ('--allocation', allocation)):
+        if value:
+            argv.extend([flag, str(value)])
+
+    with open(logfile, 'a') as f:
+        # New session, the replenisher outlives the deploy.
+        return subprocess.Popen(
+            argv, stdin=open(os.devnull, 'rb'), stdout=f,
+            stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fill the warm pool of sys disks of a template')
+    parser.add_argument('--path', dest='vmdeploypath', required=True)
+    parser.add_argument('--tmplpath', dest='vmtmplpath', required=True)
+    parser.add_argument('--tmpl', dest='vmtmpl', required=True)
+    parser.add_argument('--sys', dest='vmsyssize', type=int, required=True)
+    parser.add_argument('--count', dest='count', type=int, required=True)
+    parser.add_argument('--tmplcachesize', dest='tmplcachesize', type=int)
+    parser.add_argument('--iojobs', dest='iojobs', type=int)
+    parser.add_argument('--loopjobs', dest='loopjobs', type=int)
+    parser.add_argument(
+        '--allocation', dest='allocation', default='off',
+        choices=rawdisk.ALLOCATIONS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s [%(process)d] [%(levelname)-5.5s]  %(message)s")
+
+    pool = WarmPool(args.vmdeploypath, args.vmtmpl, args.vmsyssize)
+    templates = tmplcache.TemplateCache(args.vmtmplpath, args.tmplcachesize)
+    try:
+        made = pool.fill(templates, args.count, args.iojobs, args.loopjobs,
+                         args.allocation)
+    except Exception:
+        logger.error("Failed to fill " + pool.pooldir + ". "
+                     + str(sys.exc_info()[1]))
+        return 1
+    if made is None:
+        logger.debug(pool.pooldir + " is being filled by another process.")
+    else:
+        logger.debug("Added {0} disks to {1}.".format(made, pool.pooldir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())